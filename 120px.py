@@ -1,85 +1,129 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+
 import cv2
+import numpy as np
+
+import profiling
+from annotation_index import open_yolo_index
+from build_cache import BuildCache
+from crops import (centred_crops, write_shard, crop_filename, pack_split, IMAGES_SUFFIX, LABELS_SUFFIX, BOXES_SUFFIX,
+                   MIN_VISIBILITY, PACKED_PREFIX)
 
 dataset_base = "sticky_dataset/5mpx"
 output_base = "sticky_dataset/120px"
 splits = ["train", "val"]
 crop_size = 120
 
-for split in splits:
-    img_dir = os.path.join(dataset_base, "images", split)
-    label_dir = os.path.join(dataset_base, "labels", split)
-    out_img_dir = os.path.join(output_base, split, "images")
-    out_label_dir = os.path.join(output_base, split, "labels")
-    os.makedirs(out_img_dir, exist_ok=True)
-    os.makedirs(out_label_dir, exist_ok=True)
-
-    img_files = [f for f in os.listdir(img_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-    print(f"\n[{split}] Encontradas {len(img_files)} imagens em {img_dir}")
-
-    for img_file in img_files:
-        name = os.path.splitext(img_file)[0]
-        img_path = os.path.join(img_dir, img_file)
-        label_path = os.path.join(label_dir, name + ".txt")
-
-        if not os.path.exists(label_path):
-            print(f"Label não encontrado para: {img_file}")
-            continue
-
-        img = cv2.imread(img_path)
-        if img is None:
-            print(f"Erro ao ler imagem: {img_path}")
-            continue
-        h, w = img.shape[:2]
-
-        with open(label_path) as f:
-            lines = f.readlines()
-
-        for idx, line in enumerate(lines):
-            parts = line.strip().split()
-            if len(parts) < 5:
-                print(f"Linha inválida em {label_path}: {line}")
-                continue
-            class_id, x_center, y_center, bbox_w, bbox_h = map(float, parts)
-            xc = x_center * w
-            yc = y_center * h
-            bw = bbox_w * w
-            bh = bbox_h * h
-
-            x1 = int(round(xc - crop_size/2))
-            y1 = int(round(yc - crop_size/2))
-            x1 = max(0, min(w - crop_size, x1))
-            y1 = max(0, min(h - crop_size, y1))
-            x2 = x1 + crop_size
-            y2 = y1 + crop_size
-
-            crop = img[y1:y2, x1:x2]
-            if crop.shape[0] != crop_size or crop.shape[1] != crop_size:
-                print(f"Crop fora do tamanho em {img_file} bbox {idx}")
+# Crops go to packed shards in <output_base>/<split>/shards, then into one packed_*.npy array per
+# column in <output_base>/<split> (see crops.py).
+# Set EXPORT_LOOSE to also write one .jpg + .txt per crop (needed by `yolo detect train` and magic.py).
+EXPORT_LOOSE = False
+
+# Also label every other insect visible in a crop (clipped, at least MIN_VISIBILITY of it inside),
+# not only the one the crop is centred on - unlabelled neighbours were being learned as background.
+NEIGHBOUR_LABELS = True
+
+# Worker processes (1 = serial)
+NUM_WORKERS = os.cpu_count() or 1
+
+# Only the script itself (and its spawned pool workers) profile - never a module that imports this one
+if __name__ in ("__main__", "__mp_main__"):
+    profiling.install()  # no-op unless STICKY_PROFILE is set
+
+
+def process_image(task):
+    """Crops every box of one image. Returns (log line, number of crops, output paths)."""
+    img_path, label_path, labels, line_idx, shard_dir, out_img_dir, out_label_dir = task
+    img_file = os.path.basename(img_path)
+    name = os.path.splitext(img_file)[0]
+
+    img = cv2.imread(img_path)
+    if img is None:
+        return f"Erro ao ler imagem: {img_path}", 0, []
+
+    crops, crop_labels = centred_crops(img, labels, crop_size, NEIGHBOUR_LABELS, MIN_VISIBILITY)
+    if crops is None:
+        return f"Crop fora do tamanho (ou sem labels) em {img_file}", 0, []
+
+    with profiling.span("shard_write", bytes_written=crops.nbytes + crop_labels.nbytes):
+        write_shard(shard_dir, name, crops, crop_labels, line_idx)
+    outputs = [os.path.join(shard_dir, name + suffix) for suffix in (IMAGES_SUFFIX, LABELS_SUFFIX, BOXES_SUFFIX)]
+
+    if EXPORT_LOOSE:
+        starts = np.searchsorted(crop_labels[:, 0], np.arange(len(crops) + 1))
+        for i in range(len(crops)):
+            rows = crop_labels[starts[i]:starts[i + 1], 1:]  # centred box first
+            crop_filename_i = crop_filename(name, line_idx[i], rows[0, 0])
+            crop_img_path = os.path.join(out_img_dir, crop_filename_i)
+            cv2.imwrite(crop_img_path, crops[i])
+            crop_label_path = os.path.join(out_label_dir, crop_filename_i.replace('.jpg', '.txt'))
+            with profiling.span("label_write"), open(crop_label_path, "w") as ftxt:
+                for class_id, xc_norm, yc_norm, bw_norm, bh_norm in rows:
+                    ftxt.write(f"{int(class_id)} {xc_norm:.6f} {yc_norm:.6f} {bw_norm:.6f} {bh_norm:.6f}\n")
+            outputs += [crop_img_path, crop_label_path]
+
+    return f"Salvo: {name} ({len(crops)} crops)", len(crops), outputs
+
+
+if __name__ == "__main__":
+    cache = BuildCache()
+    params = {"crop_size": crop_size, "export_loose": EXPORT_LOOSE,
+              "neighbour_labels": NEIGHBOUR_LABELS, "min_visibility": MIN_VISIBILITY}
+    live_keys = []
+    total = 0
+    rebuilt = {}
+    for split in splits:
+        img_dir = os.path.join(dataset_base, "images", split)
+        label_dir = os.path.join(dataset_base, "labels", split)
+        shard_dir = os.path.join(output_base, split, "shards")
+        out_img_dir = os.path.join(output_base, split, "images")
+        out_label_dir = os.path.join(output_base, split, "labels")
+        os.makedirs(shard_dir, exist_ok=True)
+        if EXPORT_LOOSE:
+            os.makedirs(out_img_dir, exist_ok=True)
+            os.makedirs(out_label_dir, exist_ok=True)
+
+        # Labels come from the columnar index (annotation_index.py), rebuilt only when a .txt changed
+        with profiling.span("label_index"):
+            index = open_yolo_index(img_dir, label_dir, num_workers=NUM_WORKERS)
+        print(f"\n[{split}] Encontradas {len(index)} imagens em {img_dir}")
+
+        tasks = []
+        for image_id, img_file in enumerate(index.images):
+            name = os.path.splitext(img_file)[0]
+            if not index.labelled[image_id]:
+                print(f"Label não encontrado para: {img_file}")
                 continue
-
-            xc_crop = xc - x1
-            yc_crop = yc - y1
-            bw_crop = bw
-            bh_crop = bh
-            xc_norm = xc_crop / crop_size
-            yc_norm = yc_crop / crop_size
-            bw_norm = bw_crop / crop_size
-            bh_norm = bh_crop / crop_size
-
-            xc_norm = max(0, min(1, xc_norm))
-            yc_norm = max(0, min(1, yc_norm))
-            bw_norm = max(0, min(1, bw_norm))
-            bh_norm = max(0, min(1, bh_norm))
-
-            crop_filename = f"{name}_bb{idx}_class{int(class_id)}.jpg"
-            crop_img_path = os.path.join(out_img_dir, crop_filename)
-            cv2.imwrite(crop_img_path, crop)
-
-            crop_label_path = os.path.join(out_label_dir, crop_filename.replace('.jpg', '.txt'))
-            with open(crop_label_path, "w") as ftxt:
-                ftxt.write(f"{int(class_id)} {xc_norm:.6f} {yc_norm:.6f} {bw_norm:.6f} {bh_norm:.6f}\n")
-
-            print(f"Salvo: {crop_img_path} + {crop_label_path}")
-
-print("Crops e labels YOLO de 120x120 px gerados.")
+            labels, line_idx = index.labels(image_id)
+            tasks.append((os.path.join(img_dir, img_file), os.path.join(label_dir, name + ".txt"),
+                          labels, line_idx, shard_dir, out_img_dir, out_label_dir))
+
+        # Skip images whose image, label and settings are unchanged since the last run
+        cache.prime([p for t in tasks for p in t[:2]], NUM_WORKERS)
+        live_keys += [t[0] for t in tasks]
+        tasks = [t for t in tasks if not cache.is_fresh("120px", t[0], list(t[:2]), params)]
+        rebuilt[split] = len(tasks)
+
+        if NUM_WORKERS > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=NUM_WORKERS) as pool:
+                results = list(pool.map(process_image, tasks))
+        else:
+            results = [process_image(t) for t in tasks]
+        for task, (line, n, outputs) in zip(tasks, results):
+            print(line)
+            total += n
+            cache.record("120px", task[0], list(task[:2]), params, outputs)
+
+    removed = cache.evict("120px", live_keys)
+    cache.save()
+
+    # One packed array per split, redone only when one of its shards changed
+    for split in splits:
+        split_dir = os.path.join(output_base, split)
+        stale = any(os.path.dirname(os.path.dirname(p)) == split_dir for p in removed)
+        if rebuilt[split] or stale or not os.path.exists(os.path.join(split_dir, PACKED_PREFIX + "offsets.npy")):
+            with profiling.span("pack_split"):
+                n = pack_split(split_dir)
+            print(f"[{split}] {n} crops empacotados em {split_dir}/{PACKED_PREFIX}*.npy")
+    print(f"{total} crops e labels YOLO de {crop_size}x{crop_size} px gerados ({len(removed)} arquivos obsoletos removidos).")
@@ -1,7 +1,10 @@
 import os
-import shutil
-import random
+import hashlib
 import yaml
+import numpy as np
+
+from annotation_index import open_yolo_index, INDEX_SUFFIX
+from file_links import link_file, is_placed, LINK_MODE
 
 # CONFIGURATION
 SRC_DIR = "sticky_dataset/stickytraps"
@@ -13,50 +16,128 @@ DST_LABEL_VAL   = os.path.join(DST_DIR, "labels/val")
 YAML_PATH = os.path.join(DST_DIR, "dataset.yaml")
 CLASSES = ["Macrolophus", "Nesidiocoris", "Whitefly"]  # adapte se mudar as classes
 SPLIT_RATIO = 0.8  # 80% train
+SPLIT_SEED = 0
+
+# Balance the per-class instance counts between train and val (seeded, deterministic).
+# False = independent per-image hash split, where adding photos never moves existing ones.
+STRATIFY = True
+
+# Index of the source labels used for the stratification (see annotation_index.py)
+LABEL_INDEX = os.path.join(DST_DIR, "source_labels" + INDEX_SUFFIX)
+
+def image_order(img_file):
+    return hashlib.blake2b(f"{SPLIT_SEED}:{img_file}".encode(), digest_size=8).digest()
+
+def split_of(img_file):
+    # Stable per-image assignment: adding new photos never moves existing ones to the other split
+    return "train" if int.from_bytes(image_order(img_file), "big") / 2**64 < SPLIT_RATIO else "val"
+
+def stratified_split(img_files, counts, ratio=SPLIT_RATIO):
+    """
+    Iterative stratification: the class with the fewest instances left is placed first,
+    each of its images going to the split that is furthest below its share of that class.
+    counts is (n_images, nc) instances per class. Returns {img_file: "train" | "val"}.
+    """
+    order = sorted(range(len(img_files)), key=lambda i: image_order(img_files[i]))
+    img_files = [img_files[i] for i in order]
+    counts = np.asarray(counts, dtype=np.float64)[order]
+    shares = np.array([ratio, 1 - ratio])
+    wanted = shares[:, None] * counts.sum(0)[None, :]   # instances each split still needs, per class
+    wanted_images = shares * len(img_files)
+    split = np.full(len(img_files), -1)
+    remaining = counts.copy()
+
+    while True:
+        left = remaining.sum(0)
+        classes = np.flatnonzero(left > 0)
+        if len(classes) == 0:
+            break
+        c = classes[left[classes].argmin()]
+        for i in np.flatnonzero((split < 0) & (counts[:, c] > 0)):
+            # Most needed for this class, then most images still needed, then train
+            s = max(range(2), key=lambda k: (wanted[k, c], wanted_images[k], -k))
+            split[i] = s
+            wanted[s] -= counts[i]
+            wanted_images[s] -= 1
+            remaining[i] = 0
+
+    for i in np.flatnonzero(split < 0):  # images without boxes
+        s = max(range(2), key=lambda k: (wanted_images[k], -k))
+        split[i] = s
+        wanted_images[s] -= 1
+    return {f: ("train", "val")[s] for f, s in zip(img_files, split)}
+
+def sync_dir(dst_dir, wanted):
+    """Makes dst_dir hold exactly wanted ({file name: source path}). Returns (placed, removed) counts."""
+    placed = removed = 0
+    for fname, src in wanted.items():
+        dst = os.path.join(dst_dir, fname)
+        if not is_placed(src, dst, LINK_MODE):
+            link_file(src, dst, LINK_MODE)
+            placed += 1
+    for fname in os.listdir(dst_dir):
+        path = os.path.join(dst_dir, fname)
+        if fname not in wanted and (os.path.isfile(path) or os.path.islink(path)):
+            os.remove(path)
+            removed += 1
+    return placed, removed
+
+if __name__ == "__main__":
+    # Ensure output folders exist
+    os.makedirs(DST_IMG_TRAIN, exist_ok=True)
+    os.makedirs(DST_IMG_VAL, exist_ok=True)
+    os.makedirs(DST_LABEL_TRAIN, exist_ok=True)
+    os.makedirs(DST_LABEL_VAL, exist_ok=True)
+
+    # Get all jpgs from SRC_DIR
+    all_imgs = sorted(f for f in os.listdir(SRC_DIR) if f.lower().endswith(".jpg"))
+    if STRATIFY:
+        index = open_yolo_index(SRC_DIR, SRC_DIR, LABEL_INDEX)
+        counts = np.zeros((len(all_imgs), len(CLASSES)))
+        for i, img_file in enumerate(all_imgs):
+            image_id = index.image_id(img_file)
+            if image_id is not None:
+                cls = index.boxes(image_id)[:, 0].astype(np.int64)
+                counts[i] = np.bincount(cls[cls < len(CLASSES)], minlength=len(CLASSES))
+        splits = stratified_split(all_imgs, counts)
+    else:
+        splits = {f: split_of(f) for f in all_imgs}
+    train_imgs = [f for f in all_imgs if splits[f] == "train"]
+    val_imgs = [f for f in all_imgs if splits[f] == "val"]
+
+    n_placed = n_removed = 0
+    for img_set, img_list, dst_img_dir, dst_label_dir in [
+        ('train', train_imgs, DST_IMG_TRAIN, DST_LABEL_TRAIN),
+        ('val', val_imgs, DST_IMG_VAL, DST_LABEL_VAL),
+    ]:
+        # Images and labels are linked, not copied (file_links.py); files that left the split are removed
+        wanted_imgs, wanted_labels = {}, {}
+        for img_file in img_list:
+            wanted_imgs[img_file] = os.path.join(SRC_DIR, img_file)
+            label_file = os.path.splitext(img_file)[0] + ".txt"
+            src_label_path = os.path.join(SRC_DIR, label_file)
+            if os.path.exists(src_label_path):
+                wanted_labels[label_file] = src_label_path
+            else:
+                print(f"[WARN] No label for {img_file}")
+        for dst_dir, wanted in [(dst_img_dir, wanted_imgs), (dst_label_dir, wanted_labels)]:
+            placed, removed = sync_dir(dst_dir, wanted)
+            n_placed += placed
+            n_removed += removed
+
+        print(f"{img_set}: {len(img_list)} images/labels")
+
+    print(f"{n_placed} files linked ({LINK_MODE}), {n_removed} stale files removed.")
+
+    # Create dataset.yaml
+    yaml_dict = {
+        "train": os.path.abspath(DST_IMG_TRAIN),
+        "val": os.path.abspath(DST_IMG_VAL),
+        "nc": len(CLASSES),
+        "names": CLASSES
+    }
+
+    with open(YAML_PATH, "w") as f:
+        yaml.dump(yaml_dict, f, sort_keys=False)
 
-# Ensure output folders exist
-os.makedirs(DST_IMG_TRAIN, exist_ok=True)
-os.makedirs(DST_IMG_VAL, exist_ok=True)
-os.makedirs(DST_LABEL_TRAIN, exist_ok=True)
-os.makedirs(DST_LABEL_VAL, exist_ok=True)
-
-# Get all jpgs from SRC_DIR
-all_imgs = [f for f in os.listdir(SRC_DIR) if f.lower().endswith(".jpg")]
-random.shuffle(all_imgs)
-
-n_train = int(len(all_imgs) * SPLIT_RATIO)
-train_imgs = all_imgs[:n_train]
-val_imgs = all_imgs[n_train:]
-
-for img_set, img_list, dst_img_dir, dst_label_dir in [
-    ('train', train_imgs, DST_IMG_TRAIN, DST_LABEL_TRAIN),
-    ('val', val_imgs, DST_IMG_VAL, DST_LABEL_VAL),
-]:
-    for img_file in img_list:
-        src_img_path = os.path.join(SRC_DIR, img_file)
-        label_file = os.path.splitext(img_file)[0] + ".txt"
-        src_label_path = os.path.join(SRC_DIR, label_file)
-
-        # Copy image
-        shutil.copy2(src_img_path, os.path.join(dst_img_dir, img_file))
-
-        # Copy label if exists
-        if os.path.exists(src_label_path):
-            shutil.copy2(src_label_path, os.path.join(dst_label_dir, label_file))
-        else:
-            print(f"[WARN] No label for {img_file}")
-
-    print(f"{img_set}: {len(img_list)} images/labels")
-
-# Create dataset.yaml
-yaml_dict = {
-    "train": os.path.abspath(DST_IMG_TRAIN),
-    "val": os.path.abspath(DST_IMG_VAL),
-    "nc": len(CLASSES),
-    "names": CLASSES
-}
-
-with open(YAML_PATH, "w") as f:
-    yaml.dump(yaml_dict, f, sort_keys=False)
-
-print(f"\n✅ Dataset split, organized and YAML file '{YAML_PATH}' created for YOLO training!")
+    print(f"\n✅ Dataset split, organized and YAML file '{YAML_PATH}' created for YOLO training!")
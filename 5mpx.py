@@ -1,6 +1,10 @@
 import os
 import cv2
 
+import profiling
+
+profiling.install()  # no-op unless STICKY_PROFILE is set
+
 # Diretórios
 src_base = "sticky_dataset/16mpx/images"
 dst_base = "sticky_dataset/5mpx/images"
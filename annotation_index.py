@@ -0,0 +1,297 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from crops import read_yolo_labels
+from image_header import read_image_size
+from xml_txt import voc_root_to_boxes, voc_size, CLASSES
+
+"""
+Columnar, memory-mapped annotation index.
+
+Instead of re-parsing thousands of small YOLO .txt files (or VOC XMLs) in every
+script, the annotations of a folder are parsed once into a directory of .npy
+columns that any stage can np.load(..., mmap_mode="r"):
+
+    images.npy   <U..   n       image file names
+    width.npy    int32  n       source resolution (as cv2.imread sees it)
+    height.npy   int32  n
+    labelled.npy bool   n       image had a label file / XML
+    offsets.npy  int64  n + 1   boxes of image i are rows offsets[i]:offsets[i+1]
+    image.npy    int32  m       image id of every box
+    cls.npy      int16  m       class id (xml_txt.CLASSES order)
+    xc/yc/w/h.npy float64 m     normalised YOLO box, exactly as parsed
+    line.npy     int32  m       label line (YOLO) or <object> index (VOC) of the box
+    meta.json                   source folders, format and a stat signature of the sources
+
+Boxes are stored grouped by image, so "all boxes of image N" is one slice and
+per-class counts or size histograms are single vectorised NumPy calls.
+"""
+
+INDEX_SUFFIX = ".annidx"
+COLUMNS = ["xc", "yc", "w", "h"]
+VOC_DIR = "sticky_dataset/stickytraps"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Worker processes used to parse the sources (1 = serial)
+NUM_WORKERS = os.cpu_count() or 1
+
+
+def index_path(source_dir):
+    """Default index location: next to the folder it indexes (labels/train -> labels/train.annidx)."""
+    return os.path.normpath(source_dir) + INDEX_SUFFIX
+
+
+def source_signature(paths):
+    """Hash of (name, size, mtime_ns) of every source file - a stat per file, no reads."""
+    h = hashlib.blake2b(digest_size=16)
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        h.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def _parse_yolo(task):
+    img_path, label_path = task
+    size = read_image_size(img_path)
+    if not os.path.exists(label_path):
+        return size, False, np.zeros((0, 5)), np.zeros(0, np.int32)
+    labels, line_idx = read_yolo_labels(label_path)
+    return size, True, labels, line_idx
+
+
+def _parse_voc(task):
+    img_path, xml_path = task
+    if not os.path.exists(xml_path):
+        return read_image_size(img_path), False, np.zeros((0, 5)), np.zeros(0, np.int32)
+    try:
+        root = ET.parse(xml_path).getroot()
+    except Exception as e:
+        print(f"[WARN] Failed to parse XML: {xml_path}: {e}")
+        return read_image_size(img_path), False, np.zeros((0, 5)), np.zeros(0, np.int32)
+    size = read_image_size(img_path) or voc_size(root)
+    if size is None:
+        return None, True, np.zeros((0, 5)), np.zeros(0, np.int32)
+    boxes = voc_root_to_boxes(root, size[1], size[0], xml_path, verbose=False)
+    rows = np.array([b[:5] for b in boxes], dtype=np.float64).reshape(-1, 5)
+    return size, True, rows, np.array([b[5] for b in boxes], dtype=np.int32)
+
+
+def _write_columns(path, columns, meta):
+    """Writes the columns into path + '.tmp' and swaps it in, so readers never see half an index."""
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, array in columns.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), array)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    old_path = path + ".old"
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def build_index(tasks, parse, path, meta, num_workers=NUM_WORKERS):
+    """Parses (image path, annotation path) tasks with parse() and writes the index to path."""
+    if num_workers > 1 and len(tasks) > 1:
+        chunksize = max(1, len(tasks) // (num_workers * 8))
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(parse, tasks, chunksize=chunksize))
+    else:
+        results = [parse(t) for t in tasks]
+
+    names, widths, heights, labelled, labels, lines = [], [], [], [], [], []
+    for (img_path, _), (size, has_labels, rows, line_idx) in zip(tasks, results):
+        if size is None:
+            print(f"[WARN] Image not found or unreadable: {img_path}")
+            continue
+        names.append(os.path.basename(img_path))
+        heights.append(size[0])
+        widths.append(size[1])
+        labelled.append(has_labels)
+        labels.append(rows)
+        lines.append(line_idx)
+
+    counts = np.array([len(r) for r in labels], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    boxes = np.concatenate(labels) if labels else np.zeros((0, 5))
+    columns = {
+        "images": np.array(names, dtype=str) if names else np.zeros(0, dtype="<U1"),
+        "width": np.array(widths, dtype=np.int32),
+        "height": np.array(heights, dtype=np.int32),
+        "labelled": np.array(labelled, dtype=bool),
+        "offsets": offsets,
+        "image": np.repeat(np.arange(len(names), dtype=np.int32), counts),
+        "cls": boxes[:, 0].astype(np.int16),
+        "line": np.concatenate(lines).astype(np.int32) if lines else np.zeros(0, np.int32),
+    }
+    for i, name in enumerate(COLUMNS):
+        columns[name] = np.ascontiguousarray(boxes[:, i + 1])
+    _write_columns(path, columns, meta)
+    print(f"[OK] Index {path}: {len(names)} images, {len(boxes)} boxes")
+    return path
+
+
+def _image_files(img_dir):
+    return sorted(f for f in os.listdir(img_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def yolo_sources(img_dir, label_dir):
+    tasks = [(os.path.join(img_dir, f), os.path.join(label_dir, os.path.splitext(f)[0] + ".txt"))
+             for f in _image_files(img_dir)]
+    meta = {"format": "yolo", "images": img_dir, "labels": label_dir,
+            "signature": source_signature([p for t in tasks for p in t])}
+    return tasks, meta
+
+
+def voc_sources(voc_dir):
+    tasks = [(os.path.join(voc_dir, f), os.path.join(voc_dir, os.path.splitext(f)[0] + ".xml"))
+             for f in _image_files(voc_dir)]
+    meta = {"format": "voc", "images": voc_dir, "labels": voc_dir, "classes": CLASSES,
+            "signature": source_signature([p for t in tasks for p in t])}
+    return tasks, meta
+
+
+def _open_or_build(path, tasks, meta, parse, num_workers):
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path) as f:
+                if json.load(f) == meta:
+                    return AnnotationIndex(path)
+        except (OSError, ValueError):
+            pass
+    build_index(tasks, parse, path, meta, num_workers)
+    return AnnotationIndex(path)
+
+
+def open_yolo_index(img_dir, label_dir, path=None, num_workers=NUM_WORKERS):
+    """Opens the index of a YOLO images/labels pair, rebuilding it only if a source file changed."""
+    tasks, meta = yolo_sources(img_dir, label_dir)
+    return _open_or_build(path or index_path(label_dir), tasks, meta, _parse_yolo, num_workers)
+
+
+def open_voc_index(voc_dir=VOC_DIR, path=None, num_workers=NUM_WORKERS):
+    """Opens the index of a folder of image + VOC XML pairs, rebuilding it only if a source file changed."""
+    tasks, meta = voc_sources(voc_dir)
+    return _open_or_build(path or index_path(voc_dir), tasks, meta, _parse_voc, num_workers)
+
+
+class AnnotationIndex:
+    def __init__(self, path, mmap_mode="r"):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+        self.images = load("images")
+        self.width = load("width")
+        self.height = load("height")
+        self.labelled = load("labelled")
+        self.offsets = load("offsets")
+        self.image = load("image")
+        self.cls = load("cls")
+        self.line = load("line")
+        self.xc, self.yc, self.w, self.h = (load(name) for name in COLUMNS)
+        self._ids = None
+
+    def __len__(self):
+        return len(self.images)
+
+    @property
+    def num_boxes(self):
+        return len(self.cls)
+
+    def image_id(self, name):
+        """Id of an image by file name (with or without extension), or None."""
+        if self._ids is None:
+            self._ids = {}
+            for i, fname in enumerate(self.images):
+                self._ids[str(fname)] = i
+                self._ids.setdefault(os.path.splitext(str(fname))[0], i)
+        return self._ids.get(name)
+
+    def boxes(self, image_id):
+        """(k, 5) float64 class, xc, yc, w, h of one image - the array read_yolo_labels returns."""
+        s = slice(int(self.offsets[image_id]), int(self.offsets[image_id + 1]))
+        out = np.empty((s.stop - s.start, 5), dtype=np.float64)
+        out[:, 0] = self.cls[s]
+        for i, column in enumerate((self.xc, self.yc, self.w, self.h)):
+            out[:, i + 1] = column[s]
+        return out
+
+    def labels(self, image_id):
+        """(labels, line_indices), drop-in for crops.read_yolo_labels."""
+        s = slice(int(self.offsets[image_id]), int(self.offsets[image_id + 1]))
+        return self.boxes(image_id), np.array(self.line[s], dtype=np.int32)
+
+    def box_sizes(self, pixels=True):
+        """(m, 2) box width/height, in source pixels or normalised."""
+        w, h = np.asarray(self.w), np.asarray(self.h)
+        if pixels:
+            w = w * self.width[self.image]
+            h = h * self.height[self.image]
+        return np.stack([w, h], axis=1)
+
+    def class_counts(self, nc=len(CLASSES)):
+        return np.bincount(self.cls, minlength=nc)[:nc]
+
+    def images_per_class(self, nc=len(CLASSES)):
+        pairs = np.unique(self.image.astype(np.int64) * nc + self.cls)
+        return np.bincount(pairs % nc, minlength=nc)[:nc]
+
+    def boxes_per_image(self):
+        return np.diff(self.offsets)
+
+    def size_histogram(self, bins=16, pixels=True, nc=len(CLASSES)):
+        """Per-class histogram of sqrt(box area). Returns (counts (nc, bins), edges)."""
+        sizes = self.box_sizes(pixels)
+        side = np.sqrt(sizes[:, 0] * sizes[:, 1])
+        edges = np.histogram_bin_edges(side, bins=bins)
+        counts = np.zeros((nc, len(edges) - 1), dtype=np.int64)
+        for c in range(nc):
+            counts[c] = np.histogram(side[self.cls == c], bins=edges)[0]
+        return counts, edges
+
+
+def print_stats(index, bins=8):
+    print(f"[INFO] {index.path}: {len(index)} images ({int(np.sum(index.labelled))} labelled), {index.num_boxes} boxes")
+    counts, per_image = index.class_counts(), index.images_per_class()
+    for c, name in enumerate(CLASSES):
+        print(f"  {name:<13} {int(counts[c]):>7} boxes in {int(per_image[c]):>5} images")
+    if index.num_boxes:
+        bpi = index.boxes_per_image()
+        print(f"  boxes/image: mean {bpi.mean():.1f}, max {int(bpi.max())}")
+        hist, edges = index.size_histogram(bins)
+        print("  sqrt(area) px  " + " ".join(f"{e:>7.1f}" for e in edges[:-1]))
+        for c, name in enumerate(CLASSES):
+            if counts[c]:
+                print(f"  {name:<13}  " + " ".join(f"{n:>7}" for n in hist[c]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build (if stale) and summarise a columnar annotation index.")
+    parser.add_argument("--voc", default=None, help="folder of image + VOC XML pairs")
+    parser.add_argument("--yolo", nargs=2, metavar=("IMG_DIR", "LABEL_DIR"), default=None)
+    parser.add_argument("--out", default=None, help="index directory (default: <source>" + INDEX_SUFFIX + ")")
+    parser.add_argument("--bins", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS)
+    args = parser.parse_args()
+
+    if args.yolo:
+        index = open_yolo_index(args.yolo[0], args.yolo[1], args.out, args.workers)
+    else:
+        index = open_voc_index(args.voc or VOC_DIR, args.out, args.workers)
+    print_stats(index, args.bins)
@@ -0,0 +1,148 @@
+import os
+import random
+import argparse
+
+import cv2
+import numpy as np
+
+from crops import iter_shards, read_yolo_labels
+from magic import adjust_brightness, rotate_bbox_yolo
+
+"""
+Lazy, seeded version of magic.py.
+
+Instead of writing _orig/_rot90/_rot180/_rot270(_dark) copies next to the crops,
+augmented batches are generated on the fly from the source crops (packed shards
+from 120px.py, or loose images/ + labels/ folders). Rotations are np.rot90 views
+and darkening is a uint8 lookup table, so the only copy made is the one into the
+batch buffer. The same seed always yields the same stream.
+
+Batches are (images, labels): images is B x H x W x 3 uint8 (BGR) and labels is
+an L x 6 float32 array of (index in batch, class, xc, yc, w, h).
+"""
+
+base_dir = "sticky_dataset/120px"
+angles = [0, 90, 180, 270]  # 0 = original crop
+DARK_PROB = 0.5
+MAX_DARK = 0.2
+BATCH_SIZE = 256
+SEED = 0
+
+
+class CropSource:
+    """Random access to the source crops of one split (shards first, loose files otherwise)."""
+
+    def __init__(self, split_dir):
+        self.images = []
+        self.labels = []
+        shard_dir = os.path.join(split_dir, "shards")
+        if os.path.isdir(shard_dir):
+            for _, images, labels, _ in iter_shards(shard_dir):
+                for i in range(len(images)):
+                    self.images.append((images, i))
+                    self.labels.append(labels[labels[:, 0] == i, 1:])
+        else:
+            img_dir = os.path.join(split_dir, "images")
+            lbl_dir = os.path.join(split_dir, "labels")
+            for fname in sorted(os.listdir(img_dir)):
+                if not fname.lower().endswith(('.jpg', '.jpeg', '.png')):
+                    continue
+                lbl_path = os.path.join(lbl_dir, os.path.splitext(fname)[0] + ".txt")
+                if not os.path.exists(lbl_path):
+                    continue
+                self.images.append((None, os.path.join(img_dir, fname)))
+                self.labels.append(read_yolo_labels(lbl_path, verbose=False)[0])
+
+    def __len__(self):
+        return len(self.images)
+
+    def image(self, i):
+        array, key = self.images[i]
+        if array is None:
+            return cv2.imread(key)
+        return array[key]
+
+
+def rotate_view(img, angle):
+    # Zero-copy view, counterclockwise like rotate_bbox_yolo
+    return np.rot90(img, k=angle // 90)
+
+
+def rotate_labels(labels, angle):
+    out = np.empty_like(labels)
+    out[:, 0] = labels[:, 0]
+    rotated = rotate_bbox_yolo(labels[:, 1], labels[:, 2], labels[:, 3], labels[:, 4], angle)
+    for col, values in enumerate(rotated, start=1):
+        out[:, col] = values
+    np.clip(out[:, 1:], 0, 1, out=out[:, 1:])
+    return out
+
+
+def augment_stream(split_dir, batch_size=BATCH_SIZE, angles=angles, dark_prob=DARK_PROB,
+                   max_dark=MAX_DARK, seed=SEED, shuffle=True, epochs=1):
+    """Yields (images, labels) batches of every (crop, angle) pair, optionally darkened."""
+    source = CropSource(split_dir)
+    if len(source) == 0:
+        return
+    rng = random.Random(seed)
+    pairs = [(i, angle) for i in range(len(source)) for angle in angles]
+
+    for _ in range(epochs):
+        order = list(range(len(pairs)))
+        if shuffle:
+            rng.shuffle(order)
+        for start in range(0, len(order), batch_size):
+            chunk = order[start:start + batch_size]
+            batch = None
+            batch_labels = []
+            for b, p in enumerate(chunk):
+                i, angle = pairs[p]
+                view = rotate_view(source.image(i), angle)
+                if batch is None:
+                    batch = np.empty((len(chunk),) + view.shape, dtype=np.uint8)
+                if rng.random() < dark_prob:
+                    adjust_brightness(view, max_dark, rng=rng, out=batch[b])
+                else:
+                    batch[b] = view
+                labels = rotate_labels(source.labels[i], angle)
+                batch_labels.append(np.column_stack([np.full(len(labels), b), labels]))
+            labels = np.concatenate(batch_labels).astype(np.float32) if batch_labels else np.zeros((0, 6), np.float32)
+            yield batch, labels
+
+
+def export_loose(batches, out_dir, prefix="aug"):
+    """Writes a stream to YOLO images/ + labels/ folders (for tools that need files)."""
+    img_dir = os.path.join(out_dir, "images")
+    lbl_dir = os.path.join(out_dir, "labels")
+    os.makedirs(img_dir, exist_ok=True)
+    os.makedirs(lbl_dir, exist_ok=True)
+    n = 0
+    for images, labels in batches:
+        for b in range(len(images)):
+            name = f"{prefix}_{n:07d}"
+            cv2.imwrite(os.path.join(img_dir, name + ".jpg"), images[b])
+            rows = labels[labels[:, 0] == b, 1:]
+            with open(os.path.join(lbl_dir, name + ".txt"), "w") as f:
+                f.write("\n".join(f"{int(r[0])} {r[1]:.6f} {r[2]:.6f} {r[3]:.6f} {r[4]:.6f}" for r in rows) + "\n")
+            n += 1
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream augmented 120px crops without writing them to disk.")
+    parser.add_argument("--split", default="train")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--export", default=None, help="write the stream to this folder as YOLO files")
+    args = parser.parse_args()
+
+    stream = augment_stream(os.path.join(base_dir, args.split), batch_size=args.batch_size, seed=args.seed)
+    if args.export:
+        n = export_loose(stream, args.export)
+        print(f"✅ {n} augmented crops written to {args.export}")
+    else:
+        n_images = n_boxes = 0
+        for images, labels in stream:
+            n_images += len(images)
+            n_boxes += len(labels)
+        print(f"✅ Streamed {n_images} augmented crops ({n_boxes} boxes) from {args.split}")
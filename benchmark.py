@@ -0,0 +1,395 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import cv2
+import numpy as np
+
+"""
+Benchmark suite for the dataset preparation scripts and the exported 120px models.
+
+Prep stages: a synthetic trap dataset (yellow background, dark insects, VOC XML,
+a share of portrait images) of configurable count and resolution is generated in
+a temporary folder and every script is run on it in chain order, each in its own
+process. Per stage we record wall time, images/s, MB/s of input data and the peak
+RSS of the stage process.
+
+Models: every available export of 120px/weights (best.pt, best.onnx,
+best_saved_model, best_quantized.tflite) is timed on random 128x128 input for
+each batch size and thread count, each (format, threads) pair in a fresh process
+so thread settings do not leak between runtimes.
+
+Everything runs offline on CPU. Results go to a JSON file; --compare prints the
+ratio against an earlier result file.
+"""
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+WEIGHTS_DIR = os.path.join(REPO_DIR, "120px", "weights")
+MODEL_FORMATS = {
+    "pt": os.path.join(WEIGHTS_DIR, "best.pt"),
+    "onnx": os.path.join(WEIGHTS_DIR, "best.onnx"),
+    "saved_model": os.path.join(WEIGHTS_DIR, "best_saved_model"),
+    "tflite": os.path.join(WEIGHTS_DIR, "best_quantized.tflite"),
+}
+IMG_SIZE = 128
+
+# (stage name, script, folder whose images are the stage input)
+STAGES = [
+    ("fix_dataset", "fix_dataset.py", "sticky_dataset/stickytraps"),
+    ("xml_txt", "xml_txt.py", "sticky_dataset/stickytraps"),
+    ("16mpx", "16mpx.py", "sticky_dataset/stickytraps"),
+    ("5mpx (legacy)", "5mpx.py", "sticky_dataset/16mpx/images"),
+    ("pyramid", "pyramid.py", "sticky_dataset/16mpx/images"),
+    ("120px", "120px.py", "sticky_dataset/5mpx/images"),
+    ("magic", "magic.py", "sticky_dataset/120px"),
+    ("augment_stream", "augment_stream.py", "sticky_dataset/120px"),
+]
+
+ABBRS = ["WF", "MR", "NC"]
+
+
+def make_synthetic_dataset(root, count=20, width=4608, height=3456, insects=60, portrait_share=0.3, seed=0):
+    """Writes count synthetic trap photos + VOC XML to <root>/sticky_dataset/stickytraps."""
+    rng = np.random.default_rng(seed)
+    out_dir = os.path.join(root, "sticky_dataset", "stickytraps")
+    os.makedirs(out_dir, exist_ok=True)
+    for i in range(count):
+        img = np.empty((height, width, 3), dtype=np.uint8)
+        img[:] = (40, 215, 230)  # BGR trap yellow
+        noise = rng.integers(-12, 13, size=(height // 8, width // 8, 1), dtype=np.int16)
+        img = np.clip(img + cv2.resize(noise, (width, height))[..., None], 0, 255).astype(np.uint8)
+        objects = []
+        for _ in range(insects):
+            rx, ry = int(rng.integers(6, 30)), int(rng.integers(4, 20))
+            x, y = int(rng.integers(rx + 1, width - rx - 1)), int(rng.integers(ry + 1, height - ry - 1))
+            shade = int(rng.integers(10, 90))
+            cv2.ellipse(img, (x, y), (rx, ry), float(rng.integers(0, 180)), 0, 360, (shade, shade, shade), -1)
+            objects.append((ABBRS[int(rng.integers(0, len(ABBRS)))], x - rx, y - ry, x + rx, y + ry))
+
+        portrait = rng.random() < portrait_share
+        if portrait:
+            # Stored as portrait, like the misoriented photos of the real dataset
+            img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+        name = f"{1000 + i}"
+        cv2.imwrite(os.path.join(out_dir, name + ".jpg"), img, [cv2.IMWRITE_JPEG_QUALITY, 92])
+        xml = [f"<annotation><filename>{name}.jpg</filename>",
+               f"<size><width>{width}</width><height>{height}</height><depth>3</depth></size>"]
+        for abbr, x1, y1, x2, y2 in objects:
+            xml.append(f"<object><name>{abbr}</name><bndbox><xmin>{x1}</xmin><ymin>{y1}</ymin>"
+                       f"<xmax>{x2}</xmax><ymax>{y2}</ymax></bndbox></object>")
+        xml.append("</annotation>")
+        with open(os.path.join(out_dir, name + ".xml"), "w") as f:
+            f.write("\n".join(xml))
+    return out_dir
+
+
+def folder_stats(path):
+    """(number of images, total bytes) below path."""
+    n_images = n_bytes = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fname in filenames:
+            if fname.lower().endswith((".jpg", ".jpeg", ".png", ".npy")):
+                full = os.path.join(dirpath, fname)
+                n_bytes += os.path.getsize(full)
+                if fname.endswith("_images.npy"):
+                    n_images += np.load(full, mmap_mode="r").shape[0]
+                elif not fname.endswith(".npy"):
+                    n_images += 1
+    return n_images, n_bytes
+
+
+def run_process(cmd, cwd=None, poll_interval=0.02):
+    """
+    Runs cmd; returns (returncode, seconds, peak RSS in MB, output). The peak RSS is the
+    largest sum over the process and its workers, sampled with psutil; without psutil
+    it falls back to ru_maxrss, which Linux carries over from this (parent) process.
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES="", PYTHONPATH=REPO_DIR)
+    with tempfile.TemporaryFile() as out:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=out, stderr=subprocess.STDOUT)
+        peak = 0
+        if psutil is not None:
+            try:
+                ps = psutil.Process(proc.pid)
+                while proc.poll() is None:
+                    rss = 0
+                    for p in [ps] + ps.children(recursive=True):
+                        try:
+                            rss += p.memory_info().rss
+                        except psutil.Error:
+                            pass
+                    peak = max(peak, rss)
+                    time.sleep(poll_interval)
+            except psutil.Error:
+                pass
+        _, status, rusage = os.wait4(proc.pid, 0) if proc.returncode is None else (None, None, None)
+        if status is not None:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+        seconds = time.perf_counter() - start
+        if psutil is None and rusage is not None:
+            peak = rusage.ru_maxrss * 1024  # KB on Linux
+        out.seek(0)
+        output = out.read().decode(errors="replace")
+    return proc.returncode, seconds, peak / 1024 ** 2, output
+
+
+def bench_stages(root):
+    results = []
+    for name, script, input_dir in STAGES:
+        input_path = os.path.join(root, input_dir)
+        if not os.path.exists(input_path):
+            results.append({"stage": name, "skipped": f"missing input {input_dir}"})
+            continue
+        if script == "magic.py" and not any(
+                os.path.isdir(os.path.join(input_path, s, "images")) for s in ("train", "val")):
+            results.append({"stage": name, "skipped": "no loose crops (120px.py EXPORT_LOOSE is off)"})
+            continue
+        n_images, n_bytes = folder_stats(input_path)
+        code, seconds, rss_mb, output = run_process([sys.executable, os.path.join(REPO_DIR, script)], cwd=root)
+        entry = {
+            "stage": name,
+            "returncode": code,
+            "seconds": round(seconds, 4),
+            "images": n_images,
+            "images_per_second": round(n_images / seconds, 3) if seconds > 0 else None,
+            "mb_per_second": round(n_bytes / 1e6 / seconds, 3) if seconds > 0 else None,
+            "peak_rss_mb": round(rss_mb, 1),
+        }
+        if code != 0:
+            entry["error"] = output.strip().splitlines()[-1] if output.strip() else "failed"
+        results.append(entry)
+        print(f"[STAGE] {name:16s} {seconds:8.2f}s  {entry['images_per_second'] or 0:9.2f} img/s  "
+              f"{entry['mb_per_second'] or 0:8.2f} MB/s  {rss_mb:8.1f} MB peak" + ("" if code == 0 else "  FAILED"))
+    return results
+
+
+# ------------------------------------------------------------------ models
+
+def load_runner(fmt, path, threads):
+    """Returns (run(batch_uint8_nhwc), fixed_batch or None)."""
+    if fmt == "onnx":
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        inp = session.get_inputs()[0]
+        fixed = inp.shape[0] if isinstance(inp.shape[0], int) else None
+
+        def run(x):
+            x = np.ascontiguousarray(x.transpose(0, 3, 1, 2), dtype=np.float32) / 255.0
+            return session.run(None, {inp.name: x})
+        return run, fixed
+
+    if fmt == "tflite":
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+        interpreter = Interpreter(model_path=path, num_threads=threads)
+        interpreter.allocate_tensors()
+        inp = interpreter.get_input_details()[0]
+        state = {"batch": int(inp["shape"][0])}
+
+        def run(x):
+            if x.shape[0] != state["batch"]:
+                interpreter.resize_tensor_input(inp["index"], [x.shape[0], IMG_SIZE, IMG_SIZE, 3])
+                interpreter.allocate_tensors()
+                state["batch"] = x.shape[0]
+            interpreter.set_tensor(inp["index"], x.astype(inp["dtype"]))
+            interpreter.invoke()
+            return [interpreter.get_tensor(o["index"]) for o in interpreter.get_output_details()]
+        return run, None
+
+    if fmt == "saved_model":
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+        model = tf.saved_model.load(path)
+        fn = model.signatures["serving_default"]
+        spec = list(fn.structured_input_signature[1].values())[0]
+        fixed = spec.shape[0]
+
+        def run(x):
+            return fn(tf.constant(x.astype(np.float32) / 255.0))
+        return run, fixed
+
+    if fmt == "pt":
+        import torch
+        from ultralytics import YOLO
+        torch.set_num_threads(threads)
+        model = YOLO(path).model.float().eval()
+
+        def run(x):
+            with torch.no_grad():
+                t = torch.from_numpy(np.ascontiguousarray(x.transpose(0, 3, 1, 2))).float() / 255.0
+                return model(t)
+        return run, None
+
+    raise ValueError(fmt)
+
+
+def bench_model(fmt, path, threads, batch_sizes, repeats, warmup):
+    run, fixed_batch = load_runner(fmt, path, threads)
+    rng = np.random.default_rng(0)
+    results = []
+    for bs in batch_sizes:
+        if fixed_batch is not None and bs != fixed_batch:
+            results.append({"format": fmt, "threads": threads, "batch": bs, "skipped": f"model has fixed batch {fixed_batch}"})
+            continue
+        x = rng.integers(0, 256, size=(bs, IMG_SIZE, IMG_SIZE, 3), dtype=np.uint8)
+        try:
+            for _ in range(warmup):
+                run(x)
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                run(x)
+                times.append(time.perf_counter() - start)
+        except Exception as e:  # runtime refused this batch size
+            results.append({"format": fmt, "threads": threads, "batch": bs, "skipped": str(e).splitlines()[0][:200]})
+            continue
+        times = np.array(times)
+        results.append({
+            "format": fmt, "threads": threads, "batch": bs,
+            "latency_ms_p50": round(float(np.median(times)) * 1000, 3),
+            "latency_ms_p90": round(float(np.percentile(times, 90)) * 1000, 3),
+            "images_per_second": round(bs / float(np.median(times)), 2),
+        })
+    return results
+
+
+def bench_models(formats, threads_list, batch_sizes, repeats, warmup):
+    results = []
+    for fmt in formats:
+        path = MODEL_FORMATS[fmt]
+        if not os.path.exists(path):
+            results.append({"format": fmt, "skipped": f"not found: {os.path.relpath(path, REPO_DIR)}"})
+            print(f"[MODEL] {fmt:12s} skipped (not found)")
+            continue
+        for threads in threads_list:
+            cmd = [sys.executable, os.path.abspath(__file__), "--model-worker", fmt, "--threads", str(threads),
+                   "--batch-sizes", ",".join(map(str, batch_sizes)), "--repeats", str(repeats), "--warmup", str(warmup)]
+            code, _, rss_mb, output = run_process(cmd)
+            lines = [l for l in output.splitlines() if l.startswith("{")]
+            if code != 0 or not lines:
+                reason = output.strip().splitlines()[-1] if output.strip() else "failed"
+                results.append({"format": fmt, "threads": threads, "skipped": reason[:200]})
+                print(f"[MODEL] {fmt:12s} threads={threads:<3d} skipped ({reason[:80]})")
+                continue
+            for entry in json.loads(lines[-1])["results"]:
+                entry["peak_rss_mb"] = round(rss_mb, 1)
+                results.append(entry)
+                if "skipped" in entry:
+                    continue
+                print(f"[MODEL] {fmt:12s} threads={threads:<3d} batch={entry['batch']:<4d} "
+                      f"{entry['latency_ms_p50']:9.2f} ms  {entry['images_per_second']:9.1f} img/s")
+    return results
+
+
+# ------------------------------------------------------------------ compare
+
+def result_key(entry):
+    if "stage" in entry:
+        return "stage:" + entry["stage"]
+    return f"model:{entry['format']}:t{entry.get('threads')}:b{entry.get('batch')}"
+
+
+def compare(old_path, new):
+    with open(old_path) as f:
+        old = json.load(f)
+    old_entries = {result_key(e): e for e in old["stages"] + old["models"]}
+    print(f"\nComparison with {old_path} (commit {old.get('commit')}):")
+    for entry in new["stages"] + new["models"]:
+        prev = old_entries.get(result_key(entry))
+        if prev is None or "skipped" in entry or "skipped" in prev:
+            continue
+        metric = "seconds" if "stage" in entry else "latency_ms_p50"
+        if prev.get(metric):
+            ratio = entry[metric] / prev[metric]
+            flag = "  <-- slower" if ratio > 1.1 else ("  faster" if ratio < 0.9 else "")
+            print(f"  {result_key(entry):36s} {prev[metric]:10.3f} -> {entry[metric]:10.3f} ({ratio:5.2f}x){flag}")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_int_list(text):
+    return [int(v) for v in text.split(",") if v]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the prep scripts and the exported models (CPU, offline).")
+    parser.add_argument("--count", type=int, default=20, help="synthetic trap photos")
+    parser.add_argument("--width", type=int, default=4608)
+    parser.add_argument("--height", type=int, default=3456)
+    parser.add_argument("--insects", type=int, default=60, help="insects per photo")
+    parser.add_argument("--formats", default=",".join(MODEL_FORMATS))
+    parser.add_argument("--threads", default=f"1,{os.cpu_count() or 1}")
+    parser.add_argument("--batch-sizes", default="1,8,32,128")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--skip-stages", action="store_true")
+    parser.add_argument("--skip-models", action="store_true")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic dataset folder")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", default=None, help="earlier result file to compare against")
+    parser.add_argument("--model-worker", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.model_worker:
+        # Child process: one format, one thread count
+        results = bench_model(args.model_worker, MODEL_FORMATS[args.model_worker], int(args.threads),
+                              parse_int_list(args.batch_sizes), args.repeats, args.warmup)
+        print(json.dumps({"results": results}))
+        sys.exit(0)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(),
+                 "cpus": os.cpu_count(), "numpy": np.__version__, "opencv": cv2.__version__},
+        "config": {"count": args.count, "width": args.width, "height": args.height, "insects": args.insects},
+        "stages": [],
+        "models": [],
+    }
+
+    if not args.skip_stages:
+        root = tempfile.mkdtemp(prefix="sticky_bench_")
+        try:
+            print(f"Generating {args.count} synthetic {args.width}x{args.height} traps in {root} ...")
+            make_synthetic_dataset(root, args.count, args.width, args.height, args.insects)
+            report["stages"] = bench_stages(root)
+        finally:
+            if args.keep:
+                print(f"Synthetic dataset kept in {root}")
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+
+    if not args.skip_models:
+        report["models"] = bench_models([f for f in args.formats.split(",") if f], parse_int_list(args.threads),
+                                        parse_int_list(args.batch_sizes), args.repeats, args.warmup)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✅ Results saved to {args.output}")
+
+    if args.compare:
+        compare(args.compare, report)
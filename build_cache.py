@@ -0,0 +1,153 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+"""
+Content-hash build cache shared by the dataset preparation scripts.
+
+Every stage records, per work item (usually one source image), the content hash
+of each input, a hash of the stage parameters, and the hash of each output it
+wrote. On the next run an item is redone only if an input changed, a parameter
+changed or an output went missing/was modified; items whose source disappeared
+are evicted together with the files they produced.
+
+File hashes are memoised by (size, mtime_ns), so unchanged 16 MP images are not
+re-read on every run - only new or touched files are hashed.
+"""
+
+CACHE_PATH = "sticky_dataset/.build_cache.json"
+
+# Worker processes used to hash new files (1 = serial)
+NUM_WORKERS = os.cpu_count() or 1
+
+CHUNK_SIZE = 1 << 20
+
+
+def hash_file(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def params_hash(params):
+    blob = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(blob, digest_size=16).hexdigest()
+
+
+class BuildCache:
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.stages = {}
+        self.hashes = {}  # path -> [size, mtime_ns, hash]
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self.stages = data.get("stages", {})
+                self.hashes = data.get("hashes", {})
+            except (OSError, ValueError):
+                print(f"[WARN] Ignoring unreadable build cache: {path}")
+
+    def _stat_key(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def file_hash(self, path):
+        """Content hash of path (None if missing), reusing the memo while size/mtime match."""
+        stat_key = self._stat_key(path)
+        if stat_key is None:
+            self.hashes.pop(path, None)
+            return None
+        memo = self.hashes.get(path)
+        if memo is not None and memo[:2] == stat_key:
+            return memo[2]
+        digest = hash_file(path)
+        self.hashes[path] = stat_key + [digest]
+        return digest
+
+    def prime(self, paths, num_workers=NUM_WORKERS):
+        """Hashes every new/modified file in paths on a process pool."""
+        todo = []
+        for path in paths:
+            stat_key = self._stat_key(path)
+            memo = self.hashes.get(path)
+            if stat_key is not None and (memo is None or memo[:2] != stat_key):
+                todo.append((path, stat_key))
+        if num_workers > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+                digests = list(pool.map(hash_file, [p for p, _ in todo]))
+        else:
+            digests = [hash_file(p) for p, _ in todo]
+        for (path, stat_key), digest in zip(todo, digests):
+            self.hashes[path] = stat_key + [digest]
+
+    def is_fresh(self, stage, key, inputs, params):
+        entry = self.stages.get(stage, {}).get(key)
+        if entry is None or entry["params"] != params_hash(params):
+            return False
+        if sorted(entry["inputs"]) != sorted(inputs):
+            return False
+        for path, digest in entry["inputs"].items():
+            if self.file_hash(path) != digest:
+                return False
+        for path, digest in entry["outputs"].items():
+            if self.file_hash(path) != digest:
+                return False
+        return True
+
+    def record(self, stage, key, inputs, params, outputs):
+        """Stores the current state of key; outputs it produced before but not now are deleted."""
+        stage_entries = self.stages.setdefault(stage, {})
+        old = stage_entries.get(key)
+        if old is not None:
+            for path in set(old["outputs"]) - set(outputs) - set(inputs):
+                self._remove(path)
+        stage_entries[key] = {
+            "params": params_hash(params),
+            "inputs": {p: self.file_hash(p) for p in inputs},
+            "outputs": {p: self.file_hash(p) for p in outputs if os.path.exists(p)},
+        }
+
+    def forget(self, stage, key):
+        self.stages.get(stage, {}).pop(key, None)
+
+    def outputs(self, stage):
+        """Every output path currently recorded for stage."""
+        paths = set()
+        for entry in self.stages.get(stage, {}).values():
+            paths.update(entry["outputs"])
+        return paths
+
+    def evict(self, stage, live_keys):
+        """Drops entries whose key is not in live_keys and deletes their outputs. Returns the removed paths."""
+        live_keys = set(live_keys)
+        stage_entries = self.stages.get(stage, {})
+        removed = []
+        for key in [k for k in stage_entries if k not in live_keys]:
+            entry = stage_entries.pop(key)
+            for path in set(entry["outputs"]) - set(entry["inputs"]):
+                if self._remove(path):
+                    removed.append(path)
+        return removed
+
+    def _remove(self, path):
+        self.hashes.pop(path, None)
+        if os.path.exists(path):
+            os.remove(path)
+            return True
+        return False
+
+    def save(self):
+        # Forget memoised hashes of files that are gone
+        self.hashes = {p: v for p, v in self.hashes.items() if os.path.exists(p)}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"stages": self.stages, "hashes": self.hashes}, f, sort_keys=True)
+        os.replace(tmp_path, self.path)
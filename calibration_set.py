@@ -0,0 +1,148 @@
+import os
+import re
+import argparse
+import hashlib
+
+import cv2
+import numpy as np
+
+from crops import iter_shards, read_yolo_labels
+
+"""
+Builds the representative (calibration) dataset used by convert_to_tflite.py.
+
+Instead of the first 100 files of os.listdir - which after magic.py can be mostly
+rotated copies of a few Whitefly crops - this picks a class-balanced, deduplicated,
+seeded sample of the 120px train crops: augmented copies (_orig, _rotNN, _dark)
+collapse onto their source crop, identical pixels are dropped, and every class
+gets the same share. The result is written once as a float32 N x 128 x 128 x 3
+RGB array in [0, 1] (the layout of calibration_image_sample_data_20x128x128x3_float32.npy)
+that the converter memory-maps and streams from.
+"""
+
+TRAIN_DIR = "sticky_dataset/120px/train"
+OUTPUT_DIR = "120px/weights"
+IMG_SIZE = 128
+CALIBRATION_SIZE = 240
+SEED = 0
+
+# _orig / _rot90 / _rot180_dark ... suffixes written by magic.py
+AUGMENT_SUFFIX = re.compile(r"_(orig|rot\d+(_dark)?)$")
+
+
+def calibration_path(n, output_dir=OUTPUT_DIR, img_size=IMG_SIZE):
+    return os.path.join(output_dir, f"calibration_{n}x{img_size}x{img_size}x3_float32.npy")
+
+
+def centre_class(labels):
+    """Class of the box closest to the crop centre (the box the crop was cut around)."""
+    if len(labels) == 0:
+        return None
+    d = (labels[:, 1] - 0.5) ** 2 + (labels[:, 2] - 0.5) ** 2
+    return int(labels[int(d.argmin()), 0])
+
+
+def list_candidates(train_dir=TRAIN_DIR):
+    """Returns a list of (class, loader) with one entry per distinct source crop."""
+    candidates = []
+    shard_dir = os.path.join(train_dir, "shards")
+    if os.path.isdir(shard_dir):
+        for _, images, labels, _ in iter_shards(shard_dir):
+            for i in range(len(images)):
+                cls = centre_class(labels[labels[:, 0] == i, 1:])
+                if cls is not None:
+                    candidates.append((cls, (images, i)))
+        return candidates
+
+    img_dir = os.path.join(train_dir, "images")
+    lbl_dir = os.path.join(train_dir, "labels")
+    seen = set()
+    for fname in sorted(os.listdir(img_dir)):
+        stem, ext = os.path.splitext(fname)
+        if ext.lower() not in (".jpg", ".jpeg", ".png"):
+            continue
+        base = AUGMENT_SUFFIX.sub("", stem)
+        if base in seen:
+            continue
+        # Prefer the un-augmented crop, fall back to whatever copy exists
+        for candidate in [base + ext, fname]:
+            lbl_path = os.path.join(lbl_dir, os.path.splitext(candidate)[0] + ".txt")
+            if os.path.exists(os.path.join(img_dir, candidate)) and os.path.exists(lbl_path):
+                cls = centre_class(read_yolo_labels(lbl_path, verbose=False)[0])
+                if cls is not None:
+                    seen.add(base)
+                    candidates.append((cls, os.path.join(img_dir, candidate)))
+                break
+    return candidates
+
+
+def candidate_files(train_dir=TRAIN_DIR):
+    """Every file list_candidates reads - the inputs the calibration set depends on."""
+    shard_dir = os.path.join(train_dir, "shards")
+    dirs = [shard_dir] if os.path.isdir(shard_dir) else [os.path.join(train_dir, "images"), os.path.join(train_dir, "labels")]
+    return [os.path.join(d, f) for d in dirs if os.path.isdir(d) for f in sorted(os.listdir(d))
+            if os.path.isfile(os.path.join(d, f))]
+
+
+def load_candidate(source):
+    if isinstance(source, tuple):
+        images, i = source
+        return np.asarray(images[i])
+    return cv2.imread(source)
+
+
+def to_calibration_sample(img_bgr, img_size=IMG_SIZE):
+    img = cv2.resize(img_bgr, (img_size, img_size), interpolation=cv2.INTER_LINEAR)
+    return img[..., ::-1].astype(np.float32) / 255.0
+
+
+def build_calibration_set(train_dir=TRAIN_DIR, n=CALIBRATION_SIZE, output_path=None, seed=SEED, img_size=IMG_SIZE):
+    """Samples n class-balanced, distinct crops and writes them as one .npy. Returns the path."""
+    rng = np.random.default_rng(seed)
+    candidates = list_candidates(train_dir)
+    if not candidates:
+        raise FileNotFoundError(f"No labelled crops found in {train_dir}")
+
+    by_class = {}
+    for cls, source in candidates:
+        by_class.setdefault(cls, []).append(source)
+    for sources in by_class.values():
+        rng.shuffle(sources)
+
+    # Round-robin over classes, so rare classes get the same share until they run out
+    samples, seen_hashes = [], set()
+    queues = [list(by_class[c]) for c in sorted(by_class)]
+    while len(samples) < n and any(queues):
+        for queue in queues:
+            if not queue or len(samples) >= n:
+                continue
+            img = load_candidate(queue.pop())
+            if img is None:
+                continue
+            digest = hashlib.blake2b(np.ascontiguousarray(img).tobytes(), digest_size=16).digest()
+            if digest in seen_hashes:
+                continue
+            seen_hashes.add(digest)
+            samples.append(to_calibration_sample(img, img_size))
+
+    data = np.stack(samples)
+    output_path = output_path or calibration_path(len(data), img_size=img_size)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, data)
+    os.replace(tmp_path, output_path)
+    counts = {c: len(by_class[c]) for c in sorted(by_class)}
+    print(f"[OK] {len(data)} calibration samples from {len(candidates)} distinct crops "
+          f"(per class available: {counts}) -> {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a class-balanced calibration set for int8 conversion.")
+    parser.add_argument("--train-dir", default=TRAIN_DIR)
+    parser.add_argument("--size", type=int, default=CALIBRATION_SIZE)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    build_calibration_set(args.train_dir, args.size, args.output, args.seed)
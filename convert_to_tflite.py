@@ -1,51 +1,103 @@
-import tensorflow as tf
-import numpy as np
 import os
-from PIL import Image
+import shutil
+import hashlib
+import numpy as np
+
+from build_cache import BuildCache, hash_file
+from calibration_set import build_calibration_set, calibration_path, candidate_files, CALIBRATION_SIZE, SEED
 
 # Caminho para o modelo exportado
 saved_model_dir = "120px/weights/best_saved_model"
 
-# Caminho para algumas imagens de exemplo para calibração
-sample_images_dir = "sticky_dataset/120px/train/images"  # Altere se necessário
+# Crops de treino usados para montar o conjunto de calibração (ver calibration_set.py)
+sample_images_dir = "sticky_dataset/120px/train"  # Altere se necessário
+
+# Conjunto de calibração balanceado por classe, lido via mmap; refeito quando os crops de treino mudam
+calibration_file = calibration_path(CALIBRATION_SIZE)
 
 # Tamanho de entrada (128x128 para seu modelo)
 IMG_SIZE = 128
 
+# Conversões já feitas, indexadas pelo hash do SavedModel + calibração
+cache_dir = "120px/weights/.tflite_cache"
+CACHE_KEEP = 5  # conversões mantidas no cache (as usadas mais recentemente)
+
+output_path = "120px/weights/best_quantized.tflite"
+
 # Gera um dataset representativo para calibrar o modelo
 def representative_dataset_gen():
-    image_files = [os.path.join(sample_images_dir, f) for f in os.listdir(sample_images_dir) if f.endswith(".jpg")]
-    for img_path in image_files[:100]:
-        img = Image.open(img_path).resize((IMG_SIZE, IMG_SIZE))
-        img = np.array(img)
+    data = np.load(calibration_file, mmap_mode="r")  # shape: (N, 128, 128, 3), float32 em [0, 1]
+    for i in range(len(data)):
+        yield [np.array(data[i:i + 1])]    # shape: (1, 128, 128, 3)
 
-        if img.ndim == 2:  # grayscale
-            img = np.stack([img] * 3, axis=-1)
-        elif img.shape[2] == 4:  # RGBA
-            img = img[:, :, :3]
+def ensure_calibration_set():
+    """Rebuilds the calibration .npy when the train crops, the sampling parameters or the file itself changed."""
+    cache = BuildCache()
+    inputs = candidate_files(sample_images_dir)
+    params = {"n": CALIBRATION_SIZE, "seed": SEED, "img_size": IMG_SIZE}
+    cache.prime(inputs)
+    if cache.is_fresh("calibration", calibration_file, inputs, params):
+        return
+    build_calibration_set(sample_images_dir, CALIBRATION_SIZE, calibration_file, SEED, IMG_SIZE)
+    cache.record("calibration", calibration_file, inputs, params, [calibration_file])
+    cache.save()
 
-        img = img.astype(np.float32) / 255.0  # ⚠️ conversão correta!
-        img = np.expand_dims(img, axis=0)    # shape: (1, 128, 128, 3)
-        yield [img]
+def prune_cache(keep=CACHE_KEEP):
+    """Deletes all but the keep most recently used conversions."""
+    entries = sorted((os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith(".tflite")),
+                     key=os.path.getmtime, reverse=True)
+    for path in entries[keep:]:
+        os.remove(path)
+    return len(entries[keep:])
 
-# Cria o conversor
-converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
-converter.optimizations = [tf.lite.Optimize.DEFAULT]
+def conversion_key():
+    h = hashlib.blake2b(digest_size=16)
+    for root, dirs, files in os.walk(saved_model_dir):
+        dirs.sort()
+        for fname in sorted(files):
+            path = os.path.join(root, fname)
+            h.update(os.path.relpath(path, saved_model_dir).encode())
+            h.update(hash_file(path).encode())
+    h.update(hash_file(calibration_file).encode())
+    h.update(b"int8-builtins-uint8-io")  # muda se as opções do conversor mudarem
+    return h.hexdigest()
 
-# ⚠️ Quantização total exige representative_dataset
-converter.representative_dataset = representative_dataset_gen
+def convert():
+    import tensorflow as tf
 
-# Tipos para ESP32 (quantização total)
-converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
-converter.inference_input_type = tf.uint8
-converter.inference_output_type = tf.uint8
+    # Cria o conversor
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
 
-# Converte
-tflite_model = converter.convert()
+    # ⚠️ Quantização total exige representative_dataset
+    converter.representative_dataset = representative_dataset_gen
 
-# Salva
-output_path = "120px/weights/best_quantized.tflite"
-with open(output_path, "wb") as f:
-    f.write(tflite_model)
+    # Tipos para ESP32 (quantização total)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.uint8
+    converter.inference_output_type = tf.uint8
+
+    # Converte
+    return converter.convert()
+
+if __name__ == "__main__":
+    ensure_calibration_set()
+
+    key = conversion_key()
+    cached_path = os.path.join(cache_dir, key + ".tflite")
+    if os.path.exists(cached_path):
+        os.utime(cached_path)  # marca como usado recentemente para prune_cache
+        shutil.copyfile(cached_path, output_path)
+        print(f"✅ Modelo TFLite quantizado (cache {key}) salvo em {output_path}")
+    else:
+        tflite_model = convert()
 
-print(f"✅ Modelo TFLite quantizado salvo em {output_path}")
+        # Salva
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cached_path, "wb") as f:
+            f.write(tflite_model)
+        shutil.copyfile(cached_path, output_path)
+        print(f"✅ Modelo TFLite quantizado salvo em {output_path}")
+    removed = prune_cache()
+    if removed:
+        print(f"[INFO] {removed} conversões antigas removidas de {cache_dir}")
@@ -0,0 +1,217 @@
+import os
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from build_cache import hash_file
+from image_header import read_image_size
+from pyramid import imread_reduced, target_size
+from tiled_inference import (
+    TiledDetector, MODEL_PATH, CLASS_NAMES, TILE_SIZE, OVERLAP, BATCH_SIZE, TARGET_PIXELS,
+    resize_to_pixels, tile_grid,
+)
+from xml_txt import CLASSES
+
+"""
+Season-level insect counts for a whole archive of trap photos.
+
+Walks a directory tree, decodes the photos on a process pool (reduced JPEG decode
+straight to the ~5 MP working scale, see pyramid.imread_reduced) while the main
+process runs tiled inference on the previous ones, and stores per-image, per-class
+counts in a SQLite file:
+
+    images(path, size, mtime_ns, width, height, tiles, detections, seconds, status, error, model)
+    counts(path, class, count)       class names from xml_txt.CLASSES
+
+Results are committed every CHECKPOINT_EVERY images. Re-running the same command
+skips every photo already counted with the same model (and unchanged on disk), so
+an interrupted run resumes where it stopped.
+"""
+
+DB_PATH = "counts.sqlite"
+DECODE_WORKERS = max(1, (os.cpu_count() or 2) // 2)   # the other half of the cores run ONNX Runtime
+INFER_THREADS = max(1, (os.cpu_count() or 2) - DECODE_WORKERS)
+PREFETCH = 2              # decoded images waiting per decode worker
+CHECKPOINT_EVERY = 25
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER, mtime_ns INTEGER,
+    width INTEGER, height INTEGER,
+    tiles INTEGER, detections INTEGER, seconds REAL,
+    status TEXT, error TEXT, model TEXT, processed_at REAL
+);
+CREATE TABLE IF NOT EXISTS counts (
+    path TEXT, class TEXT, count INTEGER,
+    PRIMARY KEY (path, class)
+);
+"""
+
+
+def list_images(root):
+    """Relative paths of every image under root, in a stable order."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if fname.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.relpath(os.path.join(dirpath, fname), root))
+    return paths
+
+
+def open_db(db_path):
+    db = sqlite3.connect(db_path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def pending_images(db, root, paths, model_id):
+    """Paths not yet counted with this model, or changed on disk since."""
+    done = {row[0]: row[1:] for row in db.execute("SELECT path, size, mtime_ns, model FROM images WHERE status = 'ok'")}
+    todo = []
+    for rel in paths:
+        try:
+            st = os.stat(os.path.join(root, rel))
+        except FileNotFoundError:
+            continue  # removed since the walk
+        if done.get(rel) != (st.st_size, st.st_mtime_ns, model_id):
+            todo.append(rel)
+    return todo
+
+
+def decode_image(task):
+    """
+    Worker: decodes one photo at the working scale. Returns (rel, work image, scale, (w, h),
+    (size, mtime_ns), error). The file is stat'ed before decoding, so a photo replaced
+    meanwhile is stored with the stat of the bytes that were counted and redone next run.
+    """
+    root, rel, target_pixels = task
+    path = os.path.join(root, rel)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return rel, None, 1.0, None, None, "file removed"
+    stat = (st.st_size, st.st_mtime_ns)
+    size = read_image_size(path)
+    if size is None:
+        return rel, None, 1.0, None, stat, "unreadable header"
+    h, w = size
+    tw, th = target_size(w, h, target_pixels) if target_pixels else (w, h)
+    img = imread_reduced(path, tw, th, size)
+    if img is None:
+        return rel, None, 1.0, (w, h), stat, "decode failed"
+    work, _ = resize_to_pixels(img, target_pixels)
+    return rel, work, work.shape[1] / w, (w, h), stat, None
+
+
+def count_detections(detector, work, tile_size, overlap):
+    h, w = work.shape[:2]
+    if h < tile_size or w < tile_size:
+        work = np.pad(work, ((0, max(0, tile_size - h)), (0, max(0, tile_size - w)), (0, 0)))
+    x1, y1 = tile_grid(work.shape[1], work.shape[0], tile_size, overlap)
+    _, _, classes = detector.detect_windows(work, x1, y1, tile_size)
+    return np.bincount(classes.astype(np.int64), minlength=len(CLASS_NAMES)), len(x1)
+
+
+def save_result(db, rel, model_id, stat, size, tiles, counts, seconds, error=None):
+    file_size, mtime_ns = stat if stat else (None, None)
+    w, h = size if size else (None, None)
+    status = "ok" if error is None else "error"
+    db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+               (rel, file_size, mtime_ns, w, h, tiles, int(counts.sum()) if counts is not None else None,
+                seconds, status, error, model_id, time.time()))
+    db.execute("DELETE FROM counts WHERE path = ?", (rel,))
+    if counts is not None:
+        # Model classes are a prefix of xml_txt.CLASSES; classes it cannot detect are stored as 0
+        per_class = {name: 0 for name in CLASSES}
+        for name, n in zip(CLASS_NAMES, counts):
+            per_class[name] = per_class.get(name, 0) + int(n)
+        db.executemany("INSERT INTO counts VALUES (?, ?, ?)", [(rel, name, n) for name, n in per_class.items()])
+
+
+def run(root, db_path=DB_PATH, model_path=MODEL_PATH, decode_workers=DECODE_WORKERS, threads=INFER_THREADS,
+        batch_size=BATCH_SIZE, tile_size=TILE_SIZE, overlap=OVERLAP, target_pixels=TARGET_PIXELS):
+    db = open_db(db_path)
+    model_id = hash_file(model_path)
+    paths = list_images(root)
+    todo = pending_images(db, root, paths, model_id)
+    print(f"[INFO] {len(paths)} images under {root}, {len(paths) - len(todo)} already counted, {len(todo)} to do")
+    if not todo:
+        return db
+
+    detector = TiledDetector(model_path, threads, batch_size)
+    tasks = iter([(root, rel, target_pixels) for rel in todo])
+    done = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=decode_workers) as pool:
+        # Keep the decode workers PREFETCH images ahead of the model
+        in_flight = set()
+        for task in tasks:
+            in_flight.add(pool.submit(decode_image, task))
+            if len(in_flight) >= decode_workers * PREFETCH:
+                break
+        try:
+            while in_flight:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = next(tasks, None)
+                    if task is not None:
+                        in_flight.add(pool.submit(decode_image, task))
+                    rel, work, scale, size, stat, error = future.result()
+                    t0 = time.perf_counter()
+                    if error is None:
+                        counts, tiles = count_detections(detector, work, tile_size, overlap)
+                        save_result(db, rel, model_id, stat, size, tiles, counts, time.perf_counter() - t0)
+                    else:
+                        print(f"[WARN] {rel}: {error}")
+                        save_result(db, rel, model_id, stat, size, 0, None, 0.0, error)
+                    done += 1
+                    if done % CHECKPOINT_EVERY == 0:
+                        db.commit()
+                        rate = done / (time.perf_counter() - start)
+                        print(f"[INFO] {done}/{len(todo)} images ({rate:.2f} img/s)")
+        except KeyboardInterrupt:
+            print(f"\n[WARN] Interrupted after {done} images - run again to resume")
+            for future in in_flight:
+                future.cancel()
+        finally:
+            db.commit()
+    elapsed = time.perf_counter() - start
+    print(f"[OK] {done} images counted in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.2f} img/s)")
+    return db
+
+
+def print_totals(db):
+    rows = db.execute("SELECT class, SUM(count), SUM(count > 0) FROM counts GROUP BY class").fetchall()
+    totals = {name: (n, images) for name, n, images in rows}
+    n_images = db.execute("SELECT COUNT(*) FROM images WHERE status = 'ok'").fetchone()[0]
+    print(f"\n✅ {n_images} images counted:")
+    for name in CLASSES:
+        n, images = totals.get(name, (0, 0))
+        print(f"  {name:<13} {n or 0:>9} insects on {images or 0:>6} photos")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count insects per class over an archive of trap photos (resumable).")
+    parser.add_argument("root", help="directory tree of trap photos")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--decode-workers", type=int, default=DECODE_WORKERS)
+    parser.add_argument("--threads", type=int, default=INFER_THREADS, help="ONNX Runtime intra-op threads")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--tile-size", type=int, default=TILE_SIZE)
+    parser.add_argument("--overlap", type=int, default=OVERLAP)
+    parser.add_argument("--target-pixels", type=int, default=TARGET_PIXELS, help="0 = no rescaling")
+    args = parser.parse_args()
+
+    db = run(args.root, args.db, args.model, args.decode_workers, args.threads, args.batch_size,
+             args.tile_size, args.overlap, args.target_pixels or None)
+    print_totals(db)
+    db.close()
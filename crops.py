@@ -0,0 +1,271 @@
+import os
+import glob
+
+import numpy as np
+
+"""
+Vectorized crop extraction and packed crop shards.
+
+All crop windows of an image are computed as one NumPy operation and gathered
+from a sliding-window view of the image. Crops are stored per source image as
+memory-mappable .npy shards instead of one JPEG + one .txt per crop:
+
+    <shard_dir>/<name>_images.npy   uint8   N x crop x crop x 3 (BGR, as cv2)
+    <shard_dir>/<name>_labels.npy   float32 M x 6  (crop index, class, xc, yc, w, h)
+    <shard_dir>/<name>_boxes.npy    int32   N      (label line each crop is centred on)
+
+Once a split is done, pack_split() concatenates its shards into one array per
+column next to the shard folder, the form training and calibration read in one
+memory map:
+
+    <split_dir>/packed_images.npy   uint8   N x crop x crop x 3
+    <split_dir>/packed_labels.npy   float32 M x 6  (crop index over the whole split, ...)
+    <split_dir>/packed_boxes.npy    int32   N
+    <split_dir>/packed_names.npy    str     S      (source image of each shard)
+    <split_dir>/packed_offsets.npy  int64   S + 1  (crops of image i: offsets[i]:offsets[i + 1])
+
+Rows of a crop in the labels array start with the box it is centred on; with
+neighbours=True they are followed by every other box that is visible in the
+window, clipped to it. Those are found through BoxGrid, a uniform grid over the
+boxes of the image, so dense traps do not need an all-pairs overlap test.
+"""
+
+# Neighbouring boxes are kept in a crop when at least this fraction of their area is inside it
+MIN_VISIBILITY = 0.5
+
+IMAGES_SUFFIX = "_images.npy"
+LABELS_SUFFIX = "_labels.npy"
+BOXES_SUFFIX = "_boxes.npy"
+PACKED_PREFIX = "packed_"
+PACKED_COLUMNS = ["images", "labels", "boxes", "names", "offsets"]
+
+
+def read_yolo_labels(label_path, verbose=True):
+    """Returns (labels, line_indices): labels is an (N, 5) float64 array of valid lines."""
+    with open(label_path) as f:
+        lines = f.readlines()
+    rows, indices = [], []
+    for idx, line in enumerate(lines):
+        parts = line.strip().split()
+        if len(parts) != 5:
+            if verbose:
+                print(f"Linha inválida em {label_path}: {line}")
+            continue
+        try:
+            rows.append([float(p) for p in parts])
+        except ValueError:
+            if verbose:
+                print(f"Linha inválida em {label_path}: {line}")
+            continue
+        indices.append(idx)
+    labels = np.array(rows, dtype=np.float64).reshape(-1, 5)
+    return labels, np.array(indices, dtype=np.int32)
+
+
+def crop_windows(xc, yc, img_w, img_h, crop_size):
+    """
+    Top-left corners of crop_size windows centred on (xc, yc) (pixels), clamped
+    to stay inside the image. Same rounding/clamping as the original 120px.py loop.
+    """
+    x1 = np.rint(np.asarray(xc, dtype=np.float64) - crop_size / 2).astype(np.int64)
+    y1 = np.rint(np.asarray(yc, dtype=np.float64) - crop_size / 2).astype(np.int64)
+    x1 = np.clip(x1, 0, img_w - crop_size)
+    y1 = np.clip(y1, 0, img_h - crop_size)
+    return x1, y1
+
+
+def extract_crops(img, x1, y1, crop_size):
+    """Gathers all windows at once: returns an (N, crop, crop, C) array."""
+    windows = np.lib.stride_tricks.sliding_window_view(img, (crop_size, crop_size), axis=(0, 1))
+    # windows: (H-c+1, W-c+1, C, c, c) -> gather then move channels last
+    return np.ascontiguousarray(windows[y1, x1].transpose(0, 2, 3, 1))
+
+
+def _expand_ranges(starts, counts):
+    """For ranges [starts[i], starts[i] + counts[i]) returns (owner index, value) of every element."""
+    owner = np.repeat(np.arange(len(counts)), counts)
+    first = np.cumsum(counts) - counts
+    return owner, starts[owner] + np.arange(int(counts.sum())) - first[owner]
+
+
+class BoxGrid:
+    """Uniform grid over (N, 4) xyxy pixel boxes; cell -> box ids stored CSR-style."""
+
+    def __init__(self, boxes, img_w, img_h, cell_size):
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.cell_size = cell_size
+        self.cols = max(1, -(-int(img_w) // cell_size))
+        self.rows = max(1, -(-int(img_h) // cell_size))
+        box_ids, cell_ids = self._cells(self.boxes)
+        order = np.argsort(cell_ids, kind="stable")
+        self.box_ids = box_ids[order]
+        counts = np.bincount(cell_ids, minlength=self.rows * self.cols)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def _cells(self, rects):
+        """(owner index, cell id) for every grid cell each rect touches."""
+        cx0 = np.clip(np.floor(rects[:, 0] / self.cell_size), 0, self.cols - 1).astype(np.int64)
+        cy0 = np.clip(np.floor(rects[:, 1] / self.cell_size), 0, self.rows - 1).astype(np.int64)
+        cx1 = np.clip(np.floor(rects[:, 2] / self.cell_size), 0, self.cols - 1).astype(np.int64)
+        cy1 = np.clip(np.floor(rects[:, 3] / self.cell_size), 0, self.rows - 1).astype(np.int64)
+        ncx = cx1 - cx0 + 1
+        owner, k = _expand_ranges(np.zeros(len(rects), dtype=np.int64), ncx * (cy1 - cy0 + 1))
+        return owner, (cy0[owner] + k // ncx[owner]) * self.cols + cx0[owner] + k % ncx[owner]
+
+    def query(self, windows):
+        """(window index, box index) of every box overlapping one of the (W, 4) xyxy windows."""
+        windows = np.asarray(windows, dtype=np.float64).reshape(-1, 4)
+        win_ids, cell_ids = self._cells(windows)
+        owner, pos = _expand_ranges(self.offsets[cell_ids], self.offsets[cell_ids + 1] - self.offsets[cell_ids])
+        win_ids, box_ids = win_ids[owner], self.box_ids[pos]
+        # A box spanning several cells of the same window shows up once per cell
+        pairs = np.unique(win_ids * len(self.boxes) + box_ids)
+        win_ids, box_ids = pairs // max(len(self.boxes), 1), pairs % max(len(self.boxes), 1)
+        w, b = windows[win_ids], self.boxes[box_ids]
+        hit = (b[:, 0] < w[:, 2]) & (b[:, 2] > w[:, 0]) & (b[:, 1] < w[:, 3]) & (b[:, 3] > w[:, 1])
+        return win_ids[hit], box_ids[hit]
+
+
+def neighbour_labels(boxes, classes, x1, y1, img_w, img_h, crop_size, min_visibility=MIN_VISIBILITY):
+    """
+    Rows (crop index, class, xc, yc, w, h) for every box other than the centred one that
+    is at least min_visibility inside crop window i (top-left x1[i], y1[i]), clipped to it.
+    """
+    windows = np.stack([x1, y1, x1 + crop_size, y1 + crop_size], axis=1).astype(np.float64)
+    grid = BoxGrid(boxes, img_w, img_h, crop_size)
+    win_ids, box_ids = grid.query(windows)
+    keep = win_ids != box_ids
+    win_ids, box_ids = win_ids[keep], box_ids[keep]
+
+    b, w = boxes[box_ids], windows[win_ids]
+    cx1, cy1 = np.maximum(b[:, 0], w[:, 0]), np.maximum(b[:, 1], w[:, 1])
+    cx2, cy2 = np.minimum(b[:, 2], w[:, 2]), np.minimum(b[:, 3], w[:, 3])
+    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    visible = (cx2 - cx1) * (cy2 - cy1) >= min_visibility * np.maximum(area, 1e-9)
+
+    out = np.empty((int(visible.sum()), 6), dtype=np.float64)
+    out[:, 0] = win_ids[visible]
+    out[:, 1] = classes[box_ids[visible]]
+    out[:, 2] = ((cx1 + cx2) / 2 - w[:, 0])[visible] / crop_size
+    out[:, 3] = ((cy1 + cy2) / 2 - w[:, 1])[visible] / crop_size
+    out[:, 4] = (cx2 - cx1)[visible] / crop_size
+    out[:, 5] = (cy2 - cy1)[visible] / crop_size
+    return out
+
+
+def centred_crops(img, labels, crop_size, neighbours=False, min_visibility=MIN_VISIBILITY):
+    """
+    Crops crop_size windows centred on every YOLO box of labels (N, 5).
+    Returns (crops, crop_labels) with crop_labels (M, 6) = crop index, class, xc, yc, w, h
+    normalised to the crop, or (None, None) if the image is smaller than a crop.
+    Without neighbours there is one row per crop (M = N), the centred box.
+    """
+    h, w = img.shape[:2]
+    if h < crop_size or w < crop_size or len(labels) == 0:
+        return None, None
+    xc = labels[:, 1] * w
+    yc = labels[:, 2] * h
+    bw = labels[:, 3] * w
+    bh = labels[:, 4] * h
+    x1, y1 = crop_windows(xc, yc, w, h, crop_size)
+    crops = extract_crops(img, x1, y1, crop_size)
+
+    out = np.empty((len(labels), 6), dtype=np.float64)
+    out[:, 0] = np.arange(len(labels))
+    out[:, 1] = labels[:, 0]
+    out[:, 2] = (xc - x1) / crop_size
+    out[:, 3] = (yc - y1) / crop_size
+    out[:, 4] = bw / crop_size
+    out[:, 5] = bh / crop_size
+    np.clip(out[:, 2:], 0, 1, out=out[:, 2:])
+
+    if neighbours:
+        boxes = np.stack([xc - bw / 2, yc - bh / 2, xc + bw / 2, yc + bh / 2], axis=1)
+        out = np.concatenate([out, neighbour_labels(boxes, labels[:, 0], x1, y1, w, h, crop_size, min_visibility)])
+        # Group rows by crop, the centred box first
+        out = out[np.argsort(out[:, 0], kind="stable")]
+    return crops, out
+
+
+def _save_npy(path, array):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def write_shard(shard_dir, name, crops, labels, boxes):
+    os.makedirs(shard_dir, exist_ok=True)
+    _save_npy(os.path.join(shard_dir, name + IMAGES_SUFFIX), crops)
+    _save_npy(os.path.join(shard_dir, name + LABELS_SUFFIX), labels.astype(np.float32))
+    _save_npy(os.path.join(shard_dir, name + BOXES_SUFFIX), boxes.astype(np.int32))
+
+
+def remove_shard(shard_dir, name):
+    for suffix in (IMAGES_SUFFIX, LABELS_SUFFIX, BOXES_SUFFIX):
+        path = os.path.join(shard_dir, name + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def shard_names(shard_dir):
+    paths = glob.glob(os.path.join(glob.escape(shard_dir), "*" + IMAGES_SUFFIX))
+    return sorted(os.path.basename(p)[:-len(IMAGES_SUFFIX)] for p in paths)
+
+
+def load_shard(shard_dir, name, mmap_mode="r"):
+    """Returns (images, labels, boxes); images is memory-mapped by default."""
+    images = np.load(os.path.join(shard_dir, name + IMAGES_SUFFIX), mmap_mode=mmap_mode)
+    labels = np.load(os.path.join(shard_dir, name + LABELS_SUFFIX))
+    boxes = np.load(os.path.join(shard_dir, name + BOXES_SUFFIX))
+    return images, labels, boxes
+
+
+def iter_shards(shard_dir, mmap_mode="r"):
+    """Yields (name, images, labels, boxes) for every shard in shard_dir."""
+    for name in shard_names(shard_dir):
+        images, labels, boxes = load_shard(shard_dir, name, mmap_mode)
+        yield name, images, labels, boxes
+
+
+def crop_filename(name, box_idx, class_id):
+    return f"{name}_bb{box_idx}_class{int(class_id)}.jpg"
+
+
+def pack_split(split_dir, shard_dir=None):
+    """
+    Concatenates every shard of a split into the packed_*.npy arrays of split_dir.
+    Images are copied shard by shard into a memory-mapped file, never all held at once.
+    Returns the number of crops.
+    """
+    shard_dir = shard_dir or os.path.join(split_dir, "shards")
+    names = shard_names(shard_dir)
+    shards = [load_shard(shard_dir, name) for name in names]
+    counts = np.array([len(images) for images, _, _ in shards], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    crop_shape = shards[0][0].shape[1:] if shards else (0, 0, 3)
+
+    path = os.path.join(split_dir, PACKED_PREFIX + "images.npy")
+    tmp_path = path + ".tmp"
+    packed = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(int(offsets[-1]),) + crop_shape)
+    for (images, _, _), start in zip(shards, offsets):
+        packed[start:start + len(images)] = images
+    packed.flush()
+    del packed
+    os.replace(tmp_path, path)
+
+    labels = [labels + np.array([start, 0, 0, 0, 0, 0], dtype=np.float32) for (_, labels, _), start in zip(shards, offsets)]
+    _save_npy(os.path.join(split_dir, PACKED_PREFIX + "labels.npy"),
+              np.concatenate(labels) if labels else np.zeros((0, 6), np.float32))
+    _save_npy(os.path.join(split_dir, PACKED_PREFIX + "boxes.npy"),
+              np.concatenate([boxes for _, _, boxes in shards]) if shards else np.zeros(0, np.int32))
+    _save_npy(os.path.join(split_dir, PACKED_PREFIX + "names.npy"), np.array(names, dtype=str))
+    _save_npy(os.path.join(split_dir, PACKED_PREFIX + "offsets.npy"), offsets)
+    return int(offsets[-1])
+
+
+def load_packed(split_dir, mmap_mode="r"):
+    """Returns (images, labels, boxes, names, offsets) written by pack_split; images memory-mapped by default."""
+    return tuple(np.load(os.path.join(split_dir, f"{PACKED_PREFIX}{column}.npy"),
+                         mmap_mode=mmap_mode if column == "images" else None)
+                 for column in PACKED_COLUMNS)
@@ -0,0 +1,329 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from calibration_set import AUGMENT_SUFFIX
+from crops import iter_shards
+from image_header import read_image_size
+from pyramid import reduction_factor
+
+"""
+Near-duplicate and train/val leakage check with a perceptual-hash index.
+
+Every image (loose files in <split>/images, or crops in <split>/shards) gets a
+64-bit DCT perceptual hash: grayscale 32x32 thumbnail, 2-D DCT of the whole
+batch as two matrix products, sign of the 8x8 lowest frequencies against their
+median. The hash of each of the four 90-degree rotations is kept, so rotated
+copies made by magic.py still match. Darkened copies match as well: the hash
+only compares coefficients to their median.
+
+Lookup within HAMMING_RADIUS bits uses multi-index hashing: the 64 bits are cut
+into RADIUS + 1 chunks and two hashes within the radius must agree exactly on at
+least one chunk (pigeonhole). Candidates come from equal-chunk ranges of sorted
+tables and only they get a full XOR + popcount, so the cost grows with the
+number of near-collisions instead of N^2.
+
+    python dedup.py sticky_dataset/120px                  # report
+    python dedup.py sticky_dataset/120px --remove         # delete val leaks and val duplicates
+    python dedup.py sticky_dataset/16mpx --radius 8
+"""
+
+HASH_SIZE = 8          # 8 x 8 low-frequency DCT coefficients -> 64 bits
+THUMB_SIZE = 32
+HAMMING_RADIUS = 4
+ROTATIONS = 4
+NUM_WORKERS = os.cpu_count() or 1
+CHUNK = 256            # images per worker task
+SPLITS = ["train", "val"]
+REPORT_PATH = "dedup_report.json"
+
+REDUCED_GRAY_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def dct_matrix(n):
+    """Orthonormal DCT-II matrix: dct(x) = D @ x."""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    d = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    d[0] /= np.sqrt(2)
+    return d.astype(np.float32)
+
+
+_DCT = dct_matrix(THUMB_SIZE)
+_BIT_WEIGHTS = (1 << np.arange(HASH_SIZE * HASH_SIZE, dtype=np.uint64)[::-1]).astype(np.uint64)
+
+
+def thumbnail(img):
+    """Grayscale (or BGR) image -> float32 THUMB_SIZE x THUMB_SIZE."""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(img, (THUMB_SIZE, THUMB_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def phash_batch(thumbs):
+    """(N, 32, 32) float32 -> (N, ROTATIONS) uint64 hashes, one per 90-degree rotation."""
+    thumbs = np.asarray(thumbs, dtype=np.float32)
+    rotated = np.stack([np.rot90(thumbs, k, axes=(1, 2)) for k in range(ROTATIONS)], axis=1)
+    coeffs = _DCT @ rotated @ _DCT.T                      # batched 2-D DCT
+    low = coeffs[..., :HASH_SIZE, :HASH_SIZE].reshape(*coeffs.shape[:2], -1)
+    bits = low > np.median(low[..., 1:], axis=-1, keepdims=True)   # DC term left out of the median
+    return (bits.astype(np.uint64) * _BIT_WEIGHTS).sum(-1, dtype=np.uint64)
+
+
+def popcount(x):
+    x = np.asarray(x, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x).astype(np.int64)
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+    return table[x.view(np.uint8).reshape(*x.shape, 8)].sum(-1)
+
+
+def load_gray_reduced(path):
+    """Grayscale decode at the smallest DCT-scaled size that still covers the thumbnail."""
+    size = read_image_size(path)
+    if size is None:
+        return None
+    h, w = size
+    factor = reduction_factor(w, h, THUMB_SIZE * 2, THUMB_SIZE * 2, path.lower().endswith((".jpg", ".jpeg")))
+    return cv2.imread(path, REDUCED_GRAY_FLAGS[factor])
+
+
+def _hash_files(paths):
+    thumbs, ok = [], []
+    for path in paths:
+        img = load_gray_reduced(path)
+        if img is None:
+            print(f"[WARN] Failed to load {path}")
+            continue
+        thumbs.append(thumbnail(img))
+        ok.append(path)
+    return ok, phash_batch(np.stack(thumbs)) if thumbs else np.zeros((0, ROTATIONS), np.uint64)
+
+
+def list_images(img_dir):
+    return [os.path.join(img_dir, f) for f in sorted(os.listdir(img_dir))
+            if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+
+
+def hash_files(paths, num_workers=NUM_WORKERS):
+    """Returns (paths that decoded, (N, ROTATIONS) uint64 hashes), hashed in CHUNK-sized tasks."""
+    chunks = [paths[i:i + CHUNK] for i in range(0, len(paths), CHUNK)]
+    if num_workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(_hash_files, chunks))
+    else:
+        results = [_hash_files(c) for c in chunks]
+    names = [p for ok, _ in results for p in ok]
+    hashes = np.concatenate([h for _, h in results]) if results else np.zeros((0, ROTATIONS), np.uint64)
+    return names, hashes
+
+
+def hash_shards(shard_dir):
+    """Returns ("<shard>#<i>" names, hashes) for every crop of a shard directory."""
+    names, hashes = [], []
+    for shard, images, _, _ in iter_shards(shard_dir):
+        for start in range(0, len(images), CHUNK):
+            batch = np.asarray(images[start:start + CHUNK])
+            hashes.append(phash_batch(np.stack([thumbnail(img) for img in batch])))
+            names += [f"{shard}#{i}" for i in range(start, start + len(batch))]
+    return names, np.concatenate(hashes) if hashes else np.zeros((0, ROTATIONS), np.uint64)
+
+
+def split_sources(dataset):
+    """
+    {split: (kind, directory)} for the layouts in this repo: <split>/images or <split>/shards
+    (120px crops), images/<split> (16mpx, 5mpx YOLO datasets). kind is "files" or "shards".
+    """
+    sources = {}
+    for split in SPLITS:
+        for kind, path in [("files", os.path.join(dataset, split, "images")),
+                           ("files", os.path.join(dataset, "images", split)),
+                           ("shards", os.path.join(dataset, split, "shards"))]:
+            if os.path.isdir(path) and (kind == "shards" or list_images(path)):
+                sources[split] = (kind, path)
+                break
+    return sources
+
+
+def hash_split(kind, path, num_workers=NUM_WORKERS):
+    if kind == "files":
+        return hash_files(list_images(path), num_workers)
+    return hash_shards(path)
+
+
+class HashIndex:
+    """Multi-index hashing over 64-bit hashes for Hamming-radius queries."""
+
+    def __init__(self, hashes, owners, radius=HAMMING_RADIUS):
+        self.hashes = np.asarray(hashes, dtype=np.uint64).ravel()
+        self.owners = np.asarray(owners, dtype=np.int64).ravel()
+        self.radius = radius
+        n_chunks = radius + 1
+        bounds = np.linspace(0, 64, n_chunks + 1).astype(int)
+        self.chunks = list(zip(bounds[:-1], bounds[1:]))
+        self.tables = []
+        for lo, hi in self.chunks:
+            keys = self._chunk(self.hashes, lo, hi)
+            order = np.argsort(keys, kind="stable")
+            self.tables.append((keys[order], order))
+
+    @staticmethod
+    def _chunk(hashes, lo, hi):
+        mask = np.uint64((1 << (hi - lo)) - 1)
+        return (hashes >> np.uint64(lo)) & mask
+
+    def query(self, hashes, query_owners):
+        """Returns (query owner, index owner, distance) of every pair within the radius, deduplicated."""
+        hashes = np.asarray(hashes, dtype=np.uint64).ravel()
+        query_owners = np.asarray(query_owners, dtype=np.int64).ravel()
+        found_q, found_i = [], []
+        for (lo, hi), (keys, order) in zip(self.chunks, self.tables):
+            q_keys = self._chunk(hashes, lo, hi)
+            start = np.searchsorted(keys, q_keys, side="left")
+            stop = np.searchsorted(keys, q_keys, side="right")
+            counts = stop - start
+            q_idx = np.repeat(np.arange(len(hashes)), counts)
+            first = np.cumsum(counts) - counts
+            pos = start[q_idx] + np.arange(int(counts.sum())) - first[q_idx]
+            found_q.append(q_idx)
+            found_i.append(order[pos])
+        q_idx = np.concatenate(found_q)
+        i_idx = np.concatenate(found_i)
+        dist = popcount(hashes[q_idx] ^ self.hashes[i_idx])
+        keep = dist <= self.radius
+        # Several rotations / chunks hit the same pair
+        return unique_pairs(query_owners[q_idx[keep]], self.owners[i_idx[keep]], dist[keep])
+
+
+def unique_pairs(a, b, dist):
+    """One row per (a, b) pair, with its smallest distance."""
+    order = np.lexsort((dist, b, a))
+    a, b, dist = a[order], b[order], dist[order]
+    first = np.ones(len(dist), dtype=bool)
+    first[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+    return a[first], b[first], dist[first]
+
+
+def build_index(hashes, radius=HAMMING_RADIUS):
+    """Index over every rotation hash of every image; owners are image indices."""
+    owners = np.repeat(np.arange(len(hashes)), hashes.shape[1])
+    return HashIndex(hashes.ravel(), owners, radius)
+
+
+def augment_base(name):
+    """Crop name without magic.py's _orig / _rotNN / _dark suffix (and without the extension)."""
+    stem = os.path.splitext(os.path.basename(name.split("#")[0]))[0]
+    return AUGMENT_SUFFIX.sub("", stem)
+
+
+def find_duplicates(names, hashes, radius=HAMMING_RADIUS):
+    """Within-split near-duplicate pairs (i < j) as (i, j, distance, same_family)."""
+    index = build_index(hashes, radius)
+    q, i, d = index.query(hashes[:, 0], np.arange(len(hashes)))
+    # A rotated copy is only found from one side (its upright hash against our rotations)
+    keep = q != i
+    q, i, d = unique_pairs(np.minimum(q, i)[keep], np.maximum(q, i)[keep], d[keep])
+    family = np.array([augment_base(names[a]) == augment_base(names[b]) for a, b in zip(q, i)], dtype=bool)
+    return q, i, d, family
+
+
+def find_leakage(train_hashes, val_hashes, radius=HAMMING_RADIUS):
+    """(val index, train index, distance) of val images with a near-duplicate in train."""
+    index = build_index(train_hashes, radius)
+    return index.query(val_hashes[:, 0], np.arange(len(val_hashes)))
+
+
+def duplicate_groups(n, pairs_a, pairs_b):
+    """Union-find over pairs; returns the list of groups with more than one member."""
+    parent = np.arange(n)
+
+    def root(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(pairs_a, pairs_b):
+        ra, rb = root(a), root(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    groups = {}
+    for x in np.unique(np.concatenate([pairs_a, pairs_b])) if len(pairs_a) else []:
+        groups.setdefault(root(x), []).append(int(x))
+    return [sorted(g) for g in groups.values()]
+
+
+def label_path_for(img_path):
+    """YOLO label of an image in either <split>/images or images/<split>: the last "images" becomes "labels"."""
+    parts = os.path.normpath(img_path).split(os.sep)
+    i = len(parts) - 1 - parts[::-1].index("images")
+    parts[i] = "labels"
+    parts[-1] = os.path.splitext(parts[-1])[0] + ".txt"
+    return os.sep.join(parts)
+
+
+def remove_image(img_path):
+    """Deletes a loose image and its YOLO label."""
+    for path in (img_path, label_path_for(img_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find near-duplicate images and train/val leakage (rotation-invariant pHash).")
+    parser.add_argument("dataset", help="dataset root with train/ and val/ (e.g. sticky_dataset/120px)")
+    parser.add_argument("--radius", type=int, default=HAMMING_RADIUS, help="max Hamming distance (bits of 64)")
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS)
+    parser.add_argument("--report", default=REPORT_PATH)
+    parser.add_argument("--remove", action="store_true",
+                        help="delete val images leaking from train and all but one of each val duplicate group")
+    args = parser.parse_args()
+
+    data = {}
+    for split, (kind, path) in split_sources(args.dataset).items():
+        names, hashes = hash_split(kind, path, args.workers)
+        data[split] = (names, hashes, kind)
+        print(f"[INFO] {split}: {len(names)} images hashed ({kind} in {path})")
+
+    report = {"radius": args.radius, "duplicates": {}, "leakage": []}
+    groups_of = {}
+    for split, (names, hashes, kind) in data.items():
+        a, b, d, family = find_duplicates(names, hashes, args.radius)
+        groups = groups_of[split] = duplicate_groups(len(names), a, b)
+        report["duplicates"][split] = [{"a": names[x], "b": names[y], "distance": int(z), "augmented_copy": bool(f)}
+                                       for x, y, z, f in zip(a, b, d, family)]
+        print(f"[{split}] {len(a)} near-duplicate pairs in {len(groups)} groups "
+              f"({int(family.sum())} pairs are magic.py copies of the same crop)")
+
+    if "train" in data and "val" in data:
+        v, t, d = find_leakage(data["train"][1], data["val"][1], args.radius)
+        val_names, train_names = data["val"][0], data["train"][0]
+        report["leakage"] = [{"val": val_names[x], "train": train_names[y], "distance": int(z)} for x, y, z in zip(v, t, d)]
+        leaked = np.unique(v)
+        share = len(leaked) / max(len(val_names), 1)
+        print(f"[leakage] {len(leaked)} of {len(val_names)} val images ({share:.1%}) have a near-duplicate in train")
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"✅ Report saved to {args.report}")
+
+    if args.remove and "val" in data:
+        val_names, _, kind = data["val"]
+        if kind != "files":
+            print("[WARN] --remove only works on loose image files; shards are reported only")
+        else:
+            drop = set(np.unique(v).tolist()) if "train" in data else set()
+            for group in groups_of["val"]:  # keep the first of each group
+                drop.update(group[1:])
+            for x in sorted(drop):
+                remove_image(val_names[x])
+            print(f"[OK] Removed {len(drop)} val images (and labels)")
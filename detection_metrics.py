@@ -0,0 +1,236 @@
+import numpy as np
+
+from tiled_inference import box_iou
+
+"""
+Detection metrics (precision, recall, mAP50, mAP50-95) computed with NumPy only.
+
+Same definitions as the ultralytics validator that produced the tables in the
+README: predictions are matched to ground truth per image at 10 IoU thresholds
+(0.50:0.95), AP is the area under the interpolated PR curve sampled at 101 recall
+points, and precision/recall are reported at the confidence that maximises the
+mean F1 over classes.
+"""
+
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+# np.trapz was renamed to np.trapezoid in NumPy 2.0
+_trapezoid = getattr(np, "trapezoid", None) or np.trapz
+
+
+def xywhn_to_xyxy(boxes, img_w, img_h):
+    """Normalised YOLO (xc, yc, w, h) -> pixel (x1, y1, x2, y2)."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    out = np.empty_like(boxes)
+    out[:, 0] = (boxes[:, 0] - boxes[:, 2] / 2) * img_w
+    out[:, 1] = (boxes[:, 1] - boxes[:, 3] / 2) * img_h
+    out[:, 2] = (boxes[:, 0] + boxes[:, 2] / 2) * img_w
+    out[:, 3] = (boxes[:, 1] + boxes[:, 3] / 2) * img_h
+    return out
+
+
+def match_predictions(pred_classes, gt_classes, iou, iou_thresholds=IOU_THRESHOLDS):
+    """
+    Returns a (P, T) bool array: prediction p is a true positive at threshold t.
+    Each ground-truth box is matched at most once, highest IoU first.
+    """
+    correct = np.zeros((len(pred_classes), len(iou_thresholds)), dtype=bool)
+    if len(pred_classes) == 0 or len(gt_classes) == 0:
+        return correct
+    iou = iou * (gt_classes[:, None] == pred_classes[None, :])  # (G, P), other classes do not match
+    for t, threshold in enumerate(iou_thresholds):
+        gt_idx, pred_idx = np.nonzero(iou >= threshold)
+        if len(gt_idx) == 0:
+            continue
+        order = np.argsort(-iou[gt_idx, pred_idx], kind="stable")
+        gt_idx, pred_idx = gt_idx[order], pred_idx[order]
+        _, first = np.unique(pred_idx, return_index=True)
+        gt_idx, pred_idx = gt_idx[first], pred_idx[first]
+        _, first = np.unique(gt_idx, return_index=True)
+        correct[pred_idx[first], t] = True
+    return correct
+
+
+def pairwise_iou(a, b):
+    """IoU of a[i] with b[i] for (K, 4) xyxy arrays."""
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    wh = np.clip(np.minimum(a[:, 2:], b[:, 2:]) - np.maximum(a[:, :2], b[:, :2]), 0, None)
+    inter = wh[:, 0] * wh[:, 1]
+    return inter / np.maximum(area_a + area_b - inter, 1e-9)
+
+
+def match_dataset(pred_image, pred_classes, pred_boxes, gt_image, gt_classes, gt_boxes, iou_thresholds=IOU_THRESHOLDS):
+    """
+    match_predictions over a whole split at once. Boxes of all images are concatenated
+    and *_image gives the image id of every box. Only (gt, pred) pairs of the same image
+    and class are formed - a sorted key and searchsorted, no per-image loop - so the
+    cost follows the number of candidate pairs instead of images x boxes^2.
+    """
+    correct = np.zeros((len(pred_classes), len(iou_thresholds)), dtype=bool)
+    if len(pred_classes) == 0 or len(gt_classes) == 0:
+        return correct
+    span = int(max(pred_classes.max(), gt_classes.max())) + 1
+    gt_key = gt_image.astype(np.int64) * span + gt_classes
+    pred_key = pred_image.astype(np.int64) * span + pred_classes
+    order = np.argsort(gt_key, kind="stable")
+    sorted_key = gt_key[order]
+    start = np.searchsorted(sorted_key, pred_key, side="left")
+    counts = np.searchsorted(sorted_key, pred_key, side="right") - start
+    pred_idx = np.repeat(np.arange(len(pred_key)), counts)
+    first = np.cumsum(counts) - counts
+    gt_idx = order[start[pred_idx] + np.arange(int(counts.sum())) - first[pred_idx]]
+
+    iou = pairwise_iou(gt_boxes[gt_idx], pred_boxes[pred_idx])
+    keep = iou >= np.min(iou_thresholds)
+    gt_idx, pred_idx, iou = gt_idx[keep], pred_idx[keep], iou[keep]
+    order = np.argsort(-iou, kind="stable")
+    gt_idx, pred_idx, iou = gt_idx[order], pred_idx[order], iou[order]
+    for t, threshold in enumerate(iou_thresholds):
+        m = iou >= threshold
+        g, p = gt_idx[m], pred_idx[m]
+        _, first = np.unique(p, return_index=True)
+        g, p = g[first], p[first]
+        _, first = np.unique(g, return_index=True)
+        correct[p[first], t] = True
+    return correct
+
+
+def pr_envelope(recall, precision):
+    """PR curve with sentinel end points and monotonically decreasing precision."""
+    mrec = np.concatenate(([0.0], recall, [1.0]))
+    mpre = np.concatenate(([1.0], precision, [0.0]))
+    return mrec, np.flip(np.maximum.accumulate(np.flip(mpre)))
+
+
+def compute_ap(recall, precision):
+    """AP from one PR curve: precision envelope, 101-point interpolation."""
+    mrec, mpre = pr_envelope(recall, precision)
+    x = np.linspace(0, 1, 101)
+    return _trapezoid(np.interp(x, mrec, mpre), x)
+
+
+def ap_per_class(tp, conf, pred_classes, gt_classes, nc, eps=1e-16):
+    """
+    tp (P, T), conf (P,), pred_classes (P,), gt_classes (G,) over the whole dataset.
+    Returns dict with per-class precision, recall, ap (nc, T) and the PR curves.
+    """
+    order = np.argsort(-conf, kind="stable")
+    tp, conf, pred_classes = tp[order], conf[order], pred_classes[order]
+    n_thr = tp.shape[1] if tp.ndim == 2 else len(IOU_THRESHOLDS)
+
+    x = np.linspace(0, 1, 1000)
+    ap = np.zeros((nc, n_thr))
+    p_curve = np.zeros((nc, 1000))
+    r_curve = np.zeros((nc, 1000))
+    pr_curve = np.zeros((nc, 1000))  # precision vs recall at IoU 0.5
+    n_gt = np.bincount(gt_classes.astype(np.int64), minlength=nc)[:nc]
+
+    for c in range(nc):
+        mask = pred_classes == c
+        n_p = int(mask.sum())
+        if n_p == 0 or n_gt[c] == 0:
+            continue
+        fpc = (1 - tp[mask]).cumsum(0)
+        tpc = tp[mask].cumsum(0)
+        recall = tpc / (n_gt[c] + eps)
+        precision = tpc / (tpc + fpc)
+        # conf decreases along the curve, np.interp needs increasing x
+        r_curve[c] = np.interp(-x, -conf[mask], recall[:, 0], left=0)
+        p_curve[c] = np.interp(-x, -conf[mask], precision[:, 0], left=1)
+        for t in range(n_thr):
+            ap[c, t] = compute_ap(recall[:, t], precision[:, t])
+        pr_curve[c] = np.interp(x, *pr_envelope(recall[:, 0], precision[:, 0]))
+
+    f1 = 2 * p_curve * r_curve / (p_curve + r_curve + eps)
+    best = int(f1.mean(0).argmax())
+    return {
+        "precision": p_curve[:, best],
+        "recall": r_curve[:, best],
+        "ap": ap,
+        "conf_threshold": float(x[best]),
+        "instances": n_gt,
+        "px": x,
+        "p_curve": p_curve,
+        "r_curve": r_curve,
+        "pr_curve": pr_curve,
+    }
+
+
+class DetectionMetrics:
+    """Accumulates per-image matches, then computes the per-class table."""
+
+    def __init__(self, nc, iou_thresholds=IOU_THRESHOLDS):
+        self.nc = nc
+        self.iou_thresholds = iou_thresholds
+        self.tp, self.conf, self.pred_classes, self.gt_classes = [], [], [], []
+        self.images_per_class = np.zeros(nc, dtype=np.int64)
+        self.n_images = 0
+
+    def update(self, pred_boxes, pred_scores, pred_classes, gt_boxes, gt_classes):
+        """All boxes xyxy in the same pixel space."""
+        pred_classes = np.asarray(pred_classes, dtype=np.int64)
+        gt_classes = np.asarray(gt_classes, dtype=np.int64)
+        iou = box_iou(np.asarray(gt_boxes, np.float64).reshape(-1, 4), np.asarray(pred_boxes, np.float64).reshape(-1, 4))
+        self.tp.append(match_predictions(pred_classes, gt_classes, iou, self.iou_thresholds))
+        self.conf.append(np.asarray(pred_scores, dtype=np.float64))
+        self.pred_classes.append(pred_classes)
+        self.gt_classes.append(gt_classes)
+        self.images_per_class[np.unique(gt_classes[gt_classes < self.nc])] += 1
+        self.n_images += 1
+
+    def update_batch(self, n_images, pred_image, pred_boxes, pred_scores, pred_classes, gt_image, gt_boxes, gt_classes):
+        """
+        A whole split in one call: boxes of all images concatenated, *_image the image
+        id (0 .. n_images - 1) of every box, xyxy in the pixel space of its image.
+        """
+        pred_image = np.asarray(pred_image, dtype=np.int64)
+        gt_image = np.asarray(gt_image, dtype=np.int64)
+        pred_classes = np.asarray(pred_classes, dtype=np.int64)
+        gt_classes = np.asarray(gt_classes, dtype=np.int64)
+        pred_boxes = np.asarray(pred_boxes, np.float64).reshape(-1, 4)
+        gt_boxes = np.asarray(gt_boxes, np.float64).reshape(-1, 4)
+        self.tp.append(match_dataset(pred_image, pred_classes, pred_boxes, gt_image, gt_classes, gt_boxes,
+                                     self.iou_thresholds))
+        self.conf.append(np.asarray(pred_scores, dtype=np.float64))
+        self.pred_classes.append(pred_classes)
+        self.gt_classes.append(gt_classes)
+        valid = gt_classes < self.nc
+        pairs = np.unique(gt_image[valid] * self.nc + gt_classes[valid])
+        self.images_per_class += np.bincount(pairs % self.nc, minlength=self.nc)[:self.nc]
+        self.n_images += n_images
+
+    def compute(self):
+        tp = np.concatenate(self.tp) if self.tp else np.zeros((0, len(self.iou_thresholds)), bool)
+        conf = np.concatenate(self.conf) if self.conf else np.zeros(0)
+        pred_classes = np.concatenate(self.pred_classes) if self.pred_classes else np.zeros(0, np.int64)
+        gt_classes = np.concatenate(self.gt_classes) if self.gt_classes else np.zeros(0, np.int64)
+        result = ap_per_class(tp.astype(np.float64), conf, pred_classes, gt_classes, self.nc)
+        result["images"] = self.images_per_class
+        result["n_images"] = self.n_images
+        result["map50"] = result["ap"][:, 0]
+        result["map50_95"] = result["ap"].mean(1)
+        return result
+
+
+def format_table(result, class_names, title=None):
+    """README-style table: Class | Images | Instances | Precision | Recall | mAP50 | mAP50-95."""
+    present = result["instances"] > 0
+    lines = []
+    if title:
+        lines.append(title)
+    lines.append("| Class         | Images | Instances | Precision | Recall | mAP50 | mAP50-95 |")
+    lines.append("|:--------------|-------:|----------:|----------:|-------:|------:|---------:|")
+
+    def row(name, images, instances, p, r, m50, m5095):
+        return f"| {name:<13} | {images:>6} | {instances:>9} | {p:>9.3f} | {r:>6.3f} | {m50:>5.3f} | {m5095:>8.3f} |"
+
+    if present.any():
+        lines.append(row("**All**", result["n_images"], int(result["instances"].sum()),
+                         result["precision"][present].mean(), result["recall"][present].mean(),
+                         result["map50"][present].mean(), result["map50_95"][present].mean()))
+    for c, name in enumerate(class_names):
+        if present[c]:
+            lines.append(row(name, int(result["images"][c]), int(result["instances"][c]), result["precision"][c],
+                             result["recall"][c], result["map50"][c], result["map50_95"][c]))
+    return "\n".join(lines)
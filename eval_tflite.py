@@ -0,0 +1,232 @@
+import os
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from crops import iter_shards, read_yolo_labels
+from detection_metrics import DetectionMetrics, format_table, xywhn_to_xyxy
+from tiled_inference import nms, CLASS_NAMES
+
+"""
+Accuracy vs latency of the int8 model produced by convert_to_tflite.py.
+
+Runs 120px/weights/best_quantized.tflite with the TFLite interpreter over the
+sticky_dataset/120px/val crops (shards or loose files) on a pool of interpreters,
+one per worker thread. Crops are fed as uint8 directly - the model input is
+quantized with scale 1/255 and zero point 0, so the pixel values *are* the
+quantized input (other quantization params go through a uint8 lookup table) -
+and the uint8 outputs are decoded with the output scale/zero point.
+
+The float model (best_saved_model, or an .onnx export) is evaluated on the same
+crops and both per-class tables and latencies are printed side by side.
+"""
+
+TFLITE_PATH = "120px/weights/best_quantized.tflite"
+FLOAT_MODEL_PATH = "120px/weights/best_saved_model"
+VAL_DIR = "sticky_dataset/120px/val"
+IMG_SIZE = 128
+NUM_WORKERS = os.cpu_count() or 1
+CONF_THRESHOLD = 0.001  # like `yolo val`: keep low-confidence boxes for the PR curve
+IOU_THRESHOLD = 0.7
+MAX_DET = 300
+
+
+def load_interpreter_class():
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+def load_val_crops(val_dir=VAL_DIR):
+    """Returns (images uint8 N x H x W x 3 BGR, list of (M, 5) label arrays)."""
+    shard_dir = os.path.join(val_dir, "shards")
+    images, labels = [], []
+    if os.path.isdir(shard_dir):
+        for _, shard_images, shard_labels, _ in iter_shards(shard_dir):
+            images.append(np.asarray(shard_images))
+            for i in range(len(shard_images)):
+                labels.append(shard_labels[shard_labels[:, 0] == i, 1:])
+        return (np.concatenate(images) if images else np.zeros((0, IMG_SIZE, IMG_SIZE, 3), np.uint8)), labels
+
+    img_dir = os.path.join(val_dir, "images")
+    lbl_dir = os.path.join(val_dir, "labels")
+    for fname in sorted(os.listdir(img_dir)):
+        if not fname.lower().endswith(('.jpg', '.jpeg', '.png')):
+            continue
+        lbl_path = os.path.join(lbl_dir, os.path.splitext(fname)[0] + ".txt")
+        img = cv2.imread(os.path.join(img_dir, fname))
+        if img is None or not os.path.exists(lbl_path):
+            continue
+        images.append(img)
+        labels.append(read_yolo_labels(lbl_path, verbose=False)[0])
+    return np.stack(images) if images else np.zeros((0, IMG_SIZE, IMG_SIZE, 3), np.uint8), labels
+
+
+def to_model_input(img_bgr):
+    """uint8 BGR crop -> uint8 RGB at the model size (plain resize, as ultralytics letterboxes a square crop)."""
+    if img_bgr.shape[0] != IMG_SIZE or img_bgr.shape[1] != IMG_SIZE:
+        img_bgr = cv2.resize(img_bgr, (IMG_SIZE, IMG_SIZE), interpolation=cv2.INTER_LINEAR)
+    return np.ascontiguousarray(img_bgr[..., ::-1])
+
+
+def postprocess(pred, conf_threshold=CONF_THRESHOLD, iou_threshold=IOU_THRESHOLD, max_det=MAX_DET):
+    """(4 + nc, anchors) float output -> xyxy boxes (model pixels), scores, classes after NMS."""
+    pred = pred.T
+    if pred.shape[0] and pred[:, :4].max() <= 2.0:
+        pred = pred.copy()
+        pred[:, :4] *= IMG_SIZE  # normalised box export
+    cls_scores = pred[:, 4:]
+    classes = cls_scores.argmax(1)
+    scores = cls_scores[np.arange(len(pred)), classes]
+    keep = scores > conf_threshold
+    xywh, scores, classes = pred[keep, :4], scores[keep], classes[keep]
+    boxes = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+    keep = nms(boxes, scores, iou_threshold, classes)[:max_det]
+    return boxes[keep], scores[keep], classes[keep]
+
+
+class QuantizedRunner:
+    """One TFLite interpreter per worker thread, uint8 in / uint8 out."""
+
+    def __init__(self, model_path=TFLITE_PATH):
+        self.model_path = model_path
+        self.Interpreter = load_interpreter_class()
+        self.local = threading.local()
+        probe = self._interpreter()
+        inp = probe.get_input_details()[0]
+        scale, zero_point = inp["quantization"]
+        self.input_dtype = inp["dtype"]
+        self.input_lut = None
+        if self.input_dtype == np.uint8 and not (abs(scale * 255 - 1) < 1e-6 and zero_point == 0):
+            # pixel/255 -> quantized uint8, precomputed for all 256 pixel values
+            q = np.round(np.arange(256) / 255.0 / scale + zero_point)
+            self.input_lut = np.clip(q, 0, 255).astype(np.uint8)
+        out = probe.get_output_details()[0]
+        self.output_scale, self.output_zero_point = out["quantization"]
+        self.output_dtype = out["dtype"]
+
+    def _interpreter(self):
+        interpreter = getattr(self.local, "interpreter", None)
+        if interpreter is None:
+            interpreter = self.Interpreter(model_path=self.model_path, num_threads=1)
+            interpreter.allocate_tensors()
+            self.local.interpreter = interpreter
+            self.local.input_index = interpreter.get_input_details()[0]["index"]
+            self.local.output_index = interpreter.get_output_details()[0]["index"]
+        return interpreter
+
+    def __call__(self, img_rgb):
+        """Returns ((4 + nc, anchors) float32 output, seconds spent in invoke)."""
+        interpreter = self._interpreter()
+        x = img_rgb if self.input_lut is None else self.input_lut[img_rgb]
+        if self.input_dtype != np.uint8:
+            x = x.astype(np.float32) / 255.0
+        interpreter.set_tensor(self.local.input_index, x[None])
+        start = time.perf_counter()
+        interpreter.invoke()
+        elapsed = time.perf_counter() - start
+        raw = interpreter.get_tensor(self.local.output_index)[0]
+        if self.output_dtype in (np.uint8, np.int8):
+            raw = (raw.astype(np.float32) - self.output_zero_point) * self.output_scale
+        return raw, elapsed
+
+
+class FloatRunner:
+    """SavedModel (TensorFlow) or ONNX float model, fed with float32 in [0, 1]."""
+
+    def __init__(self, model_path=FLOAT_MODEL_PATH, threads=NUM_WORKERS):
+        self.onnx = model_path.endswith(".onnx")
+        if self.onnx:
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = threads
+            self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+            self.input_name = self.session.get_inputs()[0].name
+        else:
+            import tensorflow as tf
+            self.tf = tf
+            self.fn = tf.saved_model.load(model_path).signatures["serving_default"]
+
+    def __call__(self, img_rgb):
+        x = img_rgb[None].astype(np.float32) / 255.0
+        start = time.perf_counter()
+        if self.onnx:
+            raw = self.session.run(None, {self.input_name: x.transpose(0, 3, 1, 2)})[0]
+        else:
+            raw = list(self.fn(self.tf.constant(x)).values())[0].numpy()
+        elapsed = time.perf_counter() - start
+        return raw[0], elapsed
+
+
+def evaluate(runner, images, labels, workers=1):
+    """Runs runner over all crops; returns (metrics result, per-inference latencies in s, wall time in s)."""
+    inputs = [to_model_input(img) for img in images]
+    start = time.perf_counter()
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            outputs = list(pool.map(runner, inputs))
+    else:
+        outputs = [runner(x) for x in inputs]
+    wall = time.perf_counter() - start
+
+    metrics = DetectionMetrics(len(CLASS_NAMES))
+    for (raw, _), lab in zip(outputs, labels):
+        boxes, scores, classes = postprocess(raw)
+        gt = xywhn_to_xyxy(lab[:, 1:5], IMG_SIZE, IMG_SIZE)
+        metrics.update(boxes, scores, classes, gt, lab[:, 0])
+    latencies = np.array([t for _, t in outputs])
+    return metrics.compute(), latencies, wall
+
+
+def latency_line(name, latencies, wall, n):
+    if len(latencies) == 0:
+        return f"{name}: no crops"
+    return (f"{name}: p50 {np.median(latencies) * 1000:.2f} ms, p90 {np.percentile(latencies, 90) * 1000:.2f} ms "
+            f"per inference, {n / wall:.1f} crops/s overall")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy and latency of best_quantized.tflite vs the float model.")
+    parser.add_argument("--tflite", default=TFLITE_PATH)
+    parser.add_argument("--float-model", default=FLOAT_MODEL_PATH, help="SavedModel dir or .onnx ('' to skip)")
+    parser.add_argument("--val-dir", default=VAL_DIR)
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS, help="interpreters in the pool")
+    parser.add_argument("--limit", type=int, default=None, help="only the first N crops")
+    args = parser.parse_args()
+
+    images, labels = load_val_crops(args.val_dir)
+    if args.limit:
+        images, labels = images[:args.limit], labels[:args.limit]
+    print(f"[INFO] {len(images)} val crops from {args.val_dir}")
+
+    quantized = QuantizedRunner(args.tflite)
+    q_result, q_lat, q_wall = evaluate(quantized, images, labels, args.workers)
+    print(format_table(q_result, CLASS_NAMES, title=f"\nInt8 TFLite ({args.tflite})"))
+
+    f_result = None
+    if args.float_model:
+        try:
+            float_runner = FloatRunner(args.float_model)
+        except (ImportError, OSError) as e:
+            print(f"\n[WARN] Float model skipped: {e}")
+        else:
+            f_result, f_lat, f_wall = evaluate(float_runner, images, labels)
+            print(format_table(f_result, CLASS_NAMES, title=f"\nFloat ({args.float_model})"))
+
+    print("\nLatency:")
+    print("  " + latency_line(f"int8 ({args.workers} interpreters)", q_lat, q_wall, len(images)))
+    if f_result is not None:
+        print("  " + latency_line("float", f_lat, f_wall, len(images)))
+        present = q_result["instances"] > 0
+        print(f"\nQuantization cost: mAP50 {f_result['map50'][present].mean():.3f} -> {q_result['map50'][present].mean():.3f}, "
+              f"mAP50-95 {f_result['map50_95'][present].mean():.3f} -> {q_result['map50_95'][present].mean():.3f}")
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+from annotation_index import AnnotationIndex, open_yolo_index, INDEX_SUFFIX, COLUMNS
+from crops import iter_shards
+from detection_metrics import DetectionMetrics, format_table
+from tiled_inference import CLASS_NAMES
+
+"""
+Scores YOLO-format predictions against ground truth without ultralytics or torch.
+
+Predictions are either a folder of <image>.txt files with `class xc yc w h conf`
+lines (tiled_inference.py --out-dir, `yolo predict save_txt=True save_conf=True`)
+or a packed .npz with the annotation_index columns plus conf:
+
+    images (n,) names    image (m,) image id    cls, xc, yc, w, h, conf (m,)
+
+Ground truth is a YOLO labels folder (labels/val of 16mpx, val/labels of 120px -
+the image sizes come from the matching images folder), a .annidx index, or a
+split folder with 120px shards. All boxes of the split are concatenated and
+matched in one batched pass (detection_metrics.match_dataset), so a whole val
+split is scored in seconds on a CPU:
+
+    python evaluate_detections.py runs/detect/predict/labels sticky_dataset/16mpx/labels/val
+    python evaluate_detections.py preds.npz sticky_dataset/120px/val --curves pr_curves.npz
+"""
+
+PRED_COLUMNS = ["cls"] + COLUMNS + ["conf"]
+
+
+def read_prediction_dir(pred_dir):
+    """Folder of class xc yc w h conf .txt files -> packed columns (images = file stems)."""
+    names, rows, counts = [], [], []
+    for fname in sorted(os.listdir(pred_dir)):
+        if not fname.endswith(".txt"):
+            continue
+        with open(os.path.join(pred_dir, fname)) as f:
+            values = f.read().split()
+        try:
+            table = np.array(values, dtype=np.float64).reshape(-1, 6)
+        except ValueError:
+            print(f"[WARN] Skipping {fname}: expected 'class xc yc w h conf' lines")
+            continue
+        names.append(os.path.splitext(fname)[0])
+        rows.append(table)
+        counts.append(len(table))
+    table = np.concatenate(rows) if rows else np.zeros((0, 6))
+    columns = {name: table[:, i] for i, name in enumerate(PRED_COLUMNS)}
+    columns["images"] = np.array(names, dtype=str)
+    columns["image"] = np.repeat(np.arange(len(names)), counts)
+    return columns
+
+
+def save_packed(path, columns):
+    np.savez(path, **columns)
+
+
+def load_predictions(source):
+    if source.endswith(".npz"):
+        with np.load(source) as data:
+            return {name: data[name] for name in data.files}
+    return read_prediction_dir(source)
+
+
+def images_dir_for(label_dir):
+    """labels/val -> images/val, val/labels -> val/images (the last "labels" component)."""
+    parts = os.path.normpath(label_dir).split(os.sep)
+    if "labels" not in parts:
+        return None
+    parts[len(parts) - 1 - parts[::-1].index("labels")] = "images"
+    return os.sep.join(parts)
+
+
+def load_ground_truth(source):
+    """Returns packed columns: images, width, height, image, cls, xc, yc, w, h."""
+    if os.path.isdir(os.path.join(source, "shards")):
+        names, sizes, labels = [], [], []
+        for shard, images, shard_labels, _ in iter_shards(os.path.join(source, "shards")):
+            names += [f"{shard}#{i}" for i in range(len(images))]
+            sizes += [images.shape[1:3]] * len(images)
+            rows = np.asarray(shard_labels, dtype=np.float64)
+            rows[:, 0] += len(names) - len(images)
+            labels.append(rows)
+        rows = np.concatenate(labels) if labels else np.zeros((0, 6))
+        sizes = np.array(sizes, dtype=np.int64).reshape(-1, 2)
+        columns = {"images": np.array(names, dtype=str), "height": sizes[:, 0], "width": sizes[:, 1],
+                   "image": rows[:, 0].astype(np.int64), "cls": rows[:, 1]}
+        columns.update({name: rows[:, i + 2] for i, name in enumerate(COLUMNS)})
+        return columns
+
+    if source.endswith(INDEX_SUFFIX):
+        index = AnnotationIndex(source)
+    else:
+        img_dir = images_dir_for(source)
+        if img_dir is None or not os.path.isdir(img_dir):
+            raise SystemExit(f"[ERROR] No images folder next to {source} (image sizes are needed for pixel IoU)")
+        index = open_yolo_index(img_dir, source)
+    columns = {name: np.asarray(getattr(index, name)) for name in ["images", "width", "height", "image", "cls"] + COLUMNS}
+    columns["images"] = np.array([os.path.splitext(str(n))[0] for n in columns["images"]], dtype=str)
+    return columns
+
+
+def to_pixel_xyxy(columns, image, width, height):
+    w_img, h_img = width[image], height[image]
+    xc, yc = columns["xc"] * w_img, columns["yc"] * h_img
+    w, h = columns["w"] * w_img, columns["h"] * h_img
+    return np.stack([xc - w / 2, yc - h / 2, xc + w / 2, yc + h / 2], axis=1)
+
+
+def evaluate(pred, gt, nc=len(CLASS_NAMES)):
+    """Scores packed predictions against packed ground truth; returns the DetectionMetrics result."""
+    ids = {str(name): i for i, name in enumerate(gt["images"])}
+    pred_ids = np.array([ids.get(str(name), -1) for name in pred["images"]], dtype=np.int64)
+    unknown = int((pred_ids < 0).sum())
+    if unknown:
+        print(f"[WARN] {unknown} prediction files have no ground-truth image and are ignored")
+    image = pred_ids[np.asarray(pred["image"], dtype=np.int64)] if len(pred["image"]) else np.zeros(0, np.int64)
+    keep = image >= 0
+    pred = {name: np.asarray(pred[name])[keep] for name in PRED_COLUMNS}
+    image = image[keep]
+
+    metrics = DetectionMetrics(nc)
+    metrics.update_batch(len(gt["images"]),
+                         image, to_pixel_xyxy(pred, image, gt["width"], gt["height"]), pred["conf"], pred["cls"],
+                         gt["image"], to_pixel_xyxy(gt, gt["image"], gt["width"], gt["height"]), gt["cls"])
+    return metrics.compute()
+
+
+def result_summary(result, class_names):
+    present = result["instances"] > 0
+    per_class = {name: {"images": int(result["images"][c]), "instances": int(result["instances"][c]),
+                        "precision": float(result["precision"][c]), "recall": float(result["recall"][c]),
+                        "map50": float(result["map50"][c]), "map50_95": float(result["map50_95"][c])}
+                 for c, name in enumerate(class_names) if present[c]}
+    return {"images": result["n_images"], "conf_threshold": result["conf_threshold"],
+            "map50": float(result["map50"][present].mean()) if present.any() else 0.0,
+            "map50_95": float(result["map50_95"][present].mean()) if present.any() else 0.0,
+            "classes": per_class}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="mAP50 / mAP50-95 of YOLO-format predictions, NumPy only.")
+    parser.add_argument("predictions", help="folder of class xc yc w h conf .txt files, or a packed .npz")
+    parser.add_argument("ground_truth", help="YOLO labels folder, .annidx index, or 120px split folder with shards")
+    parser.add_argument("--names", nargs="+", default=CLASS_NAMES, help="class names, in class id order")
+    parser.add_argument("--curves", default=None, help="save the per-class P/R/F1 and PR curves to this .npz")
+    parser.add_argument("--json", default=None, help="save the summary table as JSON")
+    parser.add_argument("--save-packed", default=None, help="also save the predictions as a packed .npz")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    pred = load_predictions(args.predictions)
+    gt = load_ground_truth(args.ground_truth)
+    loaded = time.perf_counter()
+    print(f"[INFO] {len(pred['cls'])} predictions on {len(pred['images'])} images, "
+          f"{len(gt['cls'])} ground-truth boxes on {len(gt['images'])} images ({loaded - start:.2f}s to load)")
+    if args.save_packed:
+        save_packed(args.save_packed, pred)
+
+    result = evaluate(pred, gt, len(args.names))
+    print(format_table(result, args.names, title=f"\n{args.predictions} vs {args.ground_truth}"))
+    print(f"\n[INFO] Scored in {time.perf_counter() - loaded:.2f}s (best mean F1 at conf {result['conf_threshold']:.3f})")
+
+    if args.curves:
+        np.savez(args.curves, names=np.array(args.names), px=result["px"], p_curve=result["p_curve"],
+                 r_curve=result["r_curve"], pr_curve=result["pr_curve"], ap=result["ap"])
+        print(f"[OK] Curves saved to {args.curves}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result_summary(result, args.names), f, indent=2)
+        print(f"[OK] Summary saved to {args.json}")
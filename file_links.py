@@ -0,0 +1,130 @@
+import os
+import sys
+import errno
+import shutil
+
+import cv2
+
+"""
+Zero-copy file placement for the dataset layouts (16mpx/, 5mpx/, 2mpx/ labels ...).
+
+link_file() puts src at dst as a hardlink, else a reflink (copy-on-write clone,
+btrfs/XFS), else a symlink, and only copies when none of those is possible. A
+destination is up to date when it already is src (same inode, or a symlink to it)
+or, for clones and copies, has src's size and mtime - a stat, never a read. A
+same-filesystem copy only counts as stale (to be replaced by a link) where hard
+links can actually be made.
+
+A destination placed by link_file may share its inode with the source, so it must
+never be rewritten in place: replace_file()/imwrite_replace() write a new file and
+rename it over the destination.
+"""
+
+# "auto" tries hardlink -> reflink -> symlink -> copy; or force one of them
+LINK_MODE = "auto"
+LINK_MODES = ["hardlink", "reflink", "symlink", "copy"]
+
+FICLONE = 0x40049409  # linux/fs.h ioctl: clone the whole file
+
+# st_dev -> whether hard links can be made there (learnt from link_file, or probed once)
+_hardlinks = {}
+
+
+def reflink(src, dst):
+    """Copy-on-write clone of src at dst. Raises OSError where unsupported."""
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "reflink is only implemented for Linux", dst)
+    import fcntl
+    with open(src, "rb") as fs, open(dst, "wb") as fd:
+        try:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        except OSError:
+            fd.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def _place(src, dst, mode):
+    if mode == "hardlink":
+        os.link(src, dst)
+    elif mode == "reflink":
+        reflink(src, dst)
+    elif mode == "symlink":
+        os.symlink(os.path.relpath(os.path.abspath(src), os.path.dirname(os.path.abspath(dst))), dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+def _dir_of(path):
+    return os.path.dirname(os.path.abspath(path))
+
+
+def hardlinks_work(src, dst_dir):
+    """True if src can be hard-linked into dst_dir; probed once per filesystem."""
+    dev = os.stat(dst_dir).st_dev
+    if dev not in _hardlinks:
+        probe = os.path.join(dst_dir, f".link_probe_{os.getpid()}")
+        try:
+            os.link(src, probe)
+        except OSError:
+            _hardlinks[dev] = False
+        else:
+            os.remove(probe)
+            _hardlinks[dev] = True
+    return _hardlinks[dev]
+
+
+def is_placed(src, dst, mode=LINK_MODE):
+    """True if dst already holds the current src (stat only)."""
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        s, d = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    if mode == "symlink" or os.path.islink(dst):
+        return False
+    if mode in ("auto", "hardlink") and s.st_dev == d.st_dev and hardlinks_work(src, _dir_of(dst)):
+        return False  # a copy left by an older run: replace it with a link
+    return s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns
+
+
+def link_file(src, dst, mode=LINK_MODE):
+    """Places src at dst (replacing what is there). Returns the method that worked."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    modes = LINK_MODES if mode == "auto" else [mode]
+    for i, method in enumerate(modes):
+        try:
+            _place(src, dst, method)
+            if method == "hardlink":
+                _hardlinks[os.stat(_dir_of(dst)).st_dev] = True
+            return method
+        except OSError:
+            if method == "hardlink":
+                _hardlinks[os.stat(_dir_of(dst)).st_dev] = False
+            if i == len(modes) - 1:
+                raise
+    return None
+
+
+def replace_file(path, data):
+    """Writes data to a new inode renamed over path - never through a hard link to a source file."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def imwrite_replace(path, img):
+    """cv2.imwrite through replace_file (same encoder and bytes). Returns False if encoding failed."""
+    ok, buf = cv2.imencode(os.path.splitext(path)[1], img)
+    if not ok:
+        return False
+    replace_file(path, buf)
+    return True
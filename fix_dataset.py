@@ -1,6 +1,13 @@
 import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
 import cv2
 
+from build_cache import BuildCache
+from image_header import read_image_header, TRANSPOSED_ORIENTATIONS
+
 """
 This script processes all .jpg images in a given dataset directory.
 It checks if each image is in portrait mode (height > width).
@@ -8,36 +15,128 @@ If so, it rotates the image 90 degrees counterclockwise to convert it to landsca
 Images already in landscape mode are left unchanged.
 A summary of how many images were rotated is printed at the end.
 
+Orientation is decided from the JPEG header (size + EXIF orientation), so no image
+is decoded just to be checked. Portrait images are rotated losslessly in the DCT
+domain with jpegtran when it is installed; otherwise (or when the image size is not
+a multiple of the JPEG block size) they are decoded, rotated and re-encoded as before.
+Files already known to be landscape are recorded in the build cache (build_cache.py)
+and skipped on re-runs until their content changes.
+
 Useful for standardizing your dataset for computer vision or deep learning tasks!
 """
 
 # Path to the dataset folder
 dataset_dir = "sticky_dataset/stickytraps"
 
-# Counter for rotated images
-rotated_count = 0
+# Worker processes (1 = serial)
+NUM_WORKERS = os.cpu_count() or 1
+
+# jpegtran binary for lossless rotation (None = always re-encode with OpenCV)
+JPEGTRAN = shutil.which("jpegtran")
+
+# jpegtran transform that turns the *stored* pixels into the landscape result,
+# i.e. "apply EXIF orientation, then rotate 90 degrees counterclockwise"
+# ([] = the pixels are already right, only the EXIF tag has to go).
+JPEGTRAN_OPS = {
+    1: ["-rotate", "270"],
+    2: ["-transpose"],
+    3: ["-rotate", "90"],
+    4: ["-transverse"],
+    5: ["-flip", "vertical"],
+    6: [],
+    7: ["-flip", "horizontal"],
+    8: ["-rotate", "180"],
+}
+
+
+def rotate_lossless(image_path, orientation):
+    """Rotates with jpegtran (no re-encode). Returns False if it cannot be done losslessly."""
+    if JPEGTRAN is None:
+        return False
+    tmp_path = image_path + ".tmp"
+    cmd = [JPEGTRAN, "-copy", "none", "-perfect", "-optimize"] + JPEGTRAN_OPS[orientation]
+    cmd += ["-outfile", tmp_path, image_path]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if result.returncode != 0 or not os.path.exists(tmp_path):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, image_path)
+    return True
+
+
+def rotate_reencode(image_path):
+    # Load image using OpenCV (EXIF orientation is applied on load)
+    image = cv2.imread(image_path)
+    if image is None:
+        return False
+    rotated = cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return cv2.imwrite(image_path, rotated)  # Overwrite the original file
+
+
+def fix_image(image_path):
+    """Returns 'landscape', 'lossless', 'reencoded' or 'failed'."""
+    header = read_image_header(image_path)
+    if header is None:
+        return "failed"
 
-# Loop through all .jpg files in the folder
-for filename in os.listdir(dataset_dir):
-    if filename.lower().endswith(".jpg"):
-        image_path = os.path.join(dataset_dir, filename)
+    # Displayed dimensions: height (h), width (w)
+    h, w, orientation = header
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        h, w = w, h
 
-        # Load image using OpenCV
-        image = cv2.imread(image_path)
-        if image is None:
+    if h <= w:
+        return "landscape"
+
+    # Portrait mode detected – rotate to landscape
+    if rotate_lossless(image_path, orientation):
+        return "lossless"
+    if rotate_reencode(image_path):
+        return "reencoded"
+    return "failed"
+
+
+def fix_folder(folder, num_workers=NUM_WORKERS, cache=None):
+    cache = cache or BuildCache()
+    filenames = sorted(f for f in os.listdir(folder) if f.lower().endswith(".jpg"))
+    all_paths = [os.path.join(folder, f) for f in filenames]
+
+    # Skip images already normalised whose content has not changed since
+    cache.prime(all_paths, num_workers)
+    todo = [(f, p) for f, p in zip(filenames, all_paths) if not cache.is_fresh("fix_dataset", p, [p], {})]
+    paths = [p for _, p in todo]
+
+    if num_workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(fix_image, paths, chunksize=max(1, len(paths) // (num_workers * 8))))
+    else:
+        results = [fix_image(p) for p in paths]
+
+    counts = {"landscape": 0, "lossless": 0, "reencoded": 0, "failed": 0}
+    for (filename, path), result in zip(todo, results):
+        counts[result] += 1
+        if result == "failed":
             print(f"[❌] Failed to load image: {filename}")
+            cache.forget("fix_dataset", path)
             continue
+        if result == "landscape":
+            print(f"[✅] Already in landscape: {filename}")
+        else:
+            print(f"[🔁] Rotated to landscape ({result}): {filename}")
+        # In-place stage: the image itself (after rotation) is the recorded input
+        cache.record("fix_dataset", path, [path], {}, [])
 
-        # Get image dimensions: height (h), width (w)
-        h, w = image.shape[:2]
+    # Forget files that no longer exist
+    cache.evict("fix_dataset", all_paths)
+    cache.save()
+
+    counts["skipped"] = len(filenames) - len(todo)
+    return counts
 
-        if h > w:
-            # Portrait mode detected – rotate to landscape
-            rotated = cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
-            cv2.imwrite(image_path, rotated)  # Overwrite the original file
-            rotated_count += 1
-            print(f"[🔁] Rotated to landscape: {filename}")
-        else:
-            print(f"[✅] Already in landscape: {filename}")
 
-print(f"\n✅ Finished: {rotated_count} images were rotated to landscape.")
+if __name__ == "__main__":
+    counts = fix_folder(dataset_dir)
+    rotated_count = counts["lossless"] + counts["reencoded"]
+    print(f"\n✅ Finished: {rotated_count} images were rotated to landscape "
+          f"({counts['lossless']} lossless, {counts['reencoded']} re-encoded, "
+          f"{counts['skipped']} unchanged since last run, {counts['failed']} failed).")
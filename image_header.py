@@ -0,0 +1,120 @@
+import struct
+
+"""
+Reads image dimensions straight from the JPEG/PNG header, without decoding pixels.
+
+For a 16 MP trap photo cv2.imread costs a full decode (~50 MB of pixels) just to
+learn (h, w). Here we only read the first few KB of the file: the JPEG SOFn
+segment (and the EXIF orientation tag, so the result matches what cv2.imread
+would return) or the PNG IHDR chunk.
+"""
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# SOFn markers carry the frame size (C4, C8 and CC are DHT/JPG/DAC, not frames)
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# EXIF orientations 5..8 mean the stored image is transposed relative to the display
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def _exif_orientation(app1):
+    """Returns the EXIF orientation tag (1..8) from an APP1 payload, or 1."""
+    if not app1.startswith(b"Exif\x00\x00"):
+        return 1
+    tiff = app1[6:]
+    if len(tiff) < 8:
+        return 1
+    endian = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if endian is None:
+        return 1
+    ifd_offset = struct.unpack(endian + "I", tiff[4:8])[0]
+    if ifd_offset + 2 > len(tiff):
+        return 1
+    n_entries = struct.unpack(endian + "H", tiff[ifd_offset:ifd_offset + 2])[0]
+    for i in range(n_entries):
+        entry = ifd_offset + 2 + i * 12
+        if entry + 12 > len(tiff):
+            break
+        tag, typ, count = struct.unpack(endian + "HHI", tiff[entry:entry + 8])
+        if tag == 0x0112:  # Orientation, SHORT
+            value = struct.unpack(endian + "H", tiff[entry + 8:entry + 10])[0]
+            return value if 1 <= value <= 8 else 1
+    return 1
+
+
+def read_jpeg_header(f):
+    """Returns (height, width, exif_orientation) of a JPEG file object, or None."""
+    if f.read(2) != b"\xff\xd8":
+        return None
+    orientation = 1
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":  # fill bytes
+            marker = f.read(1)
+        if not marker:
+            return None
+        code = marker[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:  # standalone markers, no length
+            continue
+        if code == 0xD9 or code == 0xDA:  # EOI / SOS before any SOF: broken file
+            return None
+        raw_len = f.read(2)
+        if len(raw_len) != 2:
+            return None
+        seg_len = struct.unpack(">H", raw_len)[0]
+        if seg_len < 2:
+            return None
+        if code in SOF_MARKERS:
+            data = f.read(5)
+            if len(data) != 5:
+                return None
+            _, h, w = struct.unpack(">BHH", data)
+            return h, w, orientation
+        if code == 0xE1:
+            orientation = _exif_orientation(f.read(seg_len - 2))
+        else:
+            f.seek(seg_len - 2, 1)
+
+
+def read_png_header(f):
+    """Returns (height, width, 1) of a PNG file object, or None."""
+    head = f.read(24)
+    if len(head) < 24 or head[:8] != PNG_SIGNATURE or head[12:16] != b"IHDR":
+        return None
+    w, h = struct.unpack(">II", head[16:24])
+    return h, w, 1
+
+
+def read_image_header(img_path):
+    """Returns (stored_height, stored_width, exif_orientation) or None if unreadable."""
+    try:
+        with open(img_path, "rb") as f:
+            sig = f.read(8)
+            f.seek(0)
+            if sig.startswith(b"\xff\xd8"):
+                return read_jpeg_header(f)
+            if sig == PNG_SIGNATURE:
+                return read_png_header(f)
+    except OSError:
+        return None
+    return None
+
+
+def read_image_size(img_path, apply_exif=True):
+    """
+    Returns (height, width) as cv2.imread would report them, or None.
+    With apply_exif=False the raw stored size is returned instead.
+    """
+    header = read_image_header(img_path)
+    if header is None:
+        return None
+    h, w, orientation = header
+    if apply_exif and orientation in TRANSPOSED_ORIENTATIONS:
+        return w, h
+    return h, w
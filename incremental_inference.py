@@ -0,0 +1,386 @@
+import os
+import time
+import argparse
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from tiled_inference import (
+    TiledDetector, MODEL_PATH, CLASS_NAMES, TILE_SIZE, OVERLAP, BATCH_SIZE, NUM_THREADS, CONF_THRESHOLD,
+    IOU_THRESHOLD, TARGET_PIXELS, EDGE_MARGIN, resize_to_pixels, tile_grid, nms, save_yolo_predictions,
+)
+
+"""
+Change-aware tiled inference for repeated photos of the same trap.
+
+A trap is photographed day after day and only a few insects land in between, so
+re-running every tile of every photo is mostly wasted work. For each trap the
+last photo (as a small normalised grayscale image) and its detections are kept:
+
+1. the new photo is registered to the previous one with cv2.phaseCorrelate
+   (camera or trap moved by a few pixels);
+2. the aligned images are compared in CELL x CELL blocks - gain/offset normalised,
+   so a cloudy day is not a change - and a tile is "changed" if any block it
+   covers differs by more than CHANGE_THRESHOLD;
+3. only the changed tiles go through TiledDetector.detect_windows (plus the tiles
+   along a photo border the scene moved across); detections of the previous shot
+   are shifted by the registration offset and carried over unless a re-run tile
+   reports them again whole, and both are merged with NMS.
+
+--verify also runs every photo in full and reports the detections that differ.
+
+When registration is unreliable, the photo size changed or most tiles changed,
+the whole photo is run again. Carried boxes pick up the sub-pixel error of every
+registration, so every FULL_RUN_EVERY-th photo of a trap is also run in full,
+which re-anchors them. Per-trap states live in an LRU cache (MAX_TRAPS,
+MAX_AGE_DAYS) that is mirrored to --state-dir, so daily runs pick up where the
+previous day stopped:
+
+    python incremental_inference.py traps/T07/2024-06-*.jpg --state-dir trap_state
+"""
+
+REG_MAX_SIDE = 1024          # registration / difference image, longer side in pixels
+CELL = 8                     # difference block, in registration-image pixels
+BLUR_SIGMA = 1.0             # smoothing of the reference, so sub-pixel misalignment of edges is not a change
+CHANGE_THRESHOLD = 0.35      # mean |difference| of a block, in units of the image standard deviation
+MIN_RESPONSE = 0.05          # phaseCorrelate peak below this = registration failed
+MAX_SHIFT = 0.1              # larger offsets (fraction of the image side) are treated as a new scene
+FULL_RERUN_FRACTION = 0.6    # above this fraction of changed tiles, just run them all
+FULL_RUN_EVERY = 4           # photos per trap between full runs, bounds the drift of carried boxes
+MAX_TRAPS = 256
+MAX_AGE_DAYS = 7
+
+
+class TrapState:
+    """What is remembered of the last photo of a trap (detections in working-scale pixels)."""
+
+    def __init__(self, reference, work_shape, boxes, scores, classes, timestamp=None, photo="", since_full=0):
+        self.reference = reference
+        self.work_shape = tuple(work_shape)
+        self.boxes = boxes
+        self.scores = scores
+        self.classes = classes
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.photo = photo
+        self.since_full = since_full  # incremental photos since the last full run
+
+    def save(self, path):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, reference=self.reference, work_shape=np.array(self.work_shape), boxes=self.boxes,
+                 scores=self.scores, classes=self.classes, timestamp=self.timestamp, photo=self.photo,
+                 since_full=self.since_full)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            since_full = int(data["since_full"]) if "since_full" in data.files else 0
+            return cls(data["reference"], data["work_shape"], data["boxes"], data["scores"], data["classes"],
+                       float(data["timestamp"]), str(data["photo"]), since_full)
+
+
+class TrapCache:
+    """LRU of TrapState per trap id, optionally mirrored to one .npz per trap in state_dir."""
+
+    def __init__(self, state_dir=None, max_traps=MAX_TRAPS, max_age_days=MAX_AGE_DAYS):
+        self.state_dir = state_dir
+        self.max_traps = max_traps
+        self.max_age = max_age_days * 86400
+        self.states = OrderedDict()
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def _path(self, trap_id):
+        return os.path.join(self.state_dir, f"{trap_id}.npz")
+
+    def get(self, trap_id, now=None):
+        now = time.time() if now is None else now
+        state = self.states.get(trap_id)
+        if state is None and self.state_dir and os.path.exists(self._path(trap_id)):
+            state = TrapState.load(self._path(trap_id))
+        if state is None:
+            return None
+        if now - state.timestamp > self.max_age:
+            self.drop(trap_id)  # too old: the trap may have been replaced since
+            return None
+        self.states[trap_id] = state
+        self.states.move_to_end(trap_id)
+        return state
+
+    def put(self, trap_id, state):
+        self.states[trap_id] = state
+        self.states.move_to_end(trap_id)
+        if self.state_dir:
+            state.save(self._path(trap_id))
+        while len(self.states) > self.max_traps:
+            self.states.popitem(last=False)  # still on disk, reloaded on demand
+
+    def drop(self, trap_id):
+        self.states.pop(trap_id, None)
+        if self.state_dir and os.path.exists(self._path(trap_id)):
+            os.remove(self._path(trap_id))
+
+    def evict_expired(self, now=None):
+        """Removes states older than max_age from memory and disk. Returns the evicted trap ids."""
+        now = time.time() if now is None else now
+        expired = [t for t, s in self.states.items() if now - s.timestamp > self.max_age]
+        if self.state_dir:
+            for fname in os.listdir(self.state_dir):
+                trap_id = fname[:-len(".npz")]
+                if fname.endswith(".npz") and not fname.endswith(".tmp.npz") and trap_id not in self.states:
+                    if now - TrapState.load(os.path.join(self.state_dir, fname)).timestamp > self.max_age:
+                        expired.append(trap_id)
+        for trap_id in expired:
+            self.drop(trap_id)
+        return expired
+
+
+def reference_image(work):
+    """Small, slightly blurred float32 grayscale copy, normalised to zero mean / unit std (lighting changes cancel out)."""
+    gray = cv2.cvtColor(work, cv2.COLOR_BGR2GRAY) if work.ndim == 3 else work
+    scale = min(1.0, REG_MAX_SIDE / max(gray.shape))
+    if scale < 1:
+        gray = cv2.resize(gray, (int(gray.shape[1] * scale), int(gray.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+    gray = cv2.GaussianBlur(gray.astype(np.float32), (0, 0), BLUR_SIGMA)
+    return (gray - gray.mean()) / max(float(gray.std()), 1e-6)
+
+
+def register(previous, current):
+    """(dx, dy, response): current ~ previous shifted by (dx, dy), in reference-image pixels."""
+    window = cv2.createHanningWindow(current.shape[::-1], cv2.CV_32F)
+    # phaseCorrelate applies the window in place - keep the references intact
+    (dx, dy), response = cv2.phaseCorrelate(previous.copy(), current.copy(), window)
+    return dx, dy, response
+
+
+def changed_cells(previous, current, dx, dy):
+    """Boolean (rows, cols) map of CELL x CELL blocks that differ after aligning previous onto current."""
+    h, w = current.shape
+    shift = np.float32([[1, 0, dx], [0, 1, dy]])
+    aligned = cv2.warpAffine(previous, shift, (w, h), flags=cv2.INTER_LINEAR, borderValue=float("nan"))
+    missing = np.isnan(aligned)
+    rows, cols = -(-h // CELL), -(-w // CELL)
+
+    def block_sums(values):
+        padded = np.zeros((rows * CELL, cols * CELL), dtype=np.float32)
+        padded[:h, :w] = values
+        return padded.reshape(rows, CELL, cols, CELL).sum(axis=(1, 3))
+
+    diff = block_sums(np.where(missing, 0, np.abs(current - np.nan_to_num(aligned))))
+    seen = block_sums(~missing)
+    real = block_sums(np.ones_like(current))
+    # Blocks mostly outside the previous photo (moved into view) count as changed
+    return (seen < real / 2) | (diff / np.maximum(seen, 1) > CHANGE_THRESHOLD)
+
+
+def cell_ranges(x1, y1, tile_size, ref_scale, rows, cols):
+    """Cell index ranges [c0, c1) x [r0, r1) covered by each tile."""
+    c0 = np.clip(np.floor(x1 * ref_scale / CELL).astype(np.int64), 0, cols)
+    r0 = np.clip(np.floor(y1 * ref_scale / CELL).astype(np.int64), 0, rows)
+    c1 = np.clip(np.ceil((x1 + tile_size) * ref_scale / CELL).astype(np.int64), 0, cols)
+    r1 = np.clip(np.ceil((y1 + tile_size) * ref_scale / CELL).astype(np.int64), 0, rows)
+    return c0, r0, np.maximum(c1, c0 + 1), np.maximum(r1, r0 + 1)
+
+
+def changed_tiles(cells, x1, y1, tile_size, ref_scale):
+    """Tiles covering at least one changed cell - a summed-area table, one lookup per tile."""
+    rows, cols = cells.shape
+    table = np.zeros((rows + 1, cols + 1), dtype=np.int64)
+    table[1:, 1:] = cells.cumsum(0).cumsum(1)
+    c0, r0, c1, r1 = cell_ranges(x1, y1, tile_size, ref_scale, rows, cols)
+    c1, r1 = np.minimum(c1, cols), np.minimum(r1, rows)
+    return (table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]) > 0
+
+
+def redetected(boxes, tiles_x1, tiles_y1, tile_size, img_w, img_h, slack=0.0):
+    """
+    True for boxes that one of the given tiles reports whole, i.e. inside the tile and
+    clear of its inner borders (TiledDetector.decode cuts boxes at EDGE_MARGIN there,
+    expecting the overlapping neighbour to have them - which may not have been re-run).
+    slack widens the margin by the uncertainty of the box positions.
+    """
+    margin = (EDGE_MARGIN or 0) + slack
+    tx, ty = tiles_x1[None, :], tiles_y1[None, :]
+    bx0, by0, bx1, by1 = (boxes[:, i, None] for i in range(4))
+    left = np.where(tx > 0, bx0 - tx > margin, bx0 >= tx)
+    top = np.where(ty > 0, by0 - ty > margin, by0 >= ty)
+    right = np.where(tx + tile_size < img_w, bx1 - tx < tile_size - margin, bx1 <= tx + tile_size)
+    bottom = np.where(ty + tile_size < img_h, by1 - ty < tile_size - margin, by1 <= ty + tile_size)
+    return (left & top & right & bottom).any(axis=1)
+
+
+def overlaps(boxes, x1, y1, tile_size):
+    """True for tiles that intersect any of the boxes."""
+    if not len(boxes):
+        return np.zeros(len(x1), dtype=bool)
+    return ((boxes[:, None, 0] < x1 + tile_size) & (boxes[:, None, 2] > x1) &
+            (boxes[:, None, 1] < y1 + tile_size) & (boxes[:, None, 3] > y1)).any(axis=0)
+
+
+def unmatched(boxes, classes, ref_boxes, ref_classes, iou_threshold=0.9):
+    """Boxes with no same-class box of IoU >= iou_threshold in the reference set (for --verify)."""
+    if not len(boxes) or not len(ref_boxes):
+        return np.ones(len(boxes), dtype=bool)
+    lt = np.maximum(boxes[:, None, :2], ref_boxes[None, :, :2])
+    rb = np.minimum(boxes[:, None, 2:], ref_boxes[None, :, 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    ref_area = np.prod(ref_boxes[:, 2:] - ref_boxes[:, :2], axis=1)
+    iou = inter / np.maximum(area[:, None] + ref_area[None, :] - inter, 1e-9)
+    return ~((iou >= iou_threshold) & (classes[:, None] == ref_classes[None, :])).any(axis=1)
+
+
+class IncrementalDetector:
+    def __init__(self, detector, cache=None, tile_size=TILE_SIZE, overlap=OVERLAP, target_pixels=TARGET_PIXELS,
+                 full_run_every=FULL_RUN_EVERY):
+        self.detector = detector
+        self.cache = cache or TrapCache()
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.target_pixels = target_pixels
+        self.full_run_every = full_run_every
+
+    def detect(self, trap_id, img, photo="", timestamp=None):
+        """
+        Same result dict as TiledDetector.detect, plus "tiles_run" (tiles sent to the
+        model) and "mode" ("full", "incremental" or "unchanged").
+        """
+        start = time.perf_counter()
+        work, scale = resize_to_pixels(img, self.target_pixels)
+        h, w = work.shape[:2]
+        if h < self.tile_size or w < self.tile_size:
+            work = np.pad(work, ((0, max(0, self.tile_size - h)), (0, max(0, self.tile_size - w)), (0, 0)))
+        x1, y1 = tile_grid(work.shape[1], work.shape[0], self.tile_size, self.overlap)
+        current = reference_image(work)
+        ref_scale = current.shape[1] / work.shape[1]
+
+        previous = self.cache.get(trap_id, timestamp)
+        run = None
+        mode = "full"
+        # Every full_run_every-th photo is run in full, re-anchoring boxes carried across several registrations
+        due = previous is not None and previous.since_full + 1 >= self.full_run_every
+        if previous is not None and not due and previous.work_shape == work.shape[:2] and \
+                previous.reference.shape == current.shape:
+            dx, dy, response = register(previous.reference, current)
+            if response >= MIN_RESPONSE and max(abs(dx) / current.shape[1], abs(dy) / current.shape[0]) <= MAX_SHIFT:
+                cells = changed_cells(previous.reference, current, dx, dy)
+                run = changed_tiles(cells, x1, y1, self.tile_size, ref_scale)
+                # Previous detections moved by the registration offset
+                carried = previous.boxes + np.array([dx, dy, dx, dy]) / ref_scale
+                img_h, img_w = work.shape[:2]
+                inside = (carried[:, 2] > 0) & (carried[:, 3] > 0) & (carried[:, 0] < img_w) & (carried[:, 1] < img_h)
+                clipped = np.clip(carried, 0, [img_w, img_h, img_w, img_h])
+                # Insects now cut by the photo border look different to the model: re-run their tiles
+                cut = inside & (clipped != carried).any(axis=1)
+                run |= overlaps(clipped[cut], x1, y1, self.tile_size)
+                carried = clipped
+                # ... and so do the ones that moved in from it: re-run the tiles along the uncovered edges
+                shift_x, shift_y = dx / ref_scale, dy / ref_scale
+                run |= ((shift_x >= 0.5) & (x1 == 0)) | ((shift_x <= -0.5) & (x1 + self.tile_size >= img_w)) | \
+                       ((shift_y >= 0.5) & (y1 == 0)) | ((shift_y <= -0.5) & (y1 + self.tile_size >= img_h))
+                if run.mean() > FULL_RERUN_FRACTION:
+                    run = None
+                else:
+                    mode = "incremental" if run.any() else "unchanged"
+
+        if run is None:
+            boxes, scores, classes = self.detector.detect_windows(work, x1, y1, self.tile_size)
+            tiles_run = len(x1)
+        else:
+            # Carried over, except the boxes a re-run tile reports again
+            keep = inside & ~redetected(carried, x1[run], y1[run], self.tile_size, img_w, img_h,
+                                         slack=1 / ref_scale)  # registration is good to ~1 reference pixel
+            boxes, scores, classes = carried[keep], previous.scores[keep], previous.classes[keep]
+            tiles_run = int(run.sum())
+            if tiles_run:
+                new_boxes, new_scores, new_classes = self.detector.detect_windows(work, x1[run], y1[run], self.tile_size)
+                boxes = np.concatenate([boxes, new_boxes])
+                scores = np.concatenate([scores, new_scores])
+                classes = np.concatenate([classes, new_classes])
+                keep = nms(boxes, scores, self.detector.iou_threshold, classes)
+                boxes, scores, classes = boxes[keep], scores[keep], classes[keep]
+
+        since_full = 0 if run is None else previous.since_full + 1
+        self.cache.put(trap_id, TrapState(current, work.shape[:2], boxes, scores, classes, timestamp, photo, since_full))
+        elapsed = time.perf_counter() - start
+        return {
+            "boxes": boxes / scale,
+            "scores": scores,
+            "classes": classes,
+            "tiles": len(x1),
+            "tiles_run": tiles_run,
+            "mode": mode,
+            "seconds": elapsed,
+            "tiles_per_second": len(x1) / elapsed if elapsed > 0 else float("inf"),
+        }
+
+
+def trap_of(img_path, trap=None):
+    """Trap id of a photo: given explicitly, or the name of the folder it is in."""
+    return trap or os.path.basename(os.path.dirname(os.path.abspath(img_path)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tiled inference that only re-runs the tiles that changed since the last photo of a trap.")
+    parser.add_argument("images", nargs="+", help="photos, processed in name order per trap")
+    parser.add_argument("--trap", default=None, help="trap id for all photos (default: their folder name)")
+    parser.add_argument("--state-dir", default=None, help="keep per-trap states here between runs")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--tile-size", type=int, default=TILE_SIZE)
+    parser.add_argument("--overlap", type=int, default=OVERLAP)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=NUM_THREADS)
+    parser.add_argument("--conf", type=float, default=CONF_THRESHOLD)
+    parser.add_argument("--iou", type=float, default=IOU_THRESHOLD)
+    parser.add_argument("--target-pixels", type=int, default=TARGET_PIXELS, help="0 = no rescaling")
+    parser.add_argument("--max-age-days", type=float, default=MAX_AGE_DAYS)
+    parser.add_argument("--full-run-every", type=int, default=FULL_RUN_EVERY,
+                        help="run every N-th photo of a trap in full (1 = always)")
+    parser.add_argument("--out-dir", default=None, help="write <name>.txt predictions here")
+    parser.add_argument("--verify", action="store_true",
+                        help="also run every photo in full and report detections that differ (slow)")
+    args = parser.parse_args()
+
+    detector = TiledDetector(args.model, args.threads, args.batch_size, args.conf, args.iou)
+    cache = TrapCache(args.state_dir, max_age_days=args.max_age_days)
+    evicted = cache.evict_expired()
+    if evicted:
+        print(f"[INFO] Dropped {len(evicted)} expired trap states")
+    incremental = IncrementalDetector(detector, cache, args.tile_size, args.overlap, args.target_pixels or None,
+                                      args.full_run_every)
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    total_tiles = total_run = 0
+    total_seconds = 0.0
+    mismatches = 0
+    for img_path in sorted(args.images, key=lambda p: (trap_of(p, args.trap), os.path.basename(p))):
+        img = cv2.imread(img_path)
+        if img is None:
+            print(f"[WARN] Failed to load {img_path}")
+            continue
+        result = incremental.detect(trap_of(img_path, args.trap), img, os.path.basename(img_path),
+                                    os.path.getmtime(img_path))
+        total_tiles += result["tiles"]
+        total_run += result["tiles_run"]
+        total_seconds += result["seconds"]
+        counts = np.bincount(result["classes"].astype(np.int64), minlength=len(CLASS_NAMES))
+        summary = ", ".join(f"{name}: {n}" for name, n in zip(CLASS_NAMES, counts))
+        print(f"[OK] {img_path}: {len(result['boxes'])} detections ({summary}) - {result['mode']}, "
+              f"{result['tiles_run']}/{result['tiles']} tiles run in {result['seconds']:.2f}s")
+        if args.verify:
+            full = detector.detect(img, args.tile_size, args.overlap, args.target_pixels or None)
+            missing = int(unmatched(full["boxes"], full["classes"], result["boxes"], result["classes"]).sum())
+            extra = int(unmatched(result["boxes"], result["classes"], full["boxes"], full["classes"]).sum())
+            mismatches += missing + extra
+            if missing or extra:
+                print(f"[WARN] {img_path}: {missing} of {len(full['boxes'])} full-run detections missing, {extra} extra")
+        if args.out_dir:
+            name = os.path.splitext(os.path.basename(img_path))[0]
+            save_yolo_predictions(os.path.join(args.out_dir, name + ".txt"), result, img.shape[1], img.shape[0])
+
+    if total_tiles:
+        print(f"\n✅ {total_run} of {total_tiles} tiles run ({100 * total_run / total_tiles:.1f}%) in {total_seconds:.2f}s")
+    if args.verify:
+        print(f"[INFO] {mismatches} detections differ from full runs")
@@ -0,0 +1,513 @@
+import os
+import io
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from tiled_inference import (
+    TiledDetector, MODEL_PATH, CLASS_NAMES, TILE_SIZE, OVERLAP, BATCH_SIZE, NUM_THREADS, TARGET_PIXELS,
+    nms, resize_to_pixels, tile_grid,
+)
+from crops import extract_crops
+
+"""
+Long-running local inference service for the 120px model (ONNX Runtime, CPU).
+
+The model is loaded once; trap cameras POST encoded photos over HTTP on localhost:
+
+    POST /detect   full trap photo (JPEG/PNG body) -> tiled detection, like tiled_inference.py
+    POST /crops    one pre-cut crop (JPEG/PNG) or an .npy uint8 N x H x W x 3 BGR batch of crops
+    GET  /metrics  throughput, queue depth, p50/p99 latency, batch sizes
+    GET  /health
+
+Decoding and tiling run on a thread pool. The tiles of all requests that arrive
+within MAX_WAIT_MS of the first waiting one are concatenated into a single
+micro-batch (up to MAX_BATCH_TILES) and run through one session call, so many
+small concurrent requests cost about as much as one large one. The queue of
+waiting requests is bounded (QUEUE_SIZE): when it is full new requests get an
+immediate 503 with Retry-After instead of piling up latency. Requests still being
+read or decoded count against the same limit, and admission is decided from the
+headers before the body is read, so large bodies cannot pile up memory either. At
+most MAX_CONNECTIONS connections are served at once; further ones get a 503.
+
+    python inference_server.py serve
+    python inference_server.py loadtest --image trap.jpg --concurrency 16 --requests 200
+"""
+
+HOST = "127.0.0.1"
+PORT = 8080
+MAX_WAIT_MS = 10          # latency budget spent waiting for more requests to fill a batch
+MAX_BATCH_TILES = BATCH_SIZE
+QUEUE_SIZE = 64           # requests waiting for inference before answering 503
+PREP_WORKERS = min(8, os.cpu_count() or 1)
+MAX_CONNECTIONS = 256     # open client connections; each may hold up to MAX_BODY while reading
+MAX_BODY = 64 * 1024 * 1024
+METRICS_WINDOW = 60.0     # seconds of history behind throughput and latency percentiles
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class Job:
+    """Tiles of one request waiting for the batcher."""
+
+    def __init__(self, tiles, loop):
+        self.tiles = tiles
+        self.future = loop.create_future()
+        self.enqueued = time.perf_counter()
+
+
+class Metrics:
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.started = time.time()
+        self.counts = {"requests": 0, "completed": 0, "rejected": 0, "errors": 0, "batches": 0, "tiles": 0,
+                       "refused_connections": 0}
+        self.done = deque()      # (finish time, latency s, tiles)
+        self.batches = deque()   # (finish time, tiles in batch, inference s)
+
+    def _trim(self, now):
+        for q in (self.done, self.batches):
+            while q and q[0][0] < now - self.window:
+                q.popleft()
+
+    def request_done(self, latency, tiles):
+        now = time.time()
+        self.counts["completed"] += 1
+        self.done.append((now, latency, tiles))
+        self._trim(now)
+
+    def batch_done(self, tiles, seconds):
+        now = time.time()
+        self.counts["batches"] += 1
+        self.counts["tiles"] += tiles
+        self.batches.append((now, tiles, seconds))
+        self._trim(now)
+
+    def snapshot(self, queue_depth, queued_tiles, preparing, connections):
+        now = time.time()
+        self._trim(now)
+        span = min(self.window, now - self.started) or 1e-9
+        latencies = np.array([d[1] for d in self.done]) * 1000
+        batch_tiles = np.array([b[1] for b in self.batches])
+        return {
+            **self.counts,
+            "queue_depth": queue_depth,
+            "queued_tiles": queued_tiles,
+            "preparing": preparing,
+            "connections": connections,
+            "window_s": round(span, 1),
+            "requests_per_s": round(len(self.done) / span, 2),
+            "tiles_per_s": round(sum(d[2] for d in self.done) / span, 1),
+            "latency_ms": {
+                "p50": round(float(np.percentile(latencies, 50)), 2) if len(latencies) else None,
+                "p99": round(float(np.percentile(latencies, 99)), 2) if len(latencies) else None,
+                "max": round(float(latencies.max()), 2) if len(latencies) else None,
+            },
+            "mean_batch_tiles": round(float(batch_tiles.mean()), 1) if len(batch_tiles) else None,
+            "inference_s_per_tile": (round(sum(b[2] for b in self.batches) / batch_tiles.sum() * 1000, 3)
+                                     if len(batch_tiles) else None),
+        }
+
+
+class InferenceServer:
+    def __init__(self, detector, max_wait_ms=MAX_WAIT_MS, max_batch_tiles=MAX_BATCH_TILES, queue_size=QUEUE_SIZE,
+                 prep_workers=PREP_WORKERS, tile_size=TILE_SIZE, overlap=OVERLAP, target_pixels=TARGET_PIXELS,
+                 max_connections=MAX_CONNECTIONS):
+        self.detector = detector
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_tiles = max_batch_tiles
+        self.queue_size = queue_size
+        self.max_connections = max_connections
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.target_pixels = target_pixels
+        self.prep_pool = ThreadPoolExecutor(max_workers=prep_workers)
+        self.infer_pool = ThreadPoolExecutor(max_workers=1)  # one session.run at a time, ORT threads inside
+        self.metrics = Metrics()
+        self.queue = None
+        self.job_added = None
+        self.queued_tiles = 0
+        self.preparing = 0       # requests admitted but still reading/decoding/tiling
+        self.connections = 0
+
+    # ---- preparation (thread pool) ----
+
+    def _to_input_size(self, tiles):
+        size = self.detector.input_size
+        if tiles.shape[1] == size and tiles.shape[2] == size:
+            return np.ascontiguousarray(tiles)
+        return np.stack([cv2.resize(t, (size, size), interpolation=cv2.INTER_LINEAR) for t in tiles])
+
+    def prepare_image(self, body):
+        img = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("body is not a decodable image")
+        work, scale = resize_to_pixels(img, self.target_pixels)
+        h, w = work.shape[:2]
+        if h < self.tile_size or w < self.tile_size:
+            pad = ((0, max(0, self.tile_size - h)), (0, max(0, self.tile_size - w)), (0, 0))
+            work = np.pad(work, pad)
+        x1, y1 = tile_grid(work.shape[1], work.shape[0], self.tile_size, self.overlap)
+        tiles = self._to_input_size(extract_crops(work, x1, y1, self.tile_size))
+        return tiles, (x1, y1, work.shape[1], work.shape[0], scale, img.shape[1], img.shape[0])
+
+    def prepare_crops(self, body, content_type):
+        if content_type == "application/x-npy" or body[:6] == b"\x93NUMPY":
+            crops = np.load(io.BytesIO(body), allow_pickle=False)
+            if crops.ndim == 3:
+                crops = crops[None]
+        else:
+            img = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+            crops = None if img is None else img[None]
+        if crops is None or crops.ndim != 4 or crops.shape[-1] != 3 or len(crops) == 0:
+            raise ValueError("body must be an image or an N x H x W x 3 uint8 .npy")
+        if crops.dtype != np.uint8:
+            # A cast would silently wrap float/int16 pixel values
+            raise ValueError(f"crops must be uint8, got {crops.dtype}")
+        return self._to_input_size(crops), crops.shape[1:3]
+
+    def finish_image(self, raw, meta):
+        x1, y1, work_w, work_h, scale, img_w, img_h = meta
+        boxes, scores, classes = self.detector.decode(raw, x1, y1, self.tile_size, work_w, work_h)
+        keep = nms(boxes, scores, self.detector.iou_threshold, classes)
+        boxes = boxes[keep] / scale
+        return {"width": img_w, "height": img_h, "tiles": len(x1),
+                "detections": detections_json(boxes, scores[keep], classes[keep])}
+
+    def finish_crops(self, raw, crop_hw):
+        h, w = crop_hw
+        results = []
+        zero = np.zeros(1, dtype=np.int64)
+        for i in range(len(raw)):
+            boxes, scores, classes = self.detector.decode(raw[i:i + 1], zero, zero, self.detector.input_size)
+            keep = nms(boxes, scores, self.detector.iou_threshold, classes)
+            boxes = boxes[keep] * np.array([w, h, w, h]) / self.detector.input_size
+            results.append(detections_json(boxes, scores[keep], classes[keep]))
+        return {"crops": len(raw), "width": w, "height": h, "detections": results}
+
+    # ---- batching ----
+
+    async def submit(self, tiles):
+        """Queues tiles for inference; raises asyncio.QueueFull when the queue is full (-> 503)."""
+        job = Job(tiles, asyncio.get_running_loop())
+        self.queue.put_nowait(job)
+        self.queued_tiles += len(tiles)
+        self.job_added.set()
+        return await job.future
+
+    async def next_job(self, deadline=None):
+        """
+        Next queued job, or None once deadline (perf_counter) has passed. Only the event
+        wait is ever cancelled by the timeout, never a queue.get(), so no job is lost.
+        """
+        while self.queue.empty():
+            timeout = None if deadline is None else deadline - time.perf_counter()
+            if timeout is not None and timeout <= 0:
+                return None
+            self.job_added.clear()
+            try:
+                await asyncio.wait_for(self.job_added.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        job = self.queue.get_nowait()
+        self.queued_tiles -= len(job.tiles)
+        return job
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.next_job()]
+            tiles = len(jobs[0].tiles)
+            deadline = jobs[0].enqueued + self.max_wait
+            while tiles < self.max_batch_tiles:
+                job = await self.next_job(deadline)
+                if job is None:
+                    break
+                jobs.append(job)
+                tiles += len(job.tiles)
+
+            try:
+                batch = np.concatenate([j.tiles for j in jobs]) if len(jobs) > 1 else jobs[0].tiles
+                start = time.perf_counter()
+                raw = await loop.run_in_executor(self.infer_pool, self.detector.infer, batch)
+                self.metrics.batch_done(len(batch), time.perf_counter() - start)
+                offset = 0
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_result(raw[offset:offset + len(job.tiles)])
+                    offset += len(job.tiles)
+            except Exception as e:
+                # Fail this batch only (500, not the client's fault); the loop must keep serving the next ones
+                error = RuntimeError(f"inference batch failed: {e!r}")
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(error)
+
+    def batcher_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[ERROR] Batcher stopped: {task.exception()!r} - shutting down")
+
+    # ---- HTTP ----
+
+    def admit(self):
+        """Reserves a preparing slot for an inference request; False when the queue is full (-> 503)."""
+        self.metrics.counts["requests"] += 1
+        if self.queue.qsize() + self.preparing >= self.queue_size:
+            self.metrics.counts["rejected"] += 1
+            return False
+        self.preparing += 1
+        return True
+
+    async def route(self, method, path, headers, body):
+        """POST /detect and /crops arrive with the slot handle() reserved through admit()."""
+        if path == "/health":
+            return 200, {"status": "ok", "model_input": self.detector.input_size}
+        if path == "/metrics":
+            return 200, self.metrics.snapshot(self.queue.qsize(), self.queued_tiles, self.preparing, self.connections)
+        if path not in ("/detect", "/crops"):
+            return 404, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            try:
+                if path == "/detect":
+                    tiles, meta = await loop.run_in_executor(self.prep_pool, self.prepare_image, body)
+                    finish = self.finish_image
+                else:
+                    tiles, meta = await loop.run_in_executor(
+                        self.prep_pool, self.prepare_crops, body, headers.get("content-type", ""))
+                    finish = self.finish_crops
+            finally:
+                self.preparing -= 1
+            raw = await self.submit(tiles)
+            result = await loop.run_in_executor(self.prep_pool, finish, raw, meta)
+        except asyncio.QueueFull:
+            self.metrics.counts["rejected"] += 1
+            return 503, {"error": "queue full, retry later"}
+        except ValueError as e:
+            self.metrics.counts["errors"] += 1
+            return 400, {"error": str(e)}
+        except Exception as e:
+            self.metrics.counts["errors"] += 1
+            return 500, {"error": repr(e)}
+        latency = time.perf_counter() - start
+        self.metrics.request_done(latency, len(tiles))
+        result["latency_ms"] = round(latency * 1000, 2)
+        return 200, result
+
+    async def handle(self, reader, writer):
+        if self.connections >= self.max_connections:
+            self.metrics.counts["refused_connections"] += 1
+            try:
+                await send_response(writer, 503, {"error": "too many connections, retry later"}, False)
+            except ConnectionError:
+                pass
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    await send_response(writer, 413, {"error": f"body larger than {MAX_BODY} bytes"}, False)
+                    break
+                path = urlsplit(target).path
+                # Admission before the body is read: a rejected request never buffers its body
+                # (the connection is closed instead, as the unread body is still on it)
+                if method == "POST" and path in ("/detect", "/crops") and not self.admit():
+                    await send_response(writer, 503, {"error": "queue full, retry later"}, False)
+                    break
+                try:
+                    body = await reader.readexactly(length) if length else b""
+                except BaseException:
+                    if method == "POST" and path in ("/detect", "/crops"):
+                        self.preparing -= 1
+                    raise
+                status, payload = await self.route(method, path, headers, body)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await send_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def serve(self, host=HOST, port=PORT):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.job_added = asyncio.Event()
+        batcher = asyncio.create_task(self.batcher())
+        batcher.add_done_callback(self.batcher_done)
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"[OK] Serving {self.detector.input_size}px model on http://{host}:{port} "
+              f"(batch <= {self.max_batch_tiles} tiles, wait <= {self.max_wait * 1000:.0f} ms, queue {self.queue_size}, "
+              f"<= {self.max_connections} connections)")
+        serving = asyncio.create_task(server.serve_forever())
+        try:
+            # Without the batcher every request would hang: stop serving if it ever ends
+            await asyncio.wait([serving, batcher], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            serving.cancel()
+            batcher.cancel()
+            server.close()
+        if batcher.done() and not batcher.cancelled() and batcher.exception() is not None:
+            raise SystemExit(1)
+
+
+def detections_json(boxes, scores, classes):
+    return [{"class": int(c), "name": CLASS_NAMES[int(c)] if int(c) < len(CLASS_NAMES) else str(int(c)),
+             "score": round(float(s), 4), "box": [round(float(v), 1) for v in b]}
+            for b, s, c in zip(boxes, scores, classes)]
+
+
+async def send_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode()
+    head = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    if status == 503:
+        head.append("Retry-After: 1")
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+
+# ---- load test (pure asyncio client, localhost) ----
+
+async def http_request(reader, writer, host, method, path, body=b"", content_type="application/octet-stream"):
+    head = (f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, value = line.decode("latin-1").split(":", 1)
+        if key.strip().lower() == "content-length":
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def load_test(host, port, path, body, content_type, concurrency, total):
+    latencies, statuses = [], {}
+    remaining = [total]
+
+    async def worker():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start = time.perf_counter()
+                status, _ = await http_request(reader, writer, host, "POST", path, body, content_type)
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+                elif status == 503:
+                    # The server closes the connection on a 503 (the body was never read)
+                    writer.close()
+                    await asyncio.sleep(0.01)
+                    reader, writer = await asyncio.open_connection(host, port)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    reader, writer = await asyncio.open_connection(host, port)
+    _, metrics = await http_request(reader, writer, host, "GET", "/metrics")
+    writer.close()
+    return np.array(latencies) * 1000, statuses, wall, json.loads(metrics)
+
+
+def load_test_body(image, mode, crops):
+    if image:
+        img = cv2.imread(image)
+        if img is None:
+            raise SystemExit(f"[ERROR] Failed to load {image}")
+    else:
+        # Synthetic yellow trap with dark specks
+        rng = np.random.default_rng(0)
+        size = (TILE_SIZE, TILE_SIZE) if mode == "crops" else (1944, 2592)
+        img = np.empty(size + (3,), np.uint8)
+        img[:] = (40, 200, 220)
+        for x, y in rng.integers(0, min(size), (max(1, size[0] * size[1] // 50000), 2)):
+            cv2.circle(img, (int(x), int(y)), 5, (30, 30, 30), -1)
+    if mode == "crops" and crops > 1:
+        crop = cv2.resize(img, (TILE_SIZE, TILE_SIZE), interpolation=cv2.INTER_AREA)
+        buf = io.BytesIO()
+        np.save(buf, np.repeat(crop[None], crops, axis=0))
+        return buf.getvalue(), "application/x-npy"
+    return cv2.imencode(".jpg", img)[1].tobytes(), "image/jpeg"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-batching HTTP inference server for the 120px model.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve = sub.add_parser("serve", help="load the model once and serve on localhost")
+    serve.add_argument("--model", default=MODEL_PATH)
+    serve.add_argument("--host", default=HOST)
+    serve.add_argument("--port", type=int, default=PORT)
+    serve.add_argument("--threads", type=int, default=NUM_THREADS, help="ONNX Runtime intra-op threads")
+    serve.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    serve.add_argument("--max-batch-tiles", type=int, default=MAX_BATCH_TILES)
+    serve.add_argument("--queue-size", type=int, default=QUEUE_SIZE)
+    serve.add_argument("--prep-workers", type=int, default=PREP_WORKERS)
+    serve.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS)
+    serve.add_argument("--target-pixels", type=int, default=TARGET_PIXELS, help="0 = no rescaling")
+
+    load = sub.add_parser("loadtest", help="hammer a running server from localhost")
+    load.add_argument("--host", default=HOST)
+    load.add_argument("--port", type=int, default=PORT)
+    load.add_argument("--mode", choices=["detect", "crops"], default="crops")
+    load.add_argument("--image", default=None, help="photo or crop to send (default: synthetic)")
+    load.add_argument("--crops", type=int, default=1, help="crops per request in crops mode (sent as .npy)")
+    load.add_argument("--concurrency", type=int, default=32)
+    load.add_argument("--requests", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        detector = TiledDetector(args.model, args.threads, args.max_batch_tiles)
+        server = InferenceServer(detector, args.max_wait_ms, args.max_batch_tiles, args.queue_size,
+                                 args.prep_workers, target_pixels=args.target_pixels or None,
+                                 max_connections=args.max_connections)
+        try:
+            asyncio.run(server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        body, content_type = load_test_body(args.image, args.mode, args.crops)
+        latencies, statuses, wall, metrics = asyncio.run(load_test(
+            args.host, args.port, "/" + args.mode, body, content_type, args.concurrency, args.requests))
+        ok = statuses.get(200, 0)
+        print(f"[INFO] {args.requests} requests, concurrency {args.concurrency}, statuses {statuses}")
+        if ok:
+            print(f"✅ {ok / wall:.1f} req/s | latency p50 {np.percentile(latencies, 50):.1f} ms, "
+                  f"p99 {np.percentile(latencies, 99):.1f} ms | mean batch {metrics['mean_batch_tiles']} tiles")
+        print(json.dumps(metrics, indent=2))
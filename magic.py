@@ -4,15 +4,30 @@ import numpy as np
 import random
 import shutil
 
+import profiling
+from build_cache import BuildCache
+
 base_dir = "sticky_dataset/120px"
 splits = ["train", "val"]
 angles = [90, 180, 270]
 
-def adjust_brightness(img, max_dark=0.2):
-    factor = 1.0 - random.uniform(0, max_dark)
-    return np.clip(img * factor, 0, 255).astype(np.uint8)
+# Rotation matching rotate_bbox_yolo (angles are counterclockwise, like np.rot90)
+CV2_ROTATIONS = {
+    90: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_CLOCKWISE,
+}
+
+def brightness_lut(factor):
+    # uint8 -> uint8 table, same values as np.clip(img * factor, 0, 255).astype(np.uint8)
+    return np.clip(np.arange(256) * factor, 0, 255).astype(np.uint8)
+
+def adjust_brightness(img, max_dark=0.2, rng=random, out=None):
+    factor = 1.0 - rng.uniform(0, max_dark)
+    return np.take(brightness_lut(factor), img, out=out)
 
 def rotate_bbox_yolo(xc, yc, w, h, angle_deg):
+    # Works on scalars and on NumPy arrays of boxes alike
     if angle_deg == 90:
         return yc, 1 - xc, h, w
     elif angle_deg == 180:
@@ -22,73 +37,88 @@ def rotate_bbox_yolo(xc, yc, w, h, angle_deg):
     else:
         return xc, yc, w, h
 
-for split in splits:
-    input_img_dir = os.path.join(base_dir, split, "images")
-    input_lbl_dir = os.path.join(base_dir, split, "labels")
-    output_img_dir = os.path.join(base_dir, split, "images")
-    output_lbl_dir = os.path.join(base_dir, split, "labels")
-    os.makedirs(output_img_dir, exist_ok=True)
-    os.makedirs(output_lbl_dir, exist_ok=True)
-
-    for fname in os.listdir(input_img_dir):
-        if not fname.lower().endswith(('.jpg', '.jpeg', '.png')):
-            continue
-        img_path = os.path.join(input_img_dir, fname)
-        lbl_path = os.path.join(input_lbl_dir, fname.replace('.jpg', '.txt').replace('.jpeg', '.txt').replace('.png', '.txt'))
-        if not os.path.exists(lbl_path):
-            print(f"⚠️ Label not found for {fname}, skipping.")
-            continue
-
-        img = cv2.imread(img_path)
-        if img is None:
-            print(f"⚠️ Error reading image: {img_path}")
-            continue
-        h, w = img.shape[:2]
-        base, ext = os.path.splitext(fname)
-
-        # Copy original (comment out if you don't want to duplicate)
-        shutil.copy(img_path, os.path.join(output_img_dir, f"{base}_orig{ext}"))
-        shutil.copy(lbl_path, os.path.join(output_lbl_dir, f"{base}_orig.txt"))
-
-        # Load labels
-        with open(lbl_path) as f:
-            lines = f.readlines()
-
-        for angle in angles:
-            # Rotate image
-            if angle == 90:
-                rotated_img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
-            elif angle == 180:
-                rotated_img = cv2.rotate(img, cv2.ROTATE_180)
-            elif angle == 270:
-                rotated_img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
-            else:
+if __name__ == "__main__":
+    profiling.install()  # no-op unless STICKY_PROFILE is set (augment_stream imports this module)
+    cache = BuildCache()
+    params = {"angles": angles}
+    # Files written by a previous run live next to the originals: never augment them again
+    augmented = cache.outputs("magic")
+    live_keys = []
+    for split in splits:
+        input_img_dir = os.path.join(base_dir, split, "images")
+        input_lbl_dir = os.path.join(base_dir, split, "labels")
+        output_img_dir = os.path.join(base_dir, split, "images")
+        output_lbl_dir = os.path.join(base_dir, split, "labels")
+        os.makedirs(output_img_dir, exist_ok=True)
+        os.makedirs(output_lbl_dir, exist_ok=True)
+
+        for fname in os.listdir(input_img_dir):
+            if not fname.lower().endswith(('.jpg', '.jpeg', '.png')):
+                continue
+            img_path = os.path.join(input_img_dir, fname)
+            if img_path in augmented:
+                continue
+            lbl_path = os.path.join(input_lbl_dir, fname.replace('.jpg', '.txt').replace('.jpeg', '.txt').replace('.png', '.txt'))
+            if not os.path.exists(lbl_path):
+                print(f"⚠️ Label not found for {fname}, skipping.")
+                continue
+            live_keys.append(img_path)
+            if cache.is_fresh("magic", img_path, [img_path, lbl_path], params):
+                continue
+
+            img = cv2.imread(img_path)
+            if img is None:
+                print(f"⚠️ Error reading image: {img_path}")
                 continue
+            h, w = img.shape[:2]
+            base, ext = os.path.splitext(fname)
+
+            # Copy original (comment out if you don't want to duplicate)
+            outputs = [os.path.join(output_img_dir, f"{base}_orig{ext}"), os.path.join(output_lbl_dir, f"{base}_orig.txt")]
+            with profiling.span("copy_original",
+                                bytes_written=os.path.getsize(img_path) if profiling.enabled() else 0):
+                shutil.copy(img_path, outputs[0])
+                shutil.copy(lbl_path, outputs[1])
 
-            # Rotate bounding boxes
-            rotated_labels = []
-            for line in lines:
-                parts = line.strip().split()
-                if len(parts) != 5:
+            # Load labels
+            with profiling.span("label_read", bytes_read=os.path.getsize(lbl_path) if profiling.enabled() else 0), open(lbl_path) as f:
+                lines = f.readlines()
+
+            for angle in angles:
+                # Rotate image
+                if angle not in CV2_ROTATIONS:
                     continue
-                cls, xc, yc, bw, bh = parts
-                xc, yc, bw, bh = map(float, (xc, yc, bw, bh))
-                rxc, ryc, rbw, rbh = rotate_bbox_yolo(xc, yc, bw, bh, angle)
-                rxc, ryc, rbw, rbh = [min(max(v, 0), 1) for v in (rxc, ryc, rbw, rbh)]
-                rotated_labels.append(f"{cls} {rxc:.6f} {ryc:.6f} {rbw:.6f} {rbh:.6f}")
-
-            # 50% chance to darken
-            if random.random() < 0.5:
-                out_img = adjust_brightness(rotated_img)
-                suffix = f"{angle}_dark"
-            else:
-                out_img = rotated_img
-                suffix = f"{angle}"
-
-            out_img_name = f"{base}_rot{suffix}{ext}"
-            out_lbl_name = f"{base}_rot{suffix}.txt"
-            cv2.imwrite(os.path.join(output_img_dir, out_img_name), out_img)
-            with open(os.path.join(output_lbl_dir, out_lbl_name), "w") as fout:
-                fout.write("\n".join(rotated_labels) + "\n")
-
-print("✅ Augmentation completed for train and val!")
\ No newline at end of file
+                rotated_img = cv2.rotate(img, CV2_ROTATIONS[angle])
+
+                # Rotate bounding boxes
+                rotated_labels = []
+                for line in lines:
+                    parts = line.strip().split()
+                    if len(parts) != 5:
+                        continue
+                    cls, xc, yc, bw, bh = parts
+                    xc, yc, bw, bh = map(float, (xc, yc, bw, bh))
+                    rxc, ryc, rbw, rbh = rotate_bbox_yolo(xc, yc, bw, bh, angle)
+                    rxc, ryc, rbw, rbh = [min(max(v, 0), 1) for v in (rxc, ryc, rbw, rbh)]
+                    rotated_labels.append(f"{cls} {rxc:.6f} {ryc:.6f} {rbw:.6f} {rbh:.6f}")
+
+                # 50% chance to darken
+                if random.random() < 0.5:
+                    out_img = adjust_brightness(rotated_img)
+                    suffix = f"{angle}_dark"
+                else:
+                    out_img = rotated_img
+                    suffix = f"{angle}"
+
+                out_img_name = f"{base}_rot{suffix}{ext}"
+                out_lbl_name = f"{base}_rot{suffix}.txt"
+                cv2.imwrite(os.path.join(output_img_dir, out_img_name), out_img)
+                with profiling.span("label_write"), open(os.path.join(output_lbl_dir, out_lbl_name), "w") as fout:
+                    fout.write("\n".join(rotated_labels) + "\n")
+                outputs += [os.path.join(output_img_dir, out_img_name), os.path.join(output_lbl_dir, out_lbl_name)]
+
+            cache.record("magic", img_path, [img_path, lbl_path], params, outputs)
+
+    cache.evict("magic", live_keys)
+    cache.save()
+    print("✅ Augmentation completed for train and val!")
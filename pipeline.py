@@ -0,0 +1,429 @@
+import os
+import random
+import queue
+import hashlib
+import argparse
+import importlib
+import threading
+import multiprocessing as mp
+import xml.etree.ElementTree as ET
+
+import cv2
+import numpy as np
+import yaml
+
+from annotation_index import open_voc_index
+from crops import (centred_crops, write_shard, crop_filename, pack_split, MIN_VISIBILITY, IMAGES_SUFFIX, LABELS_SUFFIX,
+                   BOXES_SUFFIX)
+from file_links import link_file, imwrite_replace, replace_file
+from image_header import read_image_size
+from magic import adjust_brightness, rotate_bbox_yolo, CV2_ROTATIONS
+from pyramid import imread_reduced, reduction_factor, target_size
+from xml_txt import voc_root_to_boxes
+
+"""
+Single-pass, bounded-memory version of the preparation chain
+
+    fix_dataset.py -> xml_txt.py -> 16mpx.py -> 5mpx.py/pyramid.py -> 120px.py -> magic.py
+
+Each source photo is decoded once - at reduced resolution when no full-size
+artefact is asked for - and flows through generator stages in memory:
+
+    decode (+ orientation fix) -> VOC to YOLO -> split -> resize -> crops -> augment -> write
+
+A resized photo is JPEG-encoded once and decoded again before cropping, so the
+crops see the pixels 120px.py reads from the 5mpx file. They differ from the
+script chain only where the chain decodes differently: with 16mpx emitted the
+photo is decoded at full size (pyramid.py may use a reduced decode), and
+fix_dataset.py without jpegtran re-encodes the photos it rotates.
+
+Only the artefacts named with --emit are written (16mpx, 5mpx, 120px shards + packed split,
+augmented crops in the magic.py layout); nothing else touches the disk. The split
+is decided up front from the class counts of the annotation index, with the same
+stratification as 16mpx.py. Files of earlier runs that this run did not write
+(a photo that moved to the other split, or was removed) are deleted at the end.
+
+Worker processes take photo paths from a bounded queue and report back through
+another. Images never cross a process boundary: each worker runs the whole stage
+chain on its photo. Before decoding, a worker reserves the estimated size of the
+photo's pixel buffers from a shared MAX_INFLIGHT_MB budget, and releases it once
+the photo is written. Peak image memory therefore stays under the budget however
+many workers run - set it to what the gateway can spare:
+
+    python pipeline.py --emit 120px augmented --max-inflight-mb 256 --workers 2
+"""
+
+SRC_DIR = "sticky_dataset/stickytraps"
+OUT_ROOT = "sticky_dataset"
+ARTEFACTS = ["16mpx", "5mpx", "120px", "augmented"]
+RESIZE_PIXELS = 5_000_000        # 5mpx.py, and the source of the 120px crops
+CROP_SIZE = 120
+NEIGHBOUR_LABELS = True
+AUGMENT_ANGLES = [90, 180, 270]
+DARK_PROB = 0.5
+SEED = 0
+NUM_WORKERS = os.cpu_count() or 1
+MAX_INFLIGHT_MB = 512
+QUEUE_SIZE = 8                   # photo paths waiting per worker
+
+# 16mpx.py owns the split rules and the class list (its name is not a valid identifier)
+split_rules = importlib.import_module("16mpx")
+
+
+class MemoryBudget:
+    """Megabytes of image buffers that may be alive at once, shared by all workers."""
+
+    def __init__(self, megabytes):
+        self.megabytes = max(1, int(megabytes))
+        self.units = mp.Semaphore(self.megabytes)
+        self.lock = mp.Lock()  # one reservation at a time, so two workers never deadlock half-way
+        self.held = 0          # units reserved by this process
+
+    def cost(self, nbytes):
+        return min(self.megabytes, max(1, -(-int(nbytes) // 2**20)))
+
+    def acquire(self, units):
+        with self.lock:
+            for _ in range(units):
+                self.units.acquire()
+        self.held += units
+
+    def release_held(self):
+        """Gives back everything this process reserved (the photo is done, or failed half-way)."""
+        for _ in range(self.held):
+            self.units.release()
+        self.held = 0
+
+
+def plan_split(src_dir, workers):
+    """{image file: "train" | "val"}, stratified like 16mpx.py."""
+    index = open_voc_index(src_dir, num_workers=workers)
+    nc = len(split_rules.CLASSES)
+    counts = np.zeros((len(index), nc))
+    for image_id in range(len(index)):
+        cls = index.boxes(image_id)[:, 0].astype(np.int64)
+        counts[image_id] = np.bincount(cls[cls < nc], minlength=nc)
+    names = [str(n) for n in index.images]
+    if split_rules.STRATIFY:
+        return split_rules.stratified_split(names, counts)
+    return {f: split_rules.split_of(f) for f in names}
+
+
+# ---- stages: each takes and yields sample dicts ----
+
+def decode_stage(tasks, config, budget):
+    """Reduced decode at the largest size any requested artefact needs, portrait photos turned to landscape."""
+    for img_path, split in tasks:
+        size = read_image_size(img_path)
+        if size is None:
+            yield {"path": img_path, "error": "unreadable header"}
+            continue
+        h, w = size
+        portrait = h > w
+        land_w, land_h = (h, w) if portrait else (w, h)
+        out_w, out_h = target_size(land_w, land_h, config["resize_pixels"])
+        need_w, need_h = (land_w, land_h) if "16mpx" in config["emit"] else (out_w, out_h)
+        if portrait:
+            need_w, need_h = need_h, need_w
+        # Reserve what is actually decoded - the DCT scaling often cannot reach the target
+        # (16MP -> 5MP decodes at full size) - twice while cv2.rotate holds both, plus the resized copy
+        factor = reduction_factor(w, h, need_w, need_h, img_path.lower().endswith((".jpg", ".jpeg")))
+        decoded = -(-w // factor) * -(-h // factor)
+        budget.acquire(budget.cost(3 * ((2 if portrait else 1) * decoded + out_w * out_h)))
+        img = imread_reduced(img_path, need_w, need_h, size)
+        if img is None:
+            budget.release_held()
+            yield {"path": img_path, "error": "decode failed"}
+            continue
+        if portrait:
+            img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)  # as fix_dataset.py
+        sample = {"path": img_path, "split": split, "img": img, "size": (land_w, land_h), "rotated": portrait,
+                  "written": []}
+        img = None  # the sample owns the photo: resize_stage can free the full-size copy
+        yield sample
+
+
+def convert_stage(samples):
+    """VOC XML next to the photo -> normalised YOLO labels for the landscape image."""
+    for s in samples:
+        if "error" not in s:
+            xml_path = os.path.splitext(s["path"])[0] + ".xml"
+            boxes = []
+            if os.path.exists(xml_path):
+                try:
+                    boxes = voc_root_to_boxes(ET.parse(xml_path).getroot(), s["size"][0], s["size"][1], xml_path, False)
+                except ET.ParseError as e:
+                    print(f"[WARN] Failed to parse XML: {xml_path}: {e}")
+            # Rounded like the .txt round trip of xml_txt.py, so crops match 120px.py exactly
+            s["labels"] = np.array([[b[0]] + [float(f"{v:.6f}") for v in b[1:5]] for b in boxes],
+                                   dtype=np.float64).reshape(-1, 5)
+            # xml_txt.py writes the valid boxes as consecutive lines: box i is line i of the .txt
+            s["line_idx"] = np.arange(len(boxes), dtype=np.int32)
+        yield s
+
+
+def full_size_stage(samples, config):
+    """16mpx artefact: the source bytes are linked when the photo needed no rotation."""
+    for s in samples:
+        if "error" not in s and "16mpx" in config["emit"]:
+            name = os.path.basename(s["path"])
+            out_dir = os.path.join(config["out_root"], "16mpx")
+            img_path = os.path.join(out_dir, "images", s["split"], name)
+            if s["rotated"]:
+                # An earlier run may have linked img_path to the source: never write through it
+                if not imwrite_replace(img_path, s["img"]):
+                    raise OSError(f"cannot write {img_path}")
+            else:
+                link_file(s["path"], img_path)
+            s["written"] += [img_path, write_labels(out_dir, s["split"], name, s["labels"])]
+        yield s
+
+
+def resize_stage(samples, config):
+    """
+    5mpx artefact. A resized photo is encoded once, and the crops are cut from that
+    encoding decoded again - the pixels 120px.py reads back from the 5mpx file.
+    """
+    emit = config["emit"]
+    for s in samples:
+        if "error" not in s:
+            w, h = target_size(*s["size"], config["resize_pixels"])
+            name = os.path.basename(s["path"])
+            img_path = os.path.join(config["out_root"], "5mpx", "images", s["split"], name)
+            if (w, h) != s["size"]:
+                if s["img"].shape[1] != w or s["img"].shape[0] != h:
+                    s["img"] = cv2.resize(s["img"], (w, h), interpolation=cv2.INTER_AREA)
+                ok, encoded = cv2.imencode(os.path.splitext(name)[1], s["img"])
+                if not ok:
+                    raise OSError(f"cannot encode {img_path}")
+                if "5mpx" in emit:
+                    replace_file(img_path, encoded)  # an earlier run may have linked img_path to the source
+                if emit & {"120px", "augmented"}:
+                    s["img"] = None
+                    s["img"] = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+            elif "5mpx" in emit:
+                # Not smaller than the target: pyramid.py keeps the original bytes
+                if not s["rotated"]:
+                    link_file(s["path"], img_path)
+                elif not imwrite_replace(img_path, s["img"]):
+                    raise OSError(f"cannot write {img_path}")
+            if "5mpx" in emit:
+                s["written"] += [img_path, write_labels(os.path.join(config["out_root"], "5mpx"), s["split"], name,
+                                                        s["labels"])]
+        yield s
+
+
+def crop_stage(samples, config):
+    """120px.py on the resized image; the 120px artefact is the packed shard."""
+    for s in samples:
+        if "error" not in s:
+            crops, crop_labels = centred_crops(s["img"], s["labels"], config["crop_size"], NEIGHBOUR_LABELS,
+                                               MIN_VISIBILITY)
+            s["img"] = None  # the crops are copies, the photo can go
+            s["crops"], s["crop_labels"] = crops, crop_labels
+            if crops is not None and "120px" in config["emit"]:
+                name = os.path.splitext(os.path.basename(s["path"]))[0]
+                shard_dir = os.path.join(config["out_root"], "120px", s["split"], "shards")
+                write_shard(shard_dir, name, crops, crop_labels, s["line_idx"])
+                s["written"] += [os.path.join(shard_dir, name + suffix) for suffix in (IMAGES_SUFFIX, LABELS_SUFFIX, BOXES_SUFFIX)]
+        yield s
+
+
+def augment_stage(samples, config):
+    """magic.py on every crop: _orig plus the rotations, half of them darkened; seeded per photo."""
+    for s in samples:
+        if "error" not in s and s.get("crops") is not None and "augmented" in config["emit"]:
+            name = os.path.splitext(os.path.basename(s["path"]))[0]
+            rng = random.Random(int.from_bytes(hashlib.blake2b(f"{config['seed']}:{name}".encode(),
+                                                               digest_size=8).digest(), "big"))
+            out_dir = os.path.join(config["out_root"], "120px", s["split"])
+            crop_labels = s["crop_labels"]
+            starts = np.searchsorted(crop_labels[:, 0], np.arange(len(s["crops"]) + 1))
+            for i, crop in enumerate(s["crops"]):
+                rows = crop_labels[starts[i]:starts[i + 1], 1:]
+                base = os.path.splitext(crop_filename(name, s["line_idx"][i], rows[0, 0]))[0]
+                s["written"] += write_crop(out_dir, f"{base}_orig", crop, rows)
+                for angle in AUGMENT_ANGLES:
+                    rotated = cv2.rotate(crop, CV2_ROTATIONS[angle])
+                    labels = rows.copy()
+                    labels[:, 1:] = np.clip(np.column_stack(rotate_bbox_yolo(*rows[:, 1:].T, angle)), 0, 1)
+                    if rng.random() < DARK_PROB:
+                        s["written"] += write_crop(out_dir, f"{base}_rot{angle}_dark", adjust_brightness(rotated, rng=rng), labels)
+                    else:
+                        s["written"] += write_crop(out_dir, f"{base}_rot{angle}", rotated, labels)
+        yield s
+
+
+def write_labels(out_dir, split, img_file, labels):
+    path = os.path.join(out_dir, "labels", split, os.path.splitext(img_file)[0] + ".txt")
+    with open(path, "w") as f:
+        f.write("\n".join(f"{int(c)} {xc:.6f} {yc:.6f} {bw:.6f} {bh:.6f}" for c, xc, yc, bw, bh in labels))
+    return path
+
+
+def write_crop(out_dir, base, img, labels):
+    img_path = os.path.join(out_dir, "images", base + ".jpg")
+    label_path = os.path.join(out_dir, "labels", base + ".txt")
+    cv2.imwrite(img_path, img)
+    with open(label_path, "w") as f:
+        f.write("\n".join(f"{int(c)} {xc:.6f} {yc:.6f} {bw:.6f} {bh:.6f}" for c, xc, yc, bw, bh in labels) + "\n")
+    return [img_path, label_path]
+
+
+def build_stages(tasks, config, budget):
+    """Chains only the stages the deepest requested artefact needs."""
+    emit = config["emit"]
+    samples = convert_stage(decode_stage(tasks, config, budget))
+    samples = full_size_stage(samples, config)
+    if emit & {"5mpx", "120px", "augmented"}:
+        samples = resize_stage(samples, config)
+    if emit & {"120px", "augmented"}:
+        samples = crop_stage(samples, config)
+    if "augmented" in emit:
+        samples = augment_stage(samples, config)
+    return samples
+
+
+def worker(task_queue, result_queue, config, budget):
+    """Runs the stage chain photo by photo; a failing photo is reported and the worker moves on."""
+    try:
+        for task in iter(task_queue.get, None):
+            try:
+                for s in build_stages([task], config, budget):
+                    n_crops = len(s["crops"]) if s.get("crops") is not None else 0
+                    result_queue.put((s["path"], s.get("error"), len(s.get("labels", ())), n_crops,
+                                      s.get("written", [])))
+            except Exception as e:
+                result_queue.put((task[0], f"{type(e).__name__}: {e}", 0, 0, []))
+            finally:
+                budget.release_held()
+    finally:
+        result_queue.put(None)
+
+
+def output_dirs(out_root, emit):
+    """Every folder the requested artefacts are written to."""
+    dirs = []
+    for split in ["train", "val"]:
+        for name in sorted({"16mpx", "5mpx"} & emit):
+            dirs += [os.path.join(out_root, name, kind, split) for kind in ("images", "labels")]
+        if "120px" in emit:
+            dirs.append(os.path.join(out_root, "120px", split, "shards"))
+        if "augmented" in emit:
+            dirs += [os.path.join(out_root, "120px", split, kind) for kind in ("images", "labels")]
+    return dirs
+
+
+def make_dirs(out_root, emit):
+    for d in output_dirs(out_root, emit):
+        os.makedirs(d, exist_ok=True)
+
+
+def remove_stale(out_root, emit, written):
+    """
+    Deletes files of earlier runs that this run did not write - photos that moved to
+    the other split, were removed from the source, or lost boxes (16mpx.py sync_dir).
+    """
+    written = {os.path.normpath(p) for p in written}
+    removed = 0
+    for d in output_dirs(out_root, emit):
+        for fname in os.listdir(d):
+            path = os.path.normpath(os.path.join(d, fname))
+            if path not in written and (os.path.isfile(path) or os.path.islink(path)):
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def write_yaml(out_root, emit):
+    for name in {"16mpx", "5mpx"} & emit:
+        dst_dir = os.path.join(out_root, name)
+        yaml_dict = {"train": os.path.abspath(os.path.join(dst_dir, "images/train")),
+                     "val": os.path.abspath(os.path.join(dst_dir, "images/val")),
+                     "nc": len(split_rules.CLASSES), "names": split_rules.CLASSES}
+        with open(os.path.join(dst_dir, "dataset.yaml"), "w") as f:
+            yaml.dump(yaml_dict, f, sort_keys=False)
+
+
+def run(src_dir=SRC_DIR, out_root=OUT_ROOT, emit=("120px",), workers=NUM_WORKERS, max_inflight_mb=MAX_INFLIGHT_MB,
+        resize_pixels=RESIZE_PIXELS, crop_size=CROP_SIZE, seed=SEED):
+    emit = set(emit)
+    splits = plan_split(src_dir, workers)
+    tasks = [(os.path.join(src_dir, f), s) for f, s in sorted(splits.items())]
+    print(f"[INFO] {len(tasks)} photos ({sum(s == 'train' for _, s in tasks)} train), emitting {', '.join(sorted(emit))}, "
+          f"{workers} workers, {max_inflight_mb} MB in flight")
+    make_dirs(out_root, emit)
+    config = {"emit": emit, "out_root": out_root, "resize_pixels": resize_pixels, "crop_size": crop_size, "seed": seed}
+
+    budget = MemoryBudget(max_inflight_mb)
+    task_queue = mp.Queue(maxsize=QUEUE_SIZE * workers)
+    result_queue = mp.Queue(maxsize=QUEUE_SIZE * workers)
+    procs = [mp.Process(target=worker, args=(task_queue, result_queue, config, budget), daemon=True)
+             for _ in range(workers)]
+    for p in procs:
+        p.start()
+
+    def feed():
+        for task in tasks:
+            task_queue.put(task)
+        for _ in procs:
+            task_queue.put(None)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    done = boxes = crops = failed = 0
+    written = []
+    running = len(procs)
+    aborted = False
+    while running:
+        try:
+            result = result_queue.get(timeout=1)
+        except queue.Empty:
+            # A worker killed from outside (OOM, signal) never posts its sentinel and keeps its budget
+            if any(p.exitcode for p in procs) or not any(p.is_alive() for p in procs):
+                aborted = True
+                break
+            continue
+        if result is None:
+            running -= 1
+            continue
+        path, error, n_boxes, n_crops, paths = result
+        done += 1
+        if error:
+            failed += 1
+            print(f"[WARN] {path}: {error}")
+        boxes += n_boxes
+        crops += n_crops
+        written += paths
+        if done % 100 == 0:
+            print(f"[INFO] {done}/{len(tasks)} photos")
+
+    if aborted:
+        for p in procs:
+            if p.exitcode:
+                print(f"[ERROR] Worker {p.pid} exited with code {p.exitcode}")
+            p.terminate()
+        raise SystemExit(f"[ERROR] Aborted after {done}/{len(tasks)} photos; earlier outputs were left in place")
+    feeder.join()
+    for p in procs:
+        p.join()
+    removed = remove_stale(out_root, emit, written)
+    if "120px" in emit:
+        for split in ["train", "val"]:
+            pack_split(os.path.join(out_root, "120px", split))
+    write_yaml(out_root, emit)
+    print(f"✅ {done - failed} photos, {boxes} boxes, {crops} crops, {len(written)} outputs written, "
+          f"{removed} stale files removed ({failed} failed)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the preparation chain in one pass, writing only the chosen artefacts.")
+    parser.add_argument("--src", default=SRC_DIR, help="photos + VOC XMLs")
+    parser.add_argument("--out-root", default=OUT_ROOT)
+    parser.add_argument("--emit", nargs="+", choices=ARTEFACTS, default=["120px"])
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS)
+    parser.add_argument("--max-inflight-mb", type=int, default=MAX_INFLIGHT_MB,
+                        help="image buffers alive at once over all workers")
+    parser.add_argument("--seed", type=int, default=SEED, help="augmentation seed")
+    args = parser.parse_args()
+    run(args.src, args.out_root, args.emit, args.workers, args.max_inflight_mb, seed=args.seed)
@@ -0,0 +1,270 @@
+import os
+import glob
+import hashlib
+import argparse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from annotation_index import open_voc_index, open_yolo_index, VOC_DIR
+from build_cache import BuildCache, params_hash
+from image_header import read_image_size
+from pyramid import imread_reduced
+from xml_txt import ABBR_TO_CLASS, CLASSES, voc_size
+
+"""
+Batch annotation previews: print.py / print_90.py for a whole dataset.
+
+Every selected image is decoded at reduced resolution (JPEG DCT scaling, see
+pyramid.imread_reduced) to PREVIEW_WIDTH, its boxes are drawn on a process pool,
+and the previews are laid out in contact sheets of SHEET_COLS x SHEET_ROWS.
+
+Previews are cached by content: the file name is a hash of the image content,
+the annotation content and the drawing settings (file hashes are memoised in the
+build cache by size/mtime), so after fixing a few annotations only those images
+are redrawn and the sheets are re-assembled from cached thumbnails.
+
+VOC annotations are drawn from the raw XML coordinates, so boxes of a rotated
+image land in the wrong place exactly as print_90.py shows.
+
+    python preview.py                                     # sticky_dataset/stickytraps, VOC
+    python preview.py --classes Thysanoptera --min-boxes 1
+    python preview.py --mismatch                          # images whose annotations do not fit their orientation
+    python preview.py --yolo sticky_dataset/16mpx/images/val sticky_dataset/16mpx/labels/val
+"""
+
+PREVIEW_WIDTH = 1024
+SHEET_COLS = 6
+SHEET_ROWS = 4
+TILE_WIDTH = 320
+TILE_HEIGHT = 240
+CAPTION_HEIGHT = 22
+CACHE_DIR = "images/.preview_cache"
+OUTPUT_DIR = "images/previews"
+NUM_WORKERS = os.cpu_count() or 1
+
+# BGR colour per class (xml_txt.CLASSES order), grey for unknown names
+CLASS_COLORS = [(0, 0, 255), (255, 0, 0), (0, 200, 0), (0, 200, 255)]
+UNKNOWN_COLOR = (160, 160, 160)
+RENDER_VERSION = 1  # bump when the drawing changes, to invalidate the cached previews
+
+
+def voc_pixel_boxes(xml_path):
+    """Raw VOC boxes as written by the annotator: (k, 4) xyxy pixels and class ids (-1 = unknown name)."""
+    root = ET.parse(xml_path).getroot()
+    boxes, classes = [], []
+    for obj in root.findall("object"):
+        bbox = obj.find("bndbox")
+        boxes.append([float(bbox.find(k).text) for k in ("xmin", "ymin", "xmax", "ymax")])
+        name = ABBR_TO_CLASS.get(obj.find("name").text)
+        classes.append(CLASSES.index(name) if name else -1)
+    return np.array(boxes, dtype=np.float64).reshape(-1, 4), np.array(classes, dtype=np.int64), voc_size(root)
+
+
+def orientation_mismatch(task):
+    """
+    True when a VOC annotation does not fit the image as cv2 sees it: the <size>
+    is the image size transposed, or boxes reach past the right/bottom edge.
+    (YOLO labels store no pixel size; there a portrait image is the mismatch.)
+    """
+    img_path, ann_path = task
+    size = read_image_size(img_path)
+    if size is None or not os.path.exists(ann_path):
+        return False
+    h, w = size
+    try:
+        boxes, _, voc_hw = voc_pixel_boxes(ann_path)
+    except (ET.ParseError, AttributeError, TypeError, ValueError):
+        return False
+    if voc_hw is not None and voc_hw != (h, w) and voc_hw == (w, h):
+        return True
+    return bool(len(boxes)) and bool(boxes[:, 2].max() > w or boxes[:, 3].max() > h)
+
+
+def draw_boxes(img, boxes, classes, thickness=2):
+    for (x1, y1, x2, y2), cls in zip(np.round(boxes).astype(int), classes):
+        color = CLASS_COLORS[cls % len(CLASS_COLORS)] if cls >= 0 else UNKNOWN_COLOR
+        cv2.rectangle(img, (x1, y1), (x2, y2), color, thickness)
+    return img
+
+
+def render_preview(task):
+    """Worker: reduced decode + overlay, written atomically to out_path. Returns (out_path, error)."""
+    img_path, ann_path, labels, out_path, width = task
+    size = read_image_size(img_path)
+    if size is None:
+        return out_path, "unreadable image"
+    h, w = size
+    scale = width / w
+    th = max(1, round(h * scale))
+    img = imread_reduced(img_path, width, th, size)
+    if img is None:
+        return out_path, "decode failed"
+    img = cv2.resize(img, (width, th), interpolation=cv2.INTER_AREA)
+
+    if ann_path.endswith(".xml"):
+        boxes, classes = np.zeros((0, 4)), np.zeros(0, np.int64)
+        if os.path.exists(ann_path):
+            try:
+                boxes, classes, _ = voc_pixel_boxes(ann_path)
+            except (ET.ParseError, AttributeError, TypeError, ValueError) as e:
+                return out_path, f"bad XML: {e}"
+        boxes = boxes * scale
+    else:
+        xc, yc, bw, bh = (labels[:, i] for i in range(1, 5))
+        boxes = np.stack([(xc - bw / 2) * width, (yc - bh / 2) * th, (xc + bw / 2) * width, (yc + bh / 2) * th], axis=1)
+        classes = labels[:, 0].astype(np.int64)
+    draw_boxes(img, boxes, classes)
+
+    tmp_path = out_path + ".tmp.jpg"
+    cv2.imwrite(tmp_path, img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    os.replace(tmp_path, out_path)
+    return out_path, None
+
+
+def preview_key(cache, img_path, ann_path, width):
+    """Cache file name: content hashes of image and annotation plus the drawing settings."""
+    settings = params_hash({"width": width, "colors": CLASS_COLORS, "version": RENDER_VERSION})
+    blob = f"{cache.file_hash(img_path)}:{cache.file_hash(ann_path)}:{settings}".encode()
+    return hashlib.blake2b(blob, digest_size=16).hexdigest()
+
+
+def select(index, classes=None, min_boxes=None, max_boxes=None):
+    """Image ids of the index passing the class / box-count filters."""
+    keep = np.ones(len(index), dtype=bool)
+    per_image = index.boxes_per_image()
+    if min_boxes is not None:
+        keep &= per_image >= min_boxes
+    if max_boxes is not None:
+        keep &= per_image <= max_boxes
+    if classes:
+        wanted = np.isin(np.asarray(index.cls), classes)
+        has_class = np.zeros(len(index), dtype=bool)
+        has_class[np.asarray(index.image)[wanted]] = True
+        keep &= has_class
+    return np.flatnonzero(keep)
+
+
+def fit_tile(img, tile_w, tile_h):
+    """Letterboxes img into a tile_w x tile_h dark tile."""
+    tile = np.full((tile_h, tile_w, 3), 32, dtype=np.uint8)
+    scale = min(tile_w / img.shape[1], tile_h / img.shape[0])
+    w, h = max(1, int(img.shape[1] * scale)), max(1, int(img.shape[0] * scale))
+    x, y = (tile_w - w) // 2, (tile_h - h) // 2
+    tile[y:y + h, x:x + w] = cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+    return tile
+
+
+def contact_sheet(entries, cols=SHEET_COLS, tile_w=TILE_WIDTH, tile_h=TILE_HEIGHT):
+    """entries: list of (preview path, caption, highlight). Returns one BGR sheet."""
+    rows = -(-len(entries) // cols)
+    cell_h = tile_h + CAPTION_HEIGHT
+    sheet = np.full((rows * cell_h, cols * tile_w, 3), 16, dtype=np.uint8)
+    for i, (path, caption, highlight) in enumerate(entries):
+        x, y = (i % cols) * tile_w, (i // cols) * cell_h
+        img = cv2.imread(path)
+        if img is not None:
+            sheet[y + 1:y + tile_h - 1, x + 1:x + tile_w - 1] = fit_tile(img, tile_w - 2, tile_h - 2)
+        color = (0, 0, 255) if highlight else (230, 230, 230)
+        cv2.putText(sheet, caption, (x + 4, y + tile_h + 16), cv2.FONT_HERSHEY_SIMPLEX, 0.45, color, 1, cv2.LINE_AA)
+    return sheet
+
+
+def run(img_dir, ann_dir, index, fmt, out_dir=OUTPUT_DIR, cache_dir=CACHE_DIR, classes=None, min_boxes=None,
+        max_boxes=None, mismatch_only=False, width=PREVIEW_WIDTH, num_workers=NUM_WORKERS):
+    ids = select(index, classes, min_boxes, max_boxes)
+    names = [str(index.images[i]) for i in ids]
+    ext = ".xml" if fmt == "voc" else ".txt"
+    pairs = [(os.path.join(img_dir, n), os.path.join(ann_dir, os.path.splitext(n)[0] + ext)) for n in names]
+
+    pool = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    try:
+        run_map = pool.map if pool else map
+        if fmt == "voc":
+            # XML <size> and raw coordinates against the image header, one small read each
+            chunksize = max(1, len(pairs) // (num_workers * 8))
+            flags = list(pool.map(orientation_mismatch, pairs, chunksize=chunksize) if pool
+                         else map(orientation_mismatch, pairs))
+        else:
+            flags = [bool(index.height[i] > index.width[i]) for i in ids]
+        if mismatch_only:
+            keep = [i for i, flag in enumerate(flags) if flag]
+            ids, names, pairs, flags = ids[keep], [names[i] for i in keep], [pairs[i] for i in keep], [flags[i] for i in keep]
+        print(f"[INFO] {len(pairs)} of {len(index)} images selected")
+
+        cache = BuildCache()
+        cache.prime([p for pair in pairs for p in pair if os.path.exists(p)], num_workers)
+        # One cache folder per source, so a full run can drop the previews it no longer uses
+        cache_dir = os.path.join(cache_dir, params_hash([os.path.abspath(img_dir), os.path.abspath(ann_dir)])[:12])
+        os.makedirs(cache_dir, exist_ok=True)
+        tasks, previews = [], []
+        for image_id, (img_path, ann_path) in zip(ids, pairs):
+            out_path = os.path.join(cache_dir, preview_key(cache, img_path, ann_path, width) + ".jpg")
+            previews.append(out_path)
+            if not os.path.exists(out_path):
+                labels = index.boxes(image_id) if fmt == "yolo" else None
+                tasks.append((img_path, ann_path, labels, out_path, width))
+        cache.save()
+        print(f"[INFO] {len(tasks)} previews to draw, {len(pairs) - len(tasks)} cached")
+        failed = set()
+        for out_path, error in run_map(render_preview, tasks):
+            if error:
+                print(f"[WARN] {out_path}: {error}")
+                failed.add(out_path)
+    finally:
+        if pool:
+            pool.shutdown()
+
+    if not classes and min_boxes is None and max_boxes is None and not mismatch_only:
+        # Full run: previews of changed or removed images are no longer referenced
+        live = set(previews)
+        for path in glob.glob(os.path.join(cache_dir, "*.jpg")):
+            if path not in live:
+                os.remove(path)
+
+    os.makedirs(out_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(out_dir, "sheet_*.jpg")):
+        os.remove(path)
+    per_sheet = SHEET_COLS * SHEET_ROWS
+    n_boxes = index.boxes_per_image()
+    entries = [(p, f"{os.path.splitext(n)[0]}  {int(n_boxes[i])} boxes" + ("  ROT?" if flag else ""), flag)
+               for p, n, i, flag in zip(previews, names, ids, flags) if p not in failed]
+    listing = []
+    for s in range(0, len(entries), per_sheet):
+        sheet_path = os.path.join(out_dir, f"sheet_{s // per_sheet:03d}.jpg")
+        cv2.imwrite(sheet_path, contact_sheet(entries[s:s + per_sheet]), [cv2.IMWRITE_JPEG_QUALITY, 85])
+        listing += [f"{os.path.basename(sheet_path)}\t{caption}" for _, caption, _ in entries[s:s + per_sheet]]
+    with open(os.path.join(out_dir, "sheets.txt"), "w") as f:
+        f.write("\n".join(listing) + "\n")
+    n_sheets = -(-len(entries) // per_sheet)
+    print(f"✅ {len(entries)} previews in {n_sheets} contact sheets under {out_dir} "
+          f"({sum(flags)} with an orientation mismatch)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Contact sheets of annotation previews for a whole dataset.")
+    parser.add_argument("--voc", default=None, help="folder of image + VOC XML pairs (default: %s)" % VOC_DIR)
+    parser.add_argument("--yolo", nargs=2, metavar=("IMG_DIR", "LABEL_DIR"), default=None)
+    parser.add_argument("--classes", nargs="+", default=None, help="only images with any of these classes (names or ids)")
+    parser.add_argument("--min-boxes", type=int, default=None)
+    parser.add_argument("--max-boxes", type=int, default=None)
+    parser.add_argument("--mismatch", action="store_true", help="only images whose annotations do not fit their orientation")
+    parser.add_argument("--width", type=int, default=PREVIEW_WIDTH, help="preview width in pixels")
+    parser.add_argument("--out", default=OUTPUT_DIR)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS)
+    args = parser.parse_args()
+
+    classes = None
+    if args.classes:
+        classes = [int(c) if c.isdigit() else CLASSES.index(ABBR_TO_CLASS.get(c, c)) for c in args.classes]
+    if args.yolo:
+        img_dir, ann_dir = args.yolo
+        index, fmt = open_yolo_index(img_dir, ann_dir, num_workers=args.workers), "yolo"
+    else:
+        img_dir = ann_dir = args.voc or VOC_DIR
+        index, fmt = open_voc_index(img_dir, num_workers=args.workers), "voc"
+    run(img_dir, ann_dir, index, fmt, args.out, args.cache_dir, classes, args.min_boxes, args.max_boxes,
+        args.mismatch, args.width, args.workers)
@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import glob
+import time
+import atexit
+import argparse
+
+"""
+Opt-in profiling of the dataset scripts: where does the time of a run go?
+
+Off unless the STICKY_PROFILE environment variable is set, and then install()
+does nothing at all - no wrappers, and span()/count() return immediately. With
+it set (to 1, or to an output directory) install() wraps the hot calls
+
+    cv2.imread / imdecode / resize / rotate / imwrite / imencode, ET.parse
+
+with timers, scripts mark their own sections (label I/O, shard writes) with
+`with profiling.span("name", bytes_read=...)`, and bytes read/written plus RSS
+are tracked. Every process - including ProcessPoolExecutor workers, which
+re-import the script - writes its events on exit; the main process merges them
+into a Chrome trace (chrome://tracing or https://ui.perfetto.dev) and prints a
+summary table:
+
+    STICKY_PROFILE=1 python 120px.py
+    python profiling.py profiles/120px-<timestamp>-<pid>   # re-print a summary later
+"""
+
+ENV_VAR = "STICKY_PROFILE"
+RUN_ENV_VAR = "STICKY_PROFILE_RUN"
+DEFAULT_DIR = "profiles"
+RSS_EVERY = 200  # events between RSS samples in the trace
+
+_state = None
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enabled():
+    return _state is not None
+
+
+class _Span:
+    def __init__(self, name, bytes_read, bytes_written):
+        self.name = name
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, time.perf_counter_ns(), self.bytes_read, self.bytes_written)
+        return False
+
+
+def span(name, bytes_read=0, bytes_written=0):
+    """Times a block: `with span("label_write", bytes_written=n): ...`. Free when profiling is off."""
+    if _state is None:
+        return _NULL_SPAN
+    return _Span(name, bytes_read, bytes_written)
+
+
+def count(name, n=1):
+    if _state is not None:
+        _state["counters"][name] = _state["counters"].get(name, 0) + n
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def _proc_io():
+    """(read_bytes, write_bytes) that hit the storage layer, Linux only."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["read_bytes"]), int(fields["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def record(name, start_ns, end_ns, bytes_read=0, bytes_written=0):
+    state = _state
+    if state is None:
+        return
+    event = {"name": name, "ph": "X", "pid": os.getpid(), "tid": 0,
+             "ts": (start_ns - state["t0_ns"]) / 1000 + state["offset_us"], "dur": (end_ns - start_ns) / 1000}
+    if bytes_read or bytes_written:
+        event["args"] = {"bytes_read": bytes_read, "bytes_written": bytes_written}
+    state["events"].append(event)
+    if len(state["events"]) % RSS_EVERY == 0:
+        rss = _rss_mb()
+        if rss is not None:
+            state["events"].append({"name": "rss_mb", "ph": "C", "pid": os.getpid(), "tid": 0,
+                                    "ts": event["ts"], "args": {"rss_mb": round(rss, 1)}})
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError, ValueError):
+        return 0
+
+
+def _patch(module, attr, name, sizes=None):
+    """Replaces module.attr with a timed wrapper; sizes(args, result) -> (bytes_read, bytes_written)."""
+    original = getattr(module, attr)
+    if getattr(original, "_profiled", False):
+        return
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter_ns()
+        result = original(*args, **kwargs)
+        end = time.perf_counter_ns()
+        read, written = sizes(args, result) if sizes else (0, 0)
+        record(name, start, end, read, written)
+        return result
+
+    wrapper._profiled = True
+    wrapper.__wrapped__ = original
+    setattr(module, attr, wrapper)
+
+
+def _patch_hot_calls():
+    import cv2
+    import xml.etree.ElementTree as ET
+
+    _patch(cv2, "imread", "cv2.imread", lambda a, r: (_file_size(a[0]), 0))
+    _patch(cv2, "imdecode", "cv2.imdecode", lambda a, r: (len(a[0]), 0))
+    _patch(cv2, "resize", "cv2.resize")
+    _patch(cv2, "rotate", "cv2.rotate")
+    _patch(cv2, "imwrite", "cv2.imwrite", lambda a, r: (0, _file_size(a[0])))
+    _patch(cv2, "imencode", "cv2.imencode", lambda a, r: (0, len(r[1]) if r and r[0] else 0))
+    _patch(ET, "parse", "ET.parse", lambda a, r: (_file_size(a[0]), 0))
+
+
+def _reset_after_fork():
+    # A forked worker inherits the parent's buffer: start its own
+    if _state is not None:
+        _state["events"] = []
+        _state["counters"] = {}
+        _state["io_start"] = _proc_io()
+        _state["wall_start"] = time.time()
+
+
+def install(run_name=None):
+    """Enables profiling for this process if STICKY_PROFILE is set. Safe to call more than once."""
+    global _state
+    setting = os.environ.get(ENV_VAR, "")
+    if not setting or setting == "0" or _state is not None:
+        return
+    out_dir = DEFAULT_DIR if setting == "1" else setting
+    run = os.environ.get(RUN_ENV_VAR)
+    is_main = run is None
+    if is_main:
+        script = run_name or os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0]
+        run = f"{script}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        os.environ[RUN_ENV_VAR] = run  # inherited by spawned workers
+    _state = {
+        "dir": os.path.join(out_dir, run), "run": run, "is_main": is_main, "events": [], "counters": {},
+        "t0_ns": time.perf_counter_ns(), "offset_us": time.time() * 1e6, "wall_start": time.time(),
+        "io_start": _proc_io(), "main_pid": os.getpid() if is_main else None,
+    }
+    os.makedirs(_state["dir"], exist_ok=True)
+    _patch_hot_calls()
+    os.register_at_fork(after_in_child=_reset_after_fork)
+    atexit.register(_at_exit)
+    # Forked pool workers leave through os._exit, which skips atexit, but they run the
+    # multiprocessing finalizers - registered once the worker's own registry is set up
+    from multiprocessing import util
+    util.register_after_fork(_AFTER_FORK_KEY, lambda _: util.Finalize(None, flush, exitpriority=100))
+
+
+class _Key:
+    pass
+
+
+_AFTER_FORK_KEY = _Key()  # register_after_fork needs a weak-referenceable object
+
+
+def flush():
+    """Writes this process's events and totals to <dir>/<pid>.json (rewritten on every call)."""
+    state = _state
+    if state is None:
+        return
+    io_now, io_start = _proc_io(), state["io_start"]
+    data = {
+        "pid": os.getpid(),
+        "main": os.getpid() == state["main_pid"],
+        "events": state["events"],
+        "counters": state["counters"],
+        "peak_rss_mb": _peak_rss_mb(),
+        "io_read_bytes": io_now[0] - io_start[0] if io_now and io_start else None,
+        "io_write_bytes": io_now[1] - io_start[1] if io_now and io_start else None,
+        "wall_s": time.time() - state["wall_start"],
+    }
+    path = os.path.join(state["dir"], f"{os.getpid()}.json")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _at_exit():
+    flush()
+    if _state is not None and _state["is_main"] and os.getpid() == _state["main_pid"]:
+        print(report(_state["dir"]))
+
+
+def load_run(run_dir):
+    processes = []
+    for path in sorted(glob.glob(os.path.join(glob.escape(run_dir), "*.json"))):
+        if os.path.basename(path) == "trace.json":
+            continue
+        with open(path) as f:
+            processes.append(json.load(f))
+    return processes
+
+
+def summarize(processes):
+    """Per-operation totals over all processes: {name: [calls, seconds, bytes_read, bytes_written]}."""
+    totals = {}
+    for proc in processes:
+        for event in proc["events"]:
+            if event["ph"] != "X":
+                continue
+            row = totals.setdefault(event["name"], [0, 0.0, 0, 0])
+            row[0] += 1
+            row[1] += event["dur"] / 1e6
+            args = event.get("args", {})
+            row[2] += args.get("bytes_read", 0)
+            row[3] += args.get("bytes_written", 0)
+    return totals
+
+
+def report(run_dir):
+    """Merges the per-process files of a run into trace.json and returns the summary table."""
+    processes = load_run(run_dir)
+    events = []
+    for proc in processes:
+        events.append({"name": "process_name", "ph": "M", "pid": proc["pid"],
+                       "args": {"name": ("main" if proc.get("main") else "worker") + f" {proc['pid']}"}})
+        events += proc["events"]
+    trace_path = os.path.join(run_dir, "trace.json")
+    with open(trace_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    totals = summarize(processes)
+    wall = max([p["wall_s"] for p in processes if p.get("main")] or [p["wall_s"] for p in processes] or [0])
+    workers = max(1, len(processes))
+    lines = [f"\n[PROFILE] {run_dir}: {len(processes)} process(es), wall {wall:.2f}s",
+             "| Operation          |   Calls |  Total s | % of CPU-wall | Mean ms |  MB read | MB written |",
+             "|:-------------------|--------:|---------:|--------------:|--------:|---------:|-----------:|"]
+    for name, (calls, seconds, read, written) in sorted(totals.items(), key=lambda kv: -kv[1][1]):
+        share = 100 * seconds / max(wall * workers, 1e-9)
+        lines.append(f"| {name:<18} | {calls:>7} | {seconds:>8.2f} | {share:>12.1f}% | {seconds / calls * 1000:>7.2f} | "
+                     f"{read / 2**20:>8.1f} | {written / 2**20:>10.1f} |")
+    counters = {}
+    for proc in processes:
+        for key, value in proc["counters"].items():
+            counters[key] = counters.get(key, 0) + value
+    if counters:
+        lines.append("Counters: " + ", ".join(f"{k}={v}" for k, v in sorted(counters.items())))
+    peaks = [p["peak_rss_mb"] for p in processes if p.get("peak_rss_mb")]
+    if peaks:
+        lines.append(f"Peak RSS: {max(peaks):.0f} MB in one process, {sum(peaks):.0f} MB summed over processes")
+    io_read = sum(p["io_read_bytes"] or 0 for p in processes)
+    io_write = sum(p["io_write_bytes"] or 0 for p in processes)
+    if any(p["io_read_bytes"] is not None for p in processes):
+        lines.append(f"Storage I/O: {io_read / 2**20:.1f} MB read, {io_write / 2**20:.1f} MB written")
+    lines.append(f"Trace: {trace_path}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge and summarise a profiled run (STICKY_PROFILE=1).")
+    parser.add_argument("run_dir", nargs="?", default=None, help="profiles/<run> (default: latest)")
+    args = parser.parse_args()
+    run_dir = args.run_dir
+    if run_dir is None:
+        runs = sorted(glob.glob(os.path.join(DEFAULT_DIR, "*")), key=os.path.getmtime)
+        if not runs:
+            raise SystemExit(f"[ERROR] No runs in {DEFAULT_DIR}/ - run a script with {ENV_VAR}=1 first")
+        run_dir = runs[-1]
+    print(report(run_dir))
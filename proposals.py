@@ -0,0 +1,166 @@
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+from crops import crop_windows
+from tiled_inference import (
+    TiledDetector, MODEL_PATH, TILE_SIZE, NUM_THREADS, BATCH_SIZE, TARGET_PIXELS, CLASS_NAMES,
+    EDGE_MARGIN, box_iou, resize_to_pixels,
+)
+
+"""
+Cheap candidate-region proposals ahead of the 120px detector.
+
+Most of a yellow sticky trap is empty yellow background. Insects are dark or at
+least not yellow, so a colour threshold on a downscaled copy plus connected
+components finds them for a tiny fraction of the detector's cost. The detector
+then only runs on windows centred on those candidates, using the same centring
+and clamping as the training crops of 120px.py (crops.crop_windows).
+
+Run with --compare to measure how many detections of exhaustive tiling are still
+found (recall) and how many windows were saved.
+"""
+
+PROPOSAL_SCALE = 0.25     # downscale of the working image used for thresholding
+YELLOW_HUE = (15, 40)     # OpenCV hue range (0-180) of the trap background
+MIN_SATURATION = 80       # below this a pixel is not "yellow" (grey/white/black)
+DARK_VALUE = 110          # pixels darker than this are candidates whatever their hue
+MIN_AREA = 2              # blob area limits, in downscaled pixels
+MAX_AREA = 4000
+BOX_SLACK = 16            # how far a detected box may reach past its blob (legs, antennae, 1/PROPOSAL_SCALE rounding)
+# A blob this far inside a chosen window needs no window of its own. detect_windows drops boxes
+# within EDGE_MARGIN of an inner window border (expecting a grid neighbour to have them whole),
+# so the whole box - not just the blob - must stay clear of that margin.
+COVER_MARGIN = (EDGE_MARGIN or 0) + BOX_SLACK
+
+
+def candidate_mask(small_bgr):
+    """Boolean mask of pixels that do not look like yellow trap background."""
+    hsv = cv2.cvtColor(small_bgr, cv2.COLOR_BGR2HSV)
+    hue, sat, val = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    yellow = (hue >= YELLOW_HUE[0]) & (hue <= YELLOW_HUE[1]) & (sat >= MIN_SATURATION)
+    return (val < DARK_VALUE) | ~yellow
+
+
+def find_candidates(img, scale=PROPOSAL_SCALE):
+    """Returns candidate blob boxes (N, 4) xyxy in img pixels."""
+    h, w = img.shape[:2]
+    small = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    mask = candidate_mask(small).astype(np.uint8)
+    n, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    stats = stats[1:]  # label 0 is the background
+    area = stats[:, cv2.CC_STAT_AREA]
+    stats = stats[(area >= MIN_AREA) & (area <= MAX_AREA)]
+    boxes = np.empty((len(stats), 4), dtype=np.float64)
+    boxes[:, 0] = stats[:, cv2.CC_STAT_LEFT]
+    boxes[:, 1] = stats[:, cv2.CC_STAT_TOP]
+    boxes[:, 2] = stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH]
+    boxes[:, 3] = stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT]
+    return boxes / scale
+
+
+def proposal_windows(blobs, img_w, img_h, tile_size=TILE_SIZE):
+    """
+    Top-left corners of tile_size windows centred on the blobs (clamped like the
+    120px training crops). Blobs already well inside a chosen window are skipped.
+    """
+    if len(blobs) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    xc = (blobs[:, 0] + blobs[:, 2]) / 2
+    yc = (blobs[:, 1] + blobs[:, 3]) / 2
+    x1, y1 = crop_windows(xc, yc, img_w, img_h, tile_size)
+
+    # Largest blobs first, then greedily drop blobs covered by an already chosen window
+    order = np.argsort(-(blobs[:, 2] - blobs[:, 0]) * (blobs[:, 3] - blobs[:, 1]), kind="stable")
+    chosen = []
+    for i in order:
+        if chosen:
+            cx1, cy1 = x1[chosen], y1[chosen]
+            inside = (blobs[i, 0] >= cx1 + COVER_MARGIN) & (blobs[i, 1] >= cy1 + COVER_MARGIN) & \
+                     (blobs[i, 2] <= cx1 + tile_size - COVER_MARGIN) & (blobs[i, 3] <= cy1 + tile_size - COVER_MARGIN)
+            if inside.any():
+                continue
+        chosen.append(i)
+    chosen = np.array(chosen, dtype=np.int64)
+    return x1[chosen], y1[chosen]
+
+
+def detect_with_proposals(detector, img, tile_size=TILE_SIZE, target_pixels=TARGET_PIXELS):
+    """Same result dict as TiledDetector.detect, but only on proposal windows."""
+    start = time.perf_counter()
+    work, scale = resize_to_pixels(img, target_pixels)
+    blobs = find_candidates(work)
+    h, w = work.shape[:2]
+    if h < tile_size or w < tile_size:
+        # Like TiledDetector.detect: the windows need a full tile (the black padding is no candidate)
+        pad = ((0, max(0, tile_size - h)), (0, max(0, tile_size - w)), (0, 0))
+        work = np.pad(work, pad)
+        h, w = work.shape[:2]
+    x1, y1 = proposal_windows(blobs, w, h, tile_size)
+    if len(x1):
+        boxes, scores, classes = detector.detect_windows(work, x1, y1, tile_size)
+    else:
+        boxes, scores, classes = np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64)
+    elapsed = time.perf_counter() - start
+    return {
+        "boxes": boxes / scale,
+        "scores": scores,
+        "classes": classes,
+        "tiles": len(x1),
+        "candidates": len(blobs),
+        "seconds": elapsed,
+        "tiles_per_second": len(x1) / elapsed if elapsed > 0 else float("inf"),
+    }
+
+
+def matched_recall(reference, candidate, iou_threshold=0.5):
+    """Fraction of reference detections with a same-class candidate detection at IoU >= threshold."""
+    if len(reference["boxes"]) == 0:
+        return 1.0
+    if len(candidate["boxes"]) == 0:
+        return 0.0
+    iou = box_iou(reference["boxes"], candidate["boxes"])
+    iou[reference["classes"][:, None] != candidate["classes"][None, :]] = 0
+    return float((iou.max(1) >= iou_threshold).mean())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the 120px model only around dark blobs on the trap.")
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--tile-size", type=int, default=TILE_SIZE)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=NUM_THREADS)
+    parser.add_argument("--compare", action="store_true", help="also run exhaustive tiling and report recall/cost")
+    args = parser.parse_args()
+
+    detector = TiledDetector(args.model, args.threads, args.batch_size)
+    recalls = []
+    tiles_full = tiles_prop = 0
+    seconds_full = seconds_prop = 0.0
+    for img_path in args.images:
+        img = cv2.imread(img_path)
+        if img is None:
+            print(f"[WARN] Failed to load {img_path}")
+            continue
+        result = detect_with_proposals(detector, img, args.tile_size)
+        counts = np.bincount(result["classes"].astype(np.int64), minlength=len(CLASS_NAMES))
+        line = (f"[OK] {img_path}: {len(result['boxes'])} detections "
+                f"({', '.join(f'{n}: {c}' for n, c in zip(CLASS_NAMES, counts))}) - "
+                f"{result['candidates']} candidates, {result['tiles']} windows, {result['seconds']:.2f}s")
+        tiles_prop += result["tiles"]
+        seconds_prop += result["seconds"]
+        if args.compare:
+            full = detector.detect(img, args.tile_size)
+            recall = matched_recall(full, result)
+            recalls.append(recall)
+            tiles_full += full["tiles"]
+            seconds_full += full["seconds"]
+            line += f" | exhaustive: {full['tiles']} tiles, {full['seconds']:.2f}s, recall {recall:.3f}"
+        print(line)
+
+    if args.compare and recalls:
+        print(f"\n✅ Recall vs exhaustive tiling: {np.mean(recalls):.3f} | windows {tiles_prop} vs {tiles_full} tiles "
+              f"({tiles_full / max(tiles_prop, 1):.1f}x fewer) | time {seconds_prop:.2f}s vs {seconds_full:.2f}s")
@@ -0,0 +1,188 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import yaml
+
+from build_cache import BuildCache
+from file_links import link_file, is_placed, imwrite_replace
+from image_header import read_image_size
+
+"""
+Builds every resolution variant of the split dataset in a single pass.
+
+Each source image is decoded once - at reduced resolution straight from the JPEG
+DCT coefficients (IMREAD_REDUCED_COLOR_2/4/8) whenever the largest target allows
+it - and every megapixel target is resized from that one decode. The labels/
+tree and dataset.yaml are mirrored automatically: YOLO labels are normalised,
+so they are the same files for every resolution.
+
+Replaces 5mpx.py (and the manual copy of the labels it asked for).
+"""
+
+# Diretórios
+SRC_DIR = "sticky_dataset/16mpx"
+DST_ROOT = "sticky_dataset"
+splits = ["train", "val"]
+
+# Output dataset name -> target pixel count
+TARGETS = {
+    "5mpx": 5_000_000,
+    "2mpx": 2_000_000,
+}
+
+# Worker processes (1 = serial)
+NUM_WORKERS = os.cpu_count() or 1
+
+# DCT scaling factors OpenCV can decode at directly
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def target_size(w, h, target_pixels):
+    """Same rounding as 5mpx.py; never upscales."""
+    scale = (target_pixels / (w * h)) ** 0.5
+    if scale >= 1:
+        return w, h
+    return int(w * scale), int(h * scale)
+
+
+def reduction_factor(w, h, min_w, min_h, is_jpeg=True):
+    """Largest DCT reduction that still decodes at least min_w x min_h pixels."""
+    if not is_jpeg:
+        return 1
+    best = 1
+    for factor in REDUCED_FLAGS:
+        if -(-w // factor) >= min_w and -(-h // factor) >= min_h:
+            best = max(best, factor)
+    return best
+
+
+def imread_reduced(img_path, min_w, min_h, size=None):
+    """Decodes img_path at the smallest DCT-scaled size that is >= min_w x min_h."""
+    if size is None:
+        size = read_image_size(img_path)
+    if size is None:
+        return None
+    h, w = size
+    is_jpeg = img_path.lower().endswith((".jpg", ".jpeg"))
+    factor = reduction_factor(w, h, min_w, min_h, is_jpeg)
+    return cv2.imread(img_path, REDUCED_FLAGS[factor])
+
+
+def build_image(task):
+    """Decodes one image once and writes it for every target. Returns (ok, log line)."""
+    img_path, out_paths = task
+    size = read_image_size(img_path)
+    if size is None:
+        return False, f"Failed to load {img_path}"
+    h, w = size
+    sizes = {name: target_size(w, h, TARGETS[name]) for name in out_paths}
+    max_w = max(s[0] for s in sizes.values())
+    max_h = max(s[1] for s in sizes.values())
+
+    img = imread_reduced(img_path, max_w, max_h, size)
+    if img is None:
+        return False, f"Failed to load {img_path}"
+
+    ok = True
+    logs = []
+    for name, out_path in out_paths.items():
+        new_w, new_h = sizes[name]
+        if (new_w, new_h) == (w, h):
+            # Target is not smaller than the source: keep the original bytes
+            placed = link_file(img_path, out_path) is not None
+        else:
+            if img.shape[1] == new_w and img.shape[0] == new_h:
+                img_resized = img
+            else:
+                img_resized = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+            placed = imwrite_replace(out_path, img_resized)  # out_path may still be a link to the source
+        ok = ok and placed
+        logs.append(f"{name} {new_w}x{new_h}" + ("" if placed else " FAILED"))
+    return ok, f"{img_path} ({w}x{h}, decoded {img.shape[1]}x{img.shape[0]}) -> " + ", ".join(logs)
+
+
+def mirror_labels(split):
+    src_dir = os.path.join(SRC_DIR, "labels", split)
+    if not os.path.isdir(src_dir):
+        print(f"[WARN] No labels found in {src_dir}")
+        return
+    for name in TARGETS:
+        dst_dir = os.path.join(DST_ROOT, name, "labels", split)
+        os.makedirs(dst_dir, exist_ok=True)
+        src_labels = {f for f in os.listdir(src_dir) if f.endswith(".txt")}
+        for fname in src_labels:
+            src, dst = os.path.join(src_dir, fname), os.path.join(dst_dir, fname)
+            if not is_placed(src, dst):
+                link_file(src, dst)
+        # Labels whose source image left the split are stale
+        for fname in os.listdir(dst_dir):
+            if fname.endswith(".txt") and fname not in src_labels:
+                os.remove(os.path.join(dst_dir, fname))
+
+
+def mirror_yaml():
+    src_yaml = os.path.join(SRC_DIR, "dataset.yaml")
+    if not os.path.exists(src_yaml):
+        return
+    with open(src_yaml) as f:
+        yaml_dict = yaml.safe_load(f)
+    for name in TARGETS:
+        dst_dir = os.path.join(DST_ROOT, name)
+        out = dict(yaml_dict)
+        out["train"] = os.path.abspath(os.path.join(dst_dir, "images/train"))
+        out["val"] = os.path.abspath(os.path.join(dst_dir, "images/val"))
+        with open(os.path.join(dst_dir, "dataset.yaml"), "w") as f:
+            yaml.dump(out, f, sort_keys=False)
+
+
+def build_pyramid(num_workers=NUM_WORKERS, cache=None):
+    cache = cache or BuildCache()
+    params = {"targets": TARGETS}
+    tasks = []
+    for split in splits:
+        src_dir = os.path.join(SRC_DIR, "images", split)
+        for name in TARGETS:
+            os.makedirs(os.path.join(DST_ROOT, name, "images", split), exist_ok=True)
+        for fname in sorted(os.listdir(src_dir)):
+            if not fname.lower().endswith(('.jpg', '.jpeg', '.png')):
+                continue
+            out_paths = {name: os.path.join(DST_ROOT, name, "images", split, fname) for name in TARGETS}
+            tasks.append((os.path.join(src_dir, fname), out_paths))
+        mirror_labels(split)
+    mirror_yaml()
+
+    # Only images whose source, targets or outputs changed are rebuilt
+    cache.prime([img_path for img_path, _ in tasks], num_workers)
+    todo = [t for t in tasks if not cache.is_fresh("pyramid", t[0], [t[0]], params)]
+
+    if num_workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(build_image, todo))
+    else:
+        results = [build_image(task) for task in todo]
+
+    # A failed image stays out of the cache so the next run retries it
+    failed = 0
+    for (img_path, out_paths), (ok, line) in zip(todo, results):
+        print(line)
+        if ok:
+            cache.record("pyramid", img_path, [img_path], params, list(out_paths.values()))
+        else:
+            failed += 1
+    removed = cache.evict("pyramid", [img_path for img_path, _ in tasks])
+    cache.save()
+    print(f"[INFO] {len(todo)} of {len(tasks)} images rebuilt, {len(removed)} stale files removed.")
+    if failed:
+        print(f"[WARN] {failed} images failed and will be retried on the next run.")
+    return len(todo)
+
+
+if __name__ == "__main__":
+    n = build_pyramid()
+    print(f"{n} imagens convertidas para {', '.join(TARGETS)} (mantendo proporção), labels espelhados.")
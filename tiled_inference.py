@@ -0,0 +1,258 @@
+import os
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+from crops import extract_crops
+
+"""
+Tiled sliding-window inference of the 120px model over full-resolution trap photos.
+
+The 120px model only ever saw ~128x128 object-centred crops, so a full trap photo
+is first brought to the scale the crops were cut at (~5 MP, see 120px.py), cut
+into overlapping tiles, and the tiles are run through ONNX Runtime on CPU in large
+batches. Detections are mapped back to global (original image) coordinates and
+duplicates across tile seams are merged with a vectorized NMS.
+
+Export the model first:  yolo export model=120px/weights/best.pt format=onnx
+"""
+
+MODEL_PATH = "120px/weights/best.onnx"
+CLASS_NAMES = ["Macrolophus", "Nesidiocoris", "Whitefly"]
+
+TILE_SIZE = 128
+OVERLAP = 48          # should be larger than the biggest insect (in working-scale pixels)
+BATCH_SIZE = 256
+NUM_THREADS = os.cpu_count() or 1
+CONF_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.5
+TARGET_PIXELS = 5_000_000  # scale the 120px crops were cut at (None = use the image as is)
+EDGE_MARGIN = 2            # boxes touching an inner tile border are cut off: the neighbour tile has them whole
+
+
+def tile_positions(length, tile_size, overlap):
+    """Start offsets covering [0, length) with tiles of tile_size overlapping by overlap."""
+    if length <= tile_size:
+        return np.zeros(1, dtype=np.int64)
+    stride = max(1, tile_size - overlap)
+    starts = np.arange(0, length - tile_size + 1, stride, dtype=np.int64)
+    if starts[-1] != length - tile_size:
+        starts = np.append(starts, length - tile_size)
+    return starts
+
+
+def tile_grid(img_w, img_h, tile_size=TILE_SIZE, overlap=OVERLAP):
+    """Returns (x1, y1) arrays of the top-left corners of every tile."""
+    xs = tile_positions(img_w, tile_size, overlap)
+    ys = tile_positions(img_h, tile_size, overlap)
+    y1, x1 = np.meshgrid(ys, xs, indexing="ij")
+    return x1.ravel(), y1.ravel()
+
+
+def box_iou(a, b):
+    """IoU matrix between (N, 4) and (M, 4) xyxy boxes."""
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    wh = np.clip(rb - lt, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def nms(boxes, scores, iou_threshold=IOU_THRESHOLD, classes=None):
+    """
+    Greedy NMS; returns the indices to keep, best first. With classes given, boxes
+    of different classes never suppress each other (coordinate-offset trick).
+    """
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    boxes = boxes.astype(np.float64)
+    if classes is not None:
+        offset = boxes.max() + 1
+        boxes = boxes + (classes.astype(np.float64) * offset)[:, None]
+    order = np.argsort(-scores, kind="stable")
+    boxes = boxes[order]
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    keep = []
+    for i in range(len(boxes)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        rest = np.arange(i + 1, len(boxes))
+        rest = rest[~suppressed[rest]]
+        if len(rest) == 0:
+            break
+        lt = np.maximum(boxes[i, :2], boxes[rest, :2])
+        rb = np.minimum(boxes[i, 2:], boxes[rest, 2:])
+        wh = np.clip(rb - lt, 0, None)
+        inter = wh[:, 0] * wh[:, 1]
+        iou = inter / np.maximum(area[i] + area[rest] - inter, 1e-9)
+        suppressed[rest[iou > iou_threshold]] = True
+    return order[np.array(keep, dtype=np.int64)]
+
+
+def resize_to_pixels(img, target_pixels):
+    """Downscales img to ~target_pixels (INTER_AREA, like 5mpx.py). Returns (img, scale)."""
+    h, w = img.shape[:2]
+    if target_pixels is None or w * h <= target_pixels:
+        return img, 1.0
+    scale = (target_pixels / (w * h)) ** 0.5
+    new_w, new_h = int(w * scale), int(h * scale)
+    return cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA), new_w / w
+
+
+class TiledDetector:
+    def __init__(self, model_path=MODEL_PATH, num_threads=NUM_THREADS, batch_size=BATCH_SIZE,
+                 conf_threshold=CONF_THRESHOLD, iou_threshold=IOU_THRESHOLD):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_size = model_input.shape[2] if isinstance(model_input.shape[2], int) else TILE_SIZE
+        self.batch_size = batch_size
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+
+    def preprocess(self, tiles):
+        """uint8 BGR (N, t, t, 3) -> float32 RGB NCHW in [0, 1] at the model input size."""
+        if tiles.shape[1] != self.input_size or tiles.shape[2] != self.input_size:
+            size = (self.input_size, self.input_size)
+            tiles = np.stack([cv2.resize(t, size, interpolation=cv2.INTER_LINEAR) for t in tiles])
+        x = tiles[..., ::-1].transpose(0, 3, 1, 2).astype(np.float32)
+        x *= 1 / 255.0
+        return np.ascontiguousarray(x)
+
+    def infer(self, tiles):
+        """Raw model output (N, 4 + nc, anchors) for uint8 BGR tiles, run in batches."""
+        outputs = []
+        for start in range(0, len(tiles), self.batch_size):
+            batch = self.preprocess(tiles[start:start + self.batch_size])
+            outputs.append(self.session.run(None, {self.input_name: batch})[0])
+        return np.concatenate(outputs)
+
+    def decode(self, raw, x1, y1, tile_size, img_w=None, img_h=None):
+        """
+        Converts raw outputs of tiles at (x1, y1) into global xyxy boxes, scores and classes.
+        Boxes cut off by an inner tile border are dropped (the overlapping tile sees them whole).
+        """
+        pred = raw.transpose(0, 2, 1)  # (N, anchors, 4 + nc)
+        cls_scores = pred[..., 4:]
+        classes = cls_scores.argmax(-1)
+        scores = np.take_along_axis(cls_scores, classes[..., None], -1)[..., 0]
+        tile_idx, anchor_idx = np.nonzero(scores > self.conf_threshold)
+        xywh = pred[tile_idx, anchor_idx, :4] * (tile_size / self.input_size)
+        boxes = np.empty_like(xywh)
+        boxes[:, :2] = xywh[:, :2] - xywh[:, 2:] / 2
+        boxes[:, 2:] = xywh[:, :2] + xywh[:, 2:] / 2
+        np.clip(boxes, 0, tile_size, out=boxes)
+
+        if img_w is not None and img_h is not None and EDGE_MARGIN is not None:
+            tx, ty = x1[tile_idx], y1[tile_idx]
+            cut = ((boxes[:, 0] <= EDGE_MARGIN) & (tx > 0)) | \
+                  ((boxes[:, 1] <= EDGE_MARGIN) & (ty > 0)) | \
+                  ((boxes[:, 2] >= tile_size - EDGE_MARGIN) & (tx + tile_size < img_w)) | \
+                  ((boxes[:, 3] >= tile_size - EDGE_MARGIN) & (ty + tile_size < img_h))
+            keep = ~cut
+            boxes, tile_idx, anchor_idx = boxes[keep], tile_idx[keep], anchor_idx[keep]
+
+        boxes[:, [0, 2]] += x1[tile_idx, None]
+        boxes[:, [1, 3]] += y1[tile_idx, None]
+        return boxes, scores[tile_idx, anchor_idx], classes[tile_idx, anchor_idx]
+
+    def detect_windows(self, img, x1, y1, tile_size=TILE_SIZE):
+        """Runs the model on the given windows of img and merges the results with NMS."""
+        h, w = img.shape[:2]
+        tiles = extract_crops(img, x1, y1, tile_size)
+        raw = self.infer(tiles)
+        boxes, scores, classes = self.decode(raw, x1, y1, tile_size, w, h)
+        keep = nms(boxes, scores, self.iou_threshold, classes)
+        return boxes[keep], scores[keep], classes[keep]
+
+    def detect(self, img, tile_size=TILE_SIZE, overlap=OVERLAP, target_pixels=TARGET_PIXELS):
+        """
+        Detects insects on a full trap image. Returns a dict with xyxy boxes in
+        original-image pixels, scores, classes and timing stats.
+        """
+        start = time.perf_counter()
+        work, scale = resize_to_pixels(img, target_pixels)
+        h, w = work.shape[:2]
+        if h < tile_size or w < tile_size:
+            pad = ((0, max(0, tile_size - h)), (0, max(0, tile_size - w)), (0, 0))
+            work = np.pad(work, pad)
+        x1, y1 = tile_grid(work.shape[1], work.shape[0], tile_size, overlap)
+        boxes, scores, classes = self.detect_windows(work, x1, y1, tile_size)
+        boxes = boxes / scale
+        elapsed = time.perf_counter() - start
+        return {
+            "boxes": boxes,
+            "scores": scores,
+            "classes": classes,
+            "tiles": len(x1),
+            "seconds": elapsed,
+            "tiles_per_second": len(x1) / elapsed if elapsed > 0 else float("inf"),
+        }
+
+
+def save_yolo_predictions(path, result, img_w, img_h):
+    """Writes detections as YOLO lines with a trailing confidence: class xc yc w h conf."""
+    with open(path, "w") as f:
+        for (x1, y1, x2, y2), score, cls in zip(result["boxes"], result["scores"], result["classes"]):
+            f.write(f"{int(cls)} {(x1 + x2) / 2 / img_w:.6f} {(y1 + y2) / 2 / img_h:.6f} "
+                    f"{(x2 - x1) / img_w:.6f} {(y2 - y1) / img_h:.6f} {score:.5f}\n")
+
+
+def draw_detections(img, result):
+    out = img.copy()
+    for (x1, y1, x2, y2), score, cls in zip(result["boxes"].astype(int), result["scores"], result["classes"]):
+        cv2.rectangle(out, (x1, y1), (x2, y2), (0, 0, 255), 4)
+        cv2.putText(out, f"{CLASS_NAMES[cls]} {score:.2f}", (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 255, 0), 2)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the 120px model over full trap photos with overlapping tiles.")
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--tile-size", type=int, default=TILE_SIZE)
+    parser.add_argument("--overlap", type=int, default=OVERLAP)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=NUM_THREADS)
+    parser.add_argument("--conf", type=float, default=CONF_THRESHOLD)
+    parser.add_argument("--iou", type=float, default=IOU_THRESHOLD)
+    parser.add_argument("--target-pixels", type=int, default=TARGET_PIXELS, help="0 = no rescaling")
+    parser.add_argument("--out-dir", default=None, help="write <name>.txt predictions and <name>_pred.jpg here")
+    args = parser.parse_args()
+
+    detector = TiledDetector(args.model, args.threads, args.batch_size, args.conf, args.iou)
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    total_tiles = total_seconds = 0
+    for img_path in args.images:
+        img = cv2.imread(img_path)
+        if img is None:
+            print(f"[WARN] Failed to load {img_path}")
+            continue
+        result = detector.detect(img, args.tile_size, args.overlap, args.target_pixels or None)
+        total_tiles += result["tiles"]
+        total_seconds += result["seconds"]
+        counts = np.bincount(result["classes"], minlength=len(CLASS_NAMES))
+        summary = ", ".join(f"{name}: {n}" for name, n in zip(CLASS_NAMES, counts))
+        print(f"[OK] {img_path}: {len(result['boxes'])} detections ({summary}) "
+              f"- {result['tiles']} tiles, {result['tiles_per_second']:.1f} tiles/s")
+        if args.out_dir:
+            name = os.path.splitext(os.path.basename(img_path))[0]
+            save_yolo_predictions(os.path.join(args.out_dir, name + ".txt"), result, img.shape[1], img.shape[0])
+            cv2.imwrite(os.path.join(args.out_dir, name + "_pred.jpg"), draw_detections(img, result))
+
+    if total_seconds > 0:
+        print(f"\n✅ {total_tiles} tiles in {total_seconds:.2f}s ({total_tiles / total_seconds:.1f} tiles/s)")
@@ -1,6 +1,10 @@
 import os
-import cv2
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import profiling
+from build_cache import BuildCache
+from image_header import read_image_size
 
 # Class and abbreviation map
 ABBR_TO_CLASS = {
@@ -11,25 +15,35 @@ ABBR_TO_CLASS = {
 }
 CLASSES = ["Macrolophus", "Nesidiocoris", "Whitefly", "Thysanoptera"]
 
-def voc_xml_to_yolo_txt(img_path, xml_path, txt_path=None, verbose=True):
-    if txt_path is None:
-        txt_path = os.path.splitext(img_path)[0] + ".txt"
-    img = cv2.imread(img_path)
-    if img is None:
-        if verbose:
-            print(f"[WARN] Image not found: {img_path}")
-        return False
-    img_h, img_w = img.shape[:2]
+# Worker processes for the batch conversion (1 = serial, in this process)
+NUM_WORKERS = os.cpu_count() or 1
+
+# Take the image size from the VOC <size> element instead of the image header.
+# Only safe once the XMLs are known to match the (orientation-fixed) images.
+TRUST_VOC_SIZE = False
+
+# Only the script itself (and its spawned pool workers) profile - never a module that imports this one
+if __name__ in ("__main__", "__mp_main__"):
+    profiling.install()  # no-op unless STICKY_PROFILE is set
+
+def voc_size(root):
+    """Returns (height, width) from the VOC <size> element, or None if missing/invalid."""
+    size = root.find("size")
+    if size is None:
+        return None
     try:
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-    except Exception as e:
-        if verbose:
-            print(f"[WARN] Failed to parse XML: {xml_path}: {e}")
-        return False
+        w = int(float(size.find("width").text))
+        h = int(float(size.find("height").text))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if w <= 0 or h <= 0:
+        return None
+    return h, w
 
-    yolo_lines = []
-    for obj in root.findall("object"):
+def voc_root_to_boxes(root, img_w, img_h, xml_path="", verbose=True):
+    """Returns a list of (cls_id, cx, cy, bw, bh, object_index) for the valid objects, normalised."""
+    boxes = []
+    for obj_idx, obj in enumerate(root.findall("object")):
         abbr = obj.find("name").text
         if abbr not in ABBR_TO_CLASS:
             if verbose:
@@ -54,11 +68,41 @@ def voc_xml_to_yolo_txt(img_path, xml_path, txt_path=None, verbose=True):
             if verbose:
                 print(f"[SKIP] Out-of-bounds bbox in {xml_path}: {cx}, {cy}, {bw}, {bh}")
             continue
-        yolo_lines.append(f"{cls_id} {cx:.6f} {cy:.6f} {bw:.6f} {bh:.6f}")
+        boxes.append((cls_id, cx, cy, bw, bh, obj_idx))
+    return boxes
+
+def voc_root_to_yolo_lines(root, img_w, img_h, xml_path="", verbose=True):
+    return [f"{cls_id} {cx:.6f} {cy:.6f} {bw:.6f} {bh:.6f}"
+            for cls_id, cx, cy, bw, bh, _ in voc_root_to_boxes(root, img_w, img_h, xml_path, verbose)]
+
+def voc_xml_to_yolo_txt(img_path, xml_path, txt_path=None, verbose=True, trust_voc_size=TRUST_VOC_SIZE):
+    if txt_path is None:
+        txt_path = os.path.splitext(img_path)[0] + ".txt"
+    try:
+        tree = ET.parse(xml_path)
+        root = tree.getroot()
+    except Exception as e:
+        if verbose:
+            print(f"[WARN] Failed to parse XML: {xml_path}: {e}")
+        return False
+
+    # Image size from the VOC <size> element or from the image header - never a full decode
+    size = voc_size(root) if trust_voc_size else None
+    if size is None:
+        with profiling.span("image_header"):
+            size = read_image_size(img_path)
+    if size is None:
+        if verbose:
+            print(f"[WARN] Image not found: {img_path}")
+        return False
+    img_h, img_w = size
+
+    yolo_lines = voc_root_to_yolo_lines(root, img_w, img_h, xml_path, verbose)
 
     if yolo_lines:
-        with open(txt_path, "w") as f:
-            f.write("\n".join(yolo_lines))
+        text = "\n".join(yolo_lines)
+        with profiling.span("label_write", bytes_written=len(text)), open(txt_path, "w") as f:
+            f.write(text)
         if verbose:
             print(f"[OK] {txt_path} ({len(yolo_lines)} objects)")
         return True
@@ -67,28 +111,68 @@ def voc_xml_to_yolo_txt(img_path, xml_path, txt_path=None, verbose=True):
             print(f"[EMPTY] No valid objects in {xml_path}")
         return False
 
-# --------- Loop to process the whole folder --------------
+def _convert_one(img_path):
+    xml_path = os.path.splitext(img_path)[0] + ".xml"
+    if not os.path.exists(xml_path):
+        print(f"[WARN] No XML found for image: {img_path}")
+        return "missing"
+    if voc_xml_to_yolo_txt(img_path, xml_path):
+        return "ok"
+    # Do not leave a label from a previous run behind
+    txt_path = os.path.splitext(img_path)[0] + ".txt"
+    if os.path.exists(txt_path):
+        os.remove(txt_path)
+    return "empty"
 
-DATASET_DIR = "sticky_dataset/stickytraps"
-files = os.listdir(DATASET_DIR)
-images = [f for f in files if f.lower().endswith(".jpg")]
+def convert_folder(dataset_dir, num_workers=NUM_WORKERS, cache=None):
+    """
+    Converts every image/XML pair in dataset_dir whose image, XML or class map changed
+    since the last run. Returns (success, empty, failed) counts over the whole folder.
+    """
+    cache = cache or BuildCache()
+    params = {"classes": CLASSES, "abbr_to_class": ABBR_TO_CLASS, "trust_voc_size": TRUST_VOC_SIZE}
+    images = [os.path.join(dataset_dir, f) for f in sorted(os.listdir(dataset_dir)) if f.lower().endswith(".jpg")]
 
-count_success = 0
-count_empty = 0
-count_failed = 0
+    def io_paths(img_path):
+        stem = os.path.splitext(img_path)[0]
+        return [img_path, stem + ".xml"], [stem + ".txt"]
 
-for img_file in images:
-    img_path = os.path.join(DATASET_DIR, img_file)
-    xml_path = os.path.splitext(img_path)[0] + ".xml"
-    if os.path.exists(xml_path):
-        result = voc_xml_to_yolo_txt(img_path, xml_path)
-        if result:
-            count_success += 1
-        else:
-            count_empty += 1
+    cache.prime([p for img in images for p in io_paths(img)[0] if os.path.exists(p)], num_workers)
+    todo = [img for img in images if not cache.is_fresh("xml_txt", img, io_paths(img)[0], params)]
+
+    if num_workers > 1 and len(todo) > 1:
+        chunksize = max(1, len(todo) // (num_workers * 8))
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(_convert_one, todo, chunksize=chunksize))
     else:
-        print(f"[WARN] No XML found for image: {img_path}")
-        count_failed += 1
+        results = [_convert_one(p) for p in todo]
+
+    for img_path, result in zip(todo, results):
+        if result == "missing":
+            cache.forget("xml_txt", img_path)
+        else:
+            inputs, outputs = io_paths(img_path)
+            cache.record("xml_txt", img_path, inputs, params, outputs)
+    cache.evict("xml_txt", images)
+    cache.save()
 
-print(f"\nDone! Converted {count_success} files. {count_empty} had no valid objects. {count_failed} images had no XML.")
+    # Counts over the whole folder, including items that were up to date
+    counts = {"ok": 0, "empty": 0, "missing": 0}
+    for img_path in images:
+        inputs, outputs = io_paths(img_path)
+        if not os.path.exists(inputs[1]):
+            counts["missing"] += 1
+        elif os.path.exists(outputs[0]):
+            counts["ok"] += 1
+        else:
+            counts["empty"] += 1
+    print(f"[INFO] {len(todo)} of {len(images)} images (re)converted, the rest were up to date.")
+    return counts["ok"], counts["empty"], counts["missing"]
+
+# --------- Loop to process the whole folder --------------
+
+DATASET_DIR = "sticky_dataset/stickytraps"
 
+if __name__ == "__main__":
+    count_success, count_empty, count_failed = convert_folder(DATASET_DIR)
+    print(f"\nDone! Converted {count_success} files. {count_empty} had no valid objects. {count_failed} images had no XML.")